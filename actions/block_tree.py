@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+
+from actions.hashing import new_hash
+from config.config import *
+
+
+class BlockTree:
+    '''Block hashes of an image: a flat list of digests (leaves), one per leaf_size bytes.
+
+    Comparing the leaves of a target with those of the source shows which ranges of the target are
+    bad, so only those have to be written again. Built with update() while the image is read, and
+    saved next to image files so it is only built once per image.'''
+    def __init__(self, **kwargs):
+        self.leaf_size = kwargs.get('leaf_size', BLOCK_TREE_LEAF_SIZE)
+        self.algorithm = kwargs.get('algorithm', HASH_ALGORITHM)
+        self.leaves = kwargs.get('leaves', [])
+        self.size = kwargs.get('size', 0)
+        self.digest = None
+        self.filled = 0
+
+    def update(self, data):
+        '''Add the next bytes of the image'''
+        view = memoryview(data)
+        while view:
+            if self.digest is None:
+                self.digest = new_hash(self.algorithm)
+            n = min(len(view), self.leaf_size - self.filled)
+            self.digest.update(view[:n])
+            self.filled += n
+            self.size += n
+            view = view[n:]
+            if self.filled == self.leaf_size:
+                self.end_leaf()
+
+    def end_leaf(self):
+        self.leaves.append(self.digest.hexdigest())
+        self.digest = None
+        self.filled = 0
+
+    def finish(self):
+        '''Add the last, partial leaf. Call once all the data has been added'''
+        if self.filled:
+            self.end_leaf()
+        return self
+
+    def hash_leaf(self, data):
+        digest = new_hash(self.algorithm)
+        digest.update(data)
+        return digest.hexdigest()
+
+    def get_leaf_range(self, leaf):
+        '''Return (offset, length) of a leaf in the image'''
+        offset = leaf * self.leaf_size
+        return offset, min(self.leaf_size, self.size - offset)
+
+    def get_ranges(self, leaves):
+        '''Return the (offset, length) of the byte ranges covered by leaves, merging adjacent ones'''
+        ranges = []
+        for leaf in sorted(leaves):
+            offset, length = self.get_leaf_range(leaf)
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((offset, length))
+        return ranges
+
+    def save(self, path, key):
+        '''Save the tree to path. key identifies the image it was built from'''
+        tree = {'key': key, 'leaf_size': self.leaf_size, 'algorithm': self.algorithm, 'size': self.size,
+                'leaves': self.leaves}
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(tree, f)
+            os.replace(path + '.tmp', path)
+        except OSError as oe:
+            logging.info(f'Unable to save block tree {path}: {oe}')
+            return 1
+        return 0
+
+    @classmethod
+    def load(cls, path, key, **kwargs):
+        '''Return the tree saved at path, or None if there is none for key with these settings'''
+        leaf_size = kwargs.get('leaf_size', BLOCK_TREE_LEAF_SIZE)
+        algorithm = kwargs.get('algorithm', HASH_ALGORITHM)
+        try:
+            with open(path) as f:
+                tree = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.info(f'Unable to read block tree {path}: {e}')
+            return None
+        if not isinstance(tree, dict) or (tree.get('key'), tree.get('leaf_size'), tree.get('algorithm')) != \
+                (key, leaf_size, algorithm):
+            return None
+        return cls(leaf_size=leaf_size, algorithm=algorithm, leaves=tree['leaves'], size=tree['size'])
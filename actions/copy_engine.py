@@ -0,0 +1,176 @@
+import ctypes
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import shutil
+import time
+
+from actions.mounts import get_libc
+from config.config import *
+
+DIRECT_IO_ALIGNMENT = 4096
+'''fallocate(2) mode that reserves the space without changing the file size'''
+FALLOC_FL_KEEP_SIZE = 1
+'''errnos meaning the kernel or file system can't do a zero-copy transfer between these two files'''
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+STRATEGIES = ('auto', 'copy_file_range', 'sendfile', 'buffered', 'direct')
+
+
+class CopyEngine:
+    '''Copies single files with large buffers and kernel hints, replacing shutil.copy.
+
+    strategy is one of STRATEGIES. 'auto' tries copy_file_range, then sendfile, then buffered copies,
+    and remembers what the kernel refused so it isn't tried again for every file.'''
+    def __init__(self, **kwargs):
+        self.strategy = kwargs.get('strategy', COPY_STRATEGY)
+        if self.strategy not in STRATEGIES:
+            logging.info(f'Unknown copy strategy {self.strategy}, using auto')
+            self.strategy = 'auto'
+        block_size = kwargs.get('block_size', COPY_BLOCK_SIZE)
+        '''Round the block size up to the direct I/O alignment'''
+        self.block_size = max(DIRECT_IO_ALIGNMENT, -(-block_size // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT)
+        self.preallocate = kwargs.get('preallocate', COPY_PREALLOCATE)
+        self.preserve_times = kwargs.get('preserve_times', COPY_PRESERVE_TIMES)
+        self.unsupported = set()
+        self.used = set()
+        self.bytes_copied = 0
+        self.files_copied = 0
+        self.seconds = 0.0
+
+    def copy_file(self, src, dest):
+        '''Copy the contents and permission bits of src to dest, and its modification time if
+        self.preserve_times. Raises OSError on failure'''
+        start = time.time()
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            st = os.fstat(src_fd)
+            size = st.st_size
+            self.advise(src_fd, size)
+            dest_fd = self.open_dest(dest)
+            try:
+                if self.preallocate and size:
+                    self.fallocate(dest_fd, size)
+                self.copy_data(src_fd, dest_fd, size)
+            finally:
+                os.close(dest_fd)
+        finally:
+            os.close(src_fd)
+        try:
+            shutil.copymode(src, dest)
+        except OSError:
+            '''FAT has no permission bits'''
+            pass
+        if self.preserve_times:
+            os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.bytes_copied += size
+        self.files_copied += 1
+        self.seconds += time.time() - start
+
+    def advise(self, fd, size):
+        '''Tell the kernel the source will be read sequentially, and to start reading ahead now'''
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+        except (OSError, AttributeError):
+            pass
+
+    def fallocate(self, fd, size):
+        '''Reserve the clusters of the whole file, so FAT can give it contiguous ones. The size is kept
+        (FALLOC_FL_KEEP_SIZE): posix_fallocate extends the file, which vfat does by writing zeros over it,
+        doubling the writes'''
+        libc = get_libc()
+        if not libc or 'fallocate' in self.unsupported:
+            return
+        libc.fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+        if libc.fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+            error = ctypes.get_errno()
+            if error not in UNSUPPORTED_ERRNOS:
+                raise OSError(error, os.strerror(error))
+            self.unsupported.add('fallocate')
+
+    def open_dest(self, dest):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if self.strategy == 'direct' and 'direct' not in self.unsupported:
+            try:
+                return os.open(dest, flags | os.O_DIRECT, 0o644)
+            except OSError as oe:
+                if oe.errno != errno.EINVAL:
+                    raise
+                logging.info(f'O_DIRECT is not supported for {dest}, using buffered writes')
+                self.unsupported.add('direct')
+        return os.open(dest, flags, 0o644)
+
+    def copy_data(self, src_fd, dest_fd, size):
+        if self.strategy in ('auto', 'copy_file_range') and 'copy_file_range' not in self.unsupported:
+            if self.copy_file_range(src_fd, dest_fd, size):
+                return
+        if self.strategy in ('auto', 'sendfile') and 'sendfile' not in self.unsupported:
+            if self.sendfile(src_fd, dest_fd, size):
+                return
+        self.copy_buffered(src_fd, dest_fd)
+
+    def copy_file_range(self, src_fd, dest_fd, size):
+        '''Zero-copy inside the kernel. Returns False if the kernel can't do it for these files'''
+        done = 0
+        while done < size:
+            try:
+                n = os.copy_file_range(src_fd, dest_fd, min(self.block_size, size - done))
+            except (OSError, AttributeError) as e:
+                if done == 0 and (isinstance(e, AttributeError) or e.errno in UNSUPPORTED_ERRNOS):
+                    self.unsupported.add('copy_file_range')
+                    return False
+                raise
+            if n == 0:
+                break
+            done += n
+        self.used.add('copy_file_range')
+        return True
+
+    def sendfile(self, src_fd, dest_fd, size):
+        '''Zero-copy from the source's page cache. Returns False if the kernel can't do it for these files'''
+        done = 0
+        while done < size:
+            try:
+                n = os.sendfile(dest_fd, src_fd, done, min(self.block_size, size - done))
+            except OSError as oe:
+                if done == 0 and oe.errno in UNSUPPORTED_ERRNOS:
+                    self.unsupported.add('sendfile')
+                    return False
+                raise
+            if n == 0:
+                break
+            done += n
+        self.used.add('sendfile')
+        return True
+
+    def copy_buffered(self, src_fd, dest_fd):
+        '''Copy through a page aligned buffer, which O_DIRECT writes need'''
+        direct = bool(fcntl.fcntl(dest_fd, fcntl.F_GETFL) & os.O_DIRECT)
+        buf = mmap.mmap(-1, self.block_size)
+        view = memoryview(buf)
+        try:
+            while True:
+                n = os.readv(src_fd, [buf])
+                if n == 0:
+                    break
+                if direct and n % DIRECT_IO_ALIGNMENT:
+                    '''The unaligned tail of the file can't be written with O_DIRECT'''
+                    fcntl.fcntl(dest_fd, fcntl.F_SETFL, fcntl.fcntl(dest_fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+                    direct = False
+                written = 0
+                while written < n:
+                    written += os.write(dest_fd, view[written:n])
+        finally:
+            view.release()
+            buf.close()
+        self.used.add('direct' if self.strategy == 'direct' and 'direct' not in self.unsupported else 'buffered')
+
+    def report(self):
+        '''Return a summary of the settings and throughput, for the device log'''
+        rate = self.bytes_copied / self.seconds / 1024 / 1024 if self.seconds else 0
+        used = ', '.join(sorted(self.used)) or 'none'
+        return (f'copy strategy {self.strategy} (used: {used}), block size {self.block_size}, '
+                f'preallocate {self.preallocate}: {self.files_copied} files, {self.bytes_copied} bytes '
+                f'in {self.seconds:.2f} seconds ({rate:.2f} MB/s)')
@@ -0,0 +1,221 @@
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+
+from actions.hashing import new_hash
+from actions.manifest import PackedManifest
+from actions.source_index import SourceIndex
+from config.config import *
+
+
+class FanOutWriter(threading.Thread):
+    '''Drains the shared buffers for one target device and writes them below its mount directory'''
+    def __init__(self, target, total_bytes, **kwargs):
+        super().__init__(daemon=True)
+        self.target = target
+        self.dest_dir = target.device_dir
+        self.total_bytes = total_bytes
+        self.pc = kwargs.get('pc', 100)
+        queue_depth = kwargs.get('queue_depth', FAN_OUT_QUEUE_DEPTH)
+        self.buffers = queue.Queue(maxsize=queue_depth)
+        self.status = 0
+        self.bytes_written = 0
+        self.progress = -1
+        self.dest_file = None
+
+    def put(self, item):
+        '''Queue an item for this device. Blocks while the queue is full, which throttles the reader'''
+        self.buffers.put(item)
+
+    def run(self):
+        while True:
+            item = self.buffers.get()
+            if item[0] == 'done':
+                break
+            if self.status != 0:
+                '''Keep draining after a failure so the reader is never blocked by this device'''
+                continue
+            try:
+                self.handle(item)
+            except Exception as e:
+                '''Any error, not just OSError: a writer that died would leave the reader blocked on its queue'''
+                logging.info(f'{self.target.device}: fan-out write failed: {e}')
+                self.status = 1
+                try:
+                    self.close_dest_file()
+                except OSError:
+                    pass
+        self.close_dest_file()
+
+    def handle(self, item):
+        action, value = item
+        if action == 'dir':
+            os.makedirs(os.path.join(self.dest_dir, value), exist_ok=True)
+        elif action == 'open':
+            self.dest_file = open(os.path.join(self.dest_dir, value), 'wb')
+        elif action == 'data':
+            self.dest_file.write(value)
+            self.bytes_written += len(value)
+            self.emit_progress()
+        elif action == 'close':
+            self.close_dest_file()
+            rel_path, times = value
+            if times:
+                os.utime(os.path.join(self.dest_dir, rel_path), ns=times)
+
+    def close_dest_file(self):
+        if self.dest_file:
+            dest_file, self.dest_file = self.dest_file, None
+            dest_file.close()
+
+    def emit_progress(self):
+        '''Emit through the device's progress callback, only when the percentage changes'''
+        if not self.total_bytes or not self.target.progress_callback:
+            return
+        progress = int(round((self.bytes_written / float(self.total_bytes)) * self.pc))
+        if progress != self.progress:
+            self.progress = progress
+            self.target.calculate_and_emit(self.bytes_written, self.total_bytes, pc=self.pc)
+
+
+class FanOutCopier:
+    '''Reads each source file once and fans every block out to all the target devices.
+
+    Buffers are immutable bytes objects shared by all the writers' queues, so the memory used
+    is bounded by the queue depth, not by the number of devices. A slow device fills its queue,
+    which blocks the reader until that device catches up.
+
+    If hash_source is True the source checksums are created from the same buffers, so the source
+    is not read a second time, and the targets are verified against them once the copy is done. The
+    digests of the files' blocks are then added to blocks (a SourceBlocks), if given, for sampled verification.
+    If preserve_times is True (COPY_PRESERVE_TIMES by default) the files keep the source's times.'''
+    def __init__(self, source_dir, targets, **kwargs):
+        self.source_dir = source_dir
+        self.targets = targets
+        self.chunk_size = kwargs.get('chunk_size', FAN_OUT_CHUNK_SIZE)
+        self.queue_depth = kwargs.get('queue_depth', FAN_OUT_QUEUE_DEPTH)
+        self.threads = kwargs.get('threads', DEFAULT_THREAD_NUM)
+        self.hash_source = kwargs.get('hash_source', False)
+        self.blocks = kwargs.get('blocks') if self.hash_source else None
+        self.preserve_times = kwargs.get('preserve_times', COPY_PRESERVE_TIMES)
+        self.index = kwargs.get('index')
+        self.mdsums = None
+
+    def scan_source(self):
+        '''Return the relative directories and (relative path, size) of the files in the source'''
+        index = self.index or SourceIndex(self.source_dir)
+        return list(index.dirs), [(rel_path, st.st_size) for rel_path, st in index.files.items()]
+
+    def broadcast(self, writers, item):
+        for writer in writers:
+            if writer.status == 0 or item[0] == 'done':
+                writer.put(item)
+
+    def copy(self, **kwargs):
+        '''Copy the source to all the (mounted) targets. Returns a list of statuses, in target order'''
+        pc = kwargs.get('pc', 100)
+        targets = kwargs.get('targets', self.targets)
+        start = time.time()
+        try:
+            dirs, files = self.scan_source()
+        except OSError as oe:
+            logging.info(f'Unable to read source {self.source_dir}: {oe}')
+            return [1] * len(targets)
+        total_bytes = sum(size for _, size in files)
+        writers = [FanOutWriter(target, total_bytes, pc=pc, queue_depth=self.queue_depth)
+                for target in targets]
+        for writer in writers:
+            writer.start()
+        read_status = 0
+        mdsums = {}
+        try:
+            for directory in dirs:
+                self.broadcast(writers, ('dir', directory))
+            for rel_path, size in files:
+                self.broadcast(writers, ('open', rel_path))
+                digest = new_hash() if self.hash_source else None
+                tree = self.blocks.new_tree() if self.blocks and self.blocks.wants(size) else None
+                with open(os.path.join(self.source_dir, rel_path), 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    while True:
+                        buf = f.read(self.chunk_size)
+                        if not buf:
+                            break
+                        if digest:
+                            digest.update(buf)
+                        if tree:
+                            tree.update(buf)
+                        self.broadcast(writers, ('data', buf))
+                times = (st.st_atime_ns, st.st_mtime_ns) if self.preserve_times else None
+                self.broadcast(writers, ('close', (rel_path, times)))
+                if digest:
+                    mdsums[rel_path] = digest.hexdigest()
+                if tree:
+                    self.blocks.add(rel_path, tree.finish().leaves)
+        except OSError as oe:
+            logging.info(f'Error reading from source {self.source_dir}: {oe}')
+            read_status = 1
+        finally:
+            self.broadcast(writers, ('done', None))
+            for writer in writers:
+                writer.join()
+        if self.hash_source and read_status == 0:
+            self.mdsums = PackedManifest(mdsums)
+        logging.info(f'Fan-out copy of {total_bytes} bytes to {len(writers)} devices: {time.time() - start} seconds')
+        return [read_status or writer.status for writer in writers]
+
+    def prepare(self, target):
+        '''Get a target ready to be written to'''
+        return target.prepare_device()
+
+    def finish(self, target):
+        '''Verify and release a target once it has been written. finish_device unmounts a device it
+        verified, so only one that failed is released here'''
+        status = target.finish_device()
+        if status != 0:
+            self.release(target)
+        return status
+
+    def release(self, target):
+        '''Unmount a target that was prepared but won't be finished'''
+        if target.check_mountpoint() != 0:
+            logging.info(f'Failed to unmount device {target.device}')
+
+    def replicate(self):
+        '''Prepare all the targets, fan the source out to them, then verify and unmount each.
+        Targets whose completion stamp shows they already hold the payload are left alone'''
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            stamped = list(executor.map(lambda target: target.check_stamp(), self.targets))
+        done = [target for target, is_stamped in zip(self.targets, stamped) if is_stamped]
+        for target in done:
+            logging.info(f'{target.device} already holds this payload, skipping')
+            target.emit(100)
+        targets = [target for target in self.targets if target not in done]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            prepared = list(executor.map(self.prepare, targets))
+        results = {target: status for target, status in zip(targets, prepared)}
+        results.update((target, 0) for target in done)
+        ready = [target for target, status in zip(targets, prepared) if status == 0]
+        if ready:
+            pc = 50 if ready[0].checksums else 100
+            for target, status in zip(ready, self.copy(targets=ready, pc=pc)):
+                results[target] = status
+            if self.mdsums is not None:
+                for target in ready:
+                    target.source_mdsums = self.mdsums
+                    target.source_blocks = self.blocks
+
+        def finish(target):
+            if target in done:
+                return 0
+            if results[target] == 0:
+                return self.finish(target)
+            self.release(target)
+            return results[target]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            finished = list(executor.map(finish, self.targets))
+        return [(target, status) for target, status in zip(self.targets, finished)]
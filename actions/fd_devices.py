@@ -1,23 +1,46 @@
-import hashlib
+import json
 import logging
 import os
 import parted
 import shlex
-import shutil
 import socket
 import subprocess
 import tempfile
+import threading
 import time
 
+from actions.copy_engine import CopyEngine
+from actions.golden_image import GoldenImageBuilder
+from actions.hashing import HashEngine
+from actions.image import get_device_size, get_image_extent, get_volume_id, read_fat_root_file
+from actions.inventory import Inventory
+from actions.manifest import ManifestCache, PackedManifest, compare_manifests, encode_path, get_manifest_id
+from actions.mounts import mount_manager, mount_table, umount
+from actions.sampling import SampledVerifier, SourceBlocks
+from actions.source_index import SourceIndex, iter_sorted_files
+from actions.staging import SourceStage
+from actions.topology import UsbTopology
 from config.config import *
 
 class Devices:
-    def __init__(self):
+    '''The parsed mapping file (the station's UsbTopology), the latest listing of the devices and their
+    Inventory.
+
+    One instance, from get_registry(), is shared by the whole process. The mapping file is parsed
+    again only when its modification time or size changes, and the parse is swapped in under a lock,
+    so the copy threads can share it.'''
+    def __init__(self, **kwargs):
         self.mapping_file = MAPPING_FILE 
-        self.usb_ports = USB_PORTS 
+        self.usb_ports = kwargs.get('usb_ports', USB_PORTS)
         self.usbdir = USBDIR 
         self.hub_rows = HUB_ROWS 
+        self.lock = threading.Lock()
+        self.mapping_stamp = self.get_mapping_stamp()
         self.mappings = self.get_mappings()
+        self.topology = UsbTopology(self.mappings, hub_rows=self.hub_rows)
+        self.usb_ids = {}
+        self.usb_ids_lock = threading.Lock()
+        self.inventory = kwargs.get('inventory') or Inventory()
         self.replicator = socket.gethostname() 
 
     def get_mappings(self):
@@ -27,46 +50,84 @@ class Devices:
         mappings = list(filter(None, [m.rstrip('\n') for m in mappings]))
         return mappings
 
-    def get_usb_ids(self):
-        '''Returns a dictionary of the disk-path: usb ids from /dev/disk/by-path. Removes the partition listings'''
+    def get_mapping_stamp(self):
+        try:
+            st = os.stat(self.mapping_file)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def get_topology(self):
+        '''Return the UsbTopology, parsing the mapping file again first if it has changed'''
+        stamp = self.get_mapping_stamp()
+        with self.lock:
+            if stamp is None or stamp == self.mapping_stamp:
+                return self.topology
+            try:
+                mappings = self.get_mappings()
+            except OSError as oe:
+                logging.info(f'Unable to read {self.mapping_file}: {oe}')
+                return self.topology
+            logging.info(f'{self.mapping_file} changed, reloading it')
+            self.mappings = mappings
+            self.topology = UsbTopology(mappings, hub_rows=self.hub_rows)
+            self.mapping_stamp = stamp
+            return self.topology
+
+    def list_usb_ids(self):
+        '''Returns a dictionary of the disk-path: usb ids from /dev/disk/by-path. Removes the partition listings.
+        Only lists the devices, so it can be called from any thread (see HotplugMonitor)'''
         try:
             usb_ids = {os.path.realpath(os.path.join(self.usbdir, usb)): usb.split(':')[1].split('.') \
                     for usb in os.listdir(self.usbdir) if 'usb' in usb and 'part' not in usb}
         except FileNotFoundError:
-            return {}
+            usb_ids = {}
+        return usb_ids
+
+    def get_usb_ids(self):
+        '''Returns the listing of list_usb_ids. It is also kept in usb_ids, and the sysfs information of new devices
+        is read into the inventory, under a lock so that listings from different threads don't interleave'''
+        with self.usb_ids_lock:
+            usb_ids = self.list_usb_ids()
+            self.usb_ids = usb_ids
+            self.inventory.update(usb_ids)
         return usb_ids
     
-    def get_direct_dev(self):
-        '''Direct devices must be in the USB port in the config. Generally, '01' '''
-        dir_dev =  {key: '.'.join(val) for key, val in self.get_usb_ids().items() if '.'.join(val) in self.usb_ports}
+    def get_direct_dev(self, **kwargs):
+        '''Direct devices must be in the USB port in the config. Generally, '01'. usb_ids, if given, is a
+        listing from get_usb_ids to use instead of listing the devices again'''
+        usb_ids = kwargs.get('usb_ids')
+        if usb_ids is None:
+            usb_ids = self.get_usb_ids()
+        dir_dev =  {key: '.'.join(val) for key, val in usb_ids.items() if '.'.join(val) in self.usb_ports}
         return dir_dev
     
-    def get_dev_loc_from_mapping(self, dev_addr):
-        '''given the device address, return the device location from the mappings'''
-        return self.mappings.index(dev_addr) if dev_addr in self.mappings else None
-
-    def get_dev_map_location(self, dev_addr):
-        '''Return the device location with the column number'''
-        dev_loc = self.get_dev_loc_from_mapping(dev_addr)
+    def get_dev_loc_from_mapping(self, dev_addr, **kwargs):
+        '''given the device address, return the device location from the mappings of the hub (root port)'''
+        return self.topology.get_hub(kwargs.get('hub')).index.get(dev_addr)
+
+    def get_dev_map_location(self, dev_addr, **kwargs):
+        '''Return the device location on the hub's tab as (row, column)'''
+        hub = kwargs.get('hub')
+        dev_loc = self.get_dev_loc_from_mapping(dev_addr, hub=hub)
         if dev_loc == None:
             return None
-        if dev_loc > self.hub_rows - 1:
-            return (dev_loc - self.hub_rows, 1)
-        else:
-            return (dev_loc, 0)
+        return self.topology.get_hub(hub).get_position(dev_loc)
 
     def get_hubs_with_mappings(self, usb_ids):
         '''Returns dict of hubs eg: {'1': [('1.2.3', '/dev/sdb', (0.0)), ('1.3.5', '/dev/sdc', (0.1))]}'''
         hubs = {}
+        roots = set(self.usb_ports)
+        topology = self.get_topology()
         for key, val in usb_ids.items():
             dev_name = key
-            hub = val[0]
-            if hub in self.usb_ports:
-                dev_addr = '.'.join(val[1:])
-                dev_map_location =  self.get_dev_map_location(dev_addr)
+            located = topology.locate(val, roots)
+            if located:
+                hub, dev_addr = located
+                dev_map_location = self.get_dev_map_location(dev_addr, hub=hub)
             else:
-                logging.info(f'Hub {hub} is not in usb port list. Something went wrong')
-                dev_addr = None
+                if '.'.join(val) not in roots:
+                    logging.info(f'Hub {val[0]} is not in usb port list. Something went wrong')
                 dev_map_location = None
             if dev_map_location != None:
                 if hub not in hubs.keys():
@@ -75,6 +136,44 @@ class Devices:
                     hubs[hub].append((dev_addr, dev_name, dev_map_location))
         return hubs
 
+
+registry = None
+registry_lock = threading.Lock()
+
+
+def get_registry():
+    '''Return the Devices shared by the process, created on first use'''
+    global registry
+    with registry_lock:
+        if registry is None:
+            registry = Devices()
+        return registry
+
+
+class BytesProgress:
+    '''Turns a running count of bytes into progress emitted by a device, only when the percentage changes'''
+    def __init__(self, device, total, **kwargs):
+        self.device = device
+        self.total = total
+        self.pc = kwargs.get('pc', 100)
+        self.adj = kwargs.get('adj', 0)
+        self.done = 0
+        self.progress = None
+        '''add may be called from several hashing threads'''
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.done += n
+            if not self.total:
+                return
+            progress = int(round((self.done / float(self.total)) * self.pc)) + self.adj
+            if progress == self.progress:
+                return
+            self.progress = progress
+            done = self.done
+        self.device.calculate_and_emit(done, self.total, pc=self.pc, adj=self.adj)
+
 class FdDevice:
     '''Actions pertaining to particular devices'''
     def __init__(self, **kwargs):
@@ -84,7 +183,21 @@ class FdDevice:
         self.device = kwargs.get('device', None)
         self.device_dir = kwargs.get('device_dir', None)
         self.source_mdsums = kwargs.get('source_mdsums', None)
-        self.devices = Devices()
+        self.source_blocks = kwargs.get('source_blocks', None)
+        self.manifest_id = kwargs.get('manifest_id', None)
+        self.source_index = kwargs.get('source_index', None)
+        self.bad_files = []
+        self.extra_files = []
+        self.verify_incomplete = False
+        self.readback = False
+        self.sample = 1
+        self.sync = False
+        self.golden_image = None
+        self.stage = None
+        self.copy_engine = CopyEngine()
+        self.mounts = kwargs.get('mounts', mount_manager)
+        self.hash_engine = HashEngine()
+        self.devices = kwargs.get('devices') or get_registry()
         self.ignore_files = IGNORED_FILES
         self.label = DEVICE_LABEL
 
@@ -97,32 +210,51 @@ class FdDevice:
                     self.device = key
 
     def mount_device(self, **kwargs):
-        '''Mount device on a tempdir, and return the directory name '''
+        '''Mount device through the mount manager with options (DEVICE_MOUNT_OPTIONS by default), and return
+        the directory name and status. A device that is already mounted shares that mount'''
         device = kwargs.get('device')
         if not device:
             device = self.device
-        temp_dir = tempfile.mkdtemp()
-        cmd = shlex.split(f'mount {device} {temp_dir}')
-        #print(cmd)
-        status = self.check_call(cmd, timeout=30)
-        if status != 0:
-            logging.info(f'Unable to mount device {device}.')
+        options = kwargs.get('options', DEVICE_MOUNT_OPTIONS)
+        mount_dir = self.mounts.acquire(device, self.check_call, options=options)
+        if mount_dir is None:
             return None, 1
-        return temp_dir, 0
+        return mount_dir, 0
 
     def get_file_list(self):
         '''mount and list files from (source) device, then unmount'''
+        directory, status = self.mount_device(options=SOURCE_MOUNT_OPTIONS)
+        if status != 0:
+            return None
         try:
-            directory, status = self.mount_device()
-            if status == 0:
-                files =  os.listdir(directory)    
-                mount_status = self.check_mountpoint(mount_dir=directory)
-                #TO DO: check status
-                return files
-            else:
-                return None
+            return os.listdir(directory)
         except OSError:
             return 1
+        finally:
+            self.check_mountpoint()
+
+    def get_payload_size(self, **kwargs):
+        '''Return the bytes a target needs to hold this (source) device's payload: what a raw clone needs in
+        'image' copy_mode, else the space the files take on the source file system. None if unknown'''
+        copy_mode = kwargs.get('copy_mode', COPY_MODE)
+        if copy_mode == 'image':
+            try:
+                with open(self.device, 'rb') as f:
+                    return get_image_extent(f, get_device_size(self.device))[1]
+            except OSError as oe:
+                logging.info(f'Unable to read source device {self.device}: {oe}')
+                return None
+        directory, status = self.mount_device(options=SOURCE_MOUNT_OPTIONS)
+        if status != 0:
+            return None
+        try:
+            st = os.statvfs(directory)
+        except OSError as oe:
+            logging.info(f'Unable to read the size of {directory}: {oe}')
+            return None
+        finally:
+            self.check_mountpoint()
+        return (st.f_blocks - st.f_bfree) * st.f_frsize
 
     def create_dir(self, directory):
         try:
@@ -133,8 +265,15 @@ class FdDevice:
         return 0
 
     def create_checksums_files(self, **kwargs):
-        '''Creates checksums from files in source_dir, or, if none given, to the current device'''
+        '''Creates checksums from files in source_dir, or, if none given, to the current device.
+        Returns a PackedManifest of {relative path: digest}, or 1 on error. Digests found in cache (a ManifestCache), if given, are reused instead of hashing the file again.
+        The other files are hashed by workers threads (1 by default). index, if given, is the SourceIndex of the directory.
+        blocks, if given, is a SourceBlocks that the digests of the files' blocks are added to, in the same pass'''
         source_dir = kwargs.get('source_dir')
+        cache = kwargs.get('cache')
+        blocks = kwargs.get('blocks')
+        workers = kwargs.get('workers', 1)
+        index = kwargs.get('index')
         if not source_dir:
             source_dir = self.device_dir
             pc = 100
@@ -143,49 +282,215 @@ class FdDevice:
             pc = 50
             adj = 50
         start = time.time()
-        logging.info(f'Creating checksums on {source_dir}')
-        mdsums = []
-        self.num_files = self.count_files(source_dir)
-        if self.num_files > 100:
-            chunks = self.num_files // 100
-        elif self.num_files > 2:
-            chunks = self.num_files // 2
-        else:
-            chunks = 1
-        num_copied = 0
+        logging.info(f'Creating checksums on {source_dir} ({self.hash_engine.algorithm})')
+        mdsums = {}
         try:
-            for dname in os.walk(source_dir):
-                for fname in dname[2]:
-                    mdsums.append(fname + ' ' + hashlib.md5(
-                        open(os.path.join(dname[0], fname), 'rb').read()).hexdigest())
-                    num_copied += 1
-                    if num_copied % chunks == 0:
-                        self.calculate_and_emit(num_copied, self.num_files, pc=pc, adj=adj)
+            files = (index or SourceIndex(source_dir)).files
+            self.num_files = len(files)
+            total_bytes = sum(st.st_size for st in files.values())
+            progress = BytesProgress(self, total_bytes, pc=pc, adj=adj)
+            digests = {}
+            to_hash = []
+            trees = {}
+            for rel_path, st in files.items():
+                file_path = os.path.join(source_dir, rel_path)
+                digest = cache.get(rel_path, st.st_size, st.st_mtime_ns) if cache else None
+                if digest and blocks and blocks.wants(st.st_size):
+                    '''A file whose blocks aren't cached is hashed again for them'''
+                    leaves = cache.get_blocks(rel_path, st.st_size, st.st_mtime_ns, blocks.block_size)
+                    if leaves is None:
+                        digest = None
+                    else:
+                        blocks.add(rel_path, leaves)
+                if digest:
+                    digests[file_path] = digest
+                    progress.add(st.st_size)
+                else:
+                    to_hash.append((file_path, st.st_size))
+                    if blocks and blocks.wants(st.st_size):
+                        trees[file_path] = blocks.new_tree()
+            hashed = self.hash_engine.hash_files(to_hash, progress=progress.add, workers=workers, trees=trees)
+            digests.update(hashed)
+            for rel_path, st in files.items():
+                file_path = os.path.join(source_dir, rel_path)
+                tree = trees.get(file_path)
+                if tree:
+                    blocks.add(rel_path, tree.leaves)
+                if cache and file_path in hashed:
+                    cache.set(rel_path, st.st_size, st.st_mtime_ns, digests[file_path],
+                            blocks=(blocks.block_size, tree.leaves) if tree else ())
+                mdsums[rel_path] = digests[file_path]
 
         except Exception as e:
             logging.error(f'Error creating checksums: {e}')
             return 1
+        if cache:
+            cache.save()
+
+        logging.info(f'Time creating checksums: {time.time()-start} seconds, {total_bytes} bytes')
+        return PackedManifest(mdsums)
 
-        logging.info(f'Time creating checksums: {time.time()-start} seconds')
-        return mdsums
+    def iter_checksums(self, directory, **kwargs):
+        '''Yield (encoded relative path, raw digest) of the files under directory in path order, hashing them
+        one at a time, so they can be merged with the source manifest without building one for the directory.
+        progress, if given, is called with the number of bytes hashed'''
+        progress = kwargs.get('progress')
+        for rel_path, _ in iter_sorted_files(directory):
+            digest = self.hash_engine.hash_file(os.path.join(directory, rel_path), progress=progress)
+            yield encode_path(rel_path), bytes.fromhex(digest)
 
     def compare_checksums_files(self, dest_dir):
-        '''Compare checksums for newly copied fielse with those stored in the checksums file'''
-    
-        mdsums_dest = self.create_checksums_files(source_dir=dest_dir)
-        if mdsums_dest == 1:
+        '''Compare checksums for newly copied files with the source checksums, hashing the copies as they are
+        merged with the source manifest. The files that are missing or corrupted are kept in self.bad_files,
+        those that shouldn't be there in self.extra_files'''
+        self.bad_files = []
+        self.extra_files = []
+        self.verify_incomplete = False
+        if self.sample < 1 and self.source_blocks is not None:
+            return self.verify_sampled(dest_dir)
+        if self.readback:
+            return self.verify_readback(dest_dir)
+        start = time.time()
+        logging.info(f'Comparing checksums on {dest_dir} ({self.hash_engine.algorithm})...')
+        progress = BytesProgress(self, self.source_index.total_bytes if self.source_index else 0, pc=50, adj=50)
+        try:
+            missing, extra, corrupted = compare_manifests(self.source_mdsums, 
+                    self.iter_checksums(dest_dir, progress=progress.add))
+        except OSError as oe:
+            logging.info(f'Unable to verify {dest_dir} on {self.device}: {oe}')
             return 1
-
-        logging.info('Comparing checksums...')
-        # Create sets from the two list, and compare
-        diff = set(self.source_mdsums) ^ set(mdsums_dest)
-        if diff:
-            diffs = "\n".join(diff)
-            logging.info(f'These files differ:\n {diffs}')
+        for name, files in (('Missing', missing), ('Extra', extra), ('Corrupted', corrupted)):
+            if files:
+                logging.info(f'{name} files on {self.device}:\n {chr(10).join(files)}')
+        self.bad_files = sorted(missing + corrupted)
+        self.extra_files = extra
+        if self.bad_files or self.extra_files:
             return 1
-        logging.info('Totals: {len()self.source_mdsums)}, {len(mdsums_dest)}')
+        logging.info(f'Verified {len(self.source_mdsums)} files in {time.time() - start} seconds')
         return  0
-        
+
+    def get_verify_engine(self):
+        '''Return the hash engine for verifying copies: one reading from the device itself if self.readback'''
+        if not self.readback:
+            return self.hash_engine
+        return HashEngine(algorithm=self.hash_engine.algorithm, chunk_size=self.hash_engine.chunk_size, direct=True)
+
+    def verify_readback(self, dest_dir):
+        '''Verify the copied files as read back from the device, bypassing the page cache, in large
+        sequential reads. Stops at the first mismatch, leaving the rest of the files unverified'''
+        hash_engine = self.get_verify_engine()
+        try:
+            files = self.get_tree(dest_dir)
+        except OSError as oe:
+            logging.info(f'Unable to read {dest_dir} on {self.device}: {oe}')
+            return 1
+        self.bad_files = sorted(path for path in self.source_mdsums if path not in files)
+        self.extra_files = sorted(path for path in files if path not in self.source_mdsums)
+        if self.bad_files or self.extra_files:
+            logging.info(f'Missing or extra files on {self.device}:\n {chr(10).join(self.bad_files + self.extra_files)}')
+            self.verify_incomplete = True
+            return 1
+        logging.info(f'Verifying {len(files)} files read back from {self.device}...')
+        progress = BytesProgress(self, sum(files.values()), pc=50, adj=50)
+        for rel_path in sorted(files):
+            try:
+                digest = hash_engine.hash_file(os.path.join(dest_dir, rel_path), progress=progress.add)
+            except OSError as oe:
+                logging.info(f'Unable to read back {rel_path} from {self.device}: {oe}')
+                return 1
+            if digest != self.source_mdsums[rel_path]:
+                logging.info(f'Corrupted file on {self.device}: {rel_path}')
+                self.bad_files = [rel_path]
+                self.verify_incomplete = True
+                return 1
+        return 0
+
+    def verify_sampled(self, dest_dir, **kwargs):
+        '''Check the directory tree and file sizes against the source, then compare only a sample of
+        the blocks of each file with the digests of the source blocks (see SampledVerifier), so the
+        source isn't read again. Stops at the first mismatch'''
+        verifier = kwargs.get('verifier') or SampledVerifier(fraction=self.sample, block_size=self.source_blocks.block_size,
+                algorithm=self.source_blocks.algorithm, direct=self.readback)
+        try:
+            source_files = self.get_source_index().get_sizes()
+            files = self.get_tree(dest_dir)
+        except OSError as oe:
+            logging.info(f'Unable to read the files to verify on {self.device}: {oe}')
+            return 1
+        self.bad_files = sorted(path for path, size in source_files.items() if files.get(path) != size)
+        self.extra_files = sorted(path for path in files if path not in source_files)
+        if self.bad_files or self.extra_files:
+            logging.info(f'Missing, extra or truncated files on {self.device}:\n '
+                    f'{chr(10).join(self.bad_files + self.extra_files)}')
+            self.verify_incomplete = True
+            return 1
+        progress = BytesProgress(self, sum(files.values()), pc=50, adj=50)
+        for rel_path in sorted(files):
+            try:
+                match = verifier.compare_file(os.path.join(dest_dir, rel_path), files[rel_path], 
+                        self.source_mdsums[rel_path], leaves=self.source_blocks.get(rel_path))
+            except OSError as oe:
+                logging.info(f'Unable to verify {rel_path} on {self.device}: {oe}')
+                return 1
+            if not match:
+                logging.info(f'Corrupted file on {self.device}: {rel_path}')
+                self.bad_files = [rel_path]
+                self.verify_incomplete = True
+                return 1
+            progress.add(files[rel_path])
+        logging.info(f'{self.device}: {verifier.report()}')
+        return 0
+
+    def get_tree(self, directory):
+        '''Return {relative path: size} of the files under directory'''
+        return SourceIndex(directory).get_sizes()
+
+    def get_source_index(self):
+        '''Return the index of the source shared by the workers, scanning the source only if none was given'''
+        if self.source_index is None:
+            self.source_index = SourceIndex(self.source_dir)
+        return self.source_index
+
+    def repair_files(self, dest_dir, **kwargs):
+        '''Re-copy the bad files found by compare_checksums_files from the source and remove the extra
+        ones, then verify just those files again, up to retries times. Returns 0 once they all match.
+        If the verification stopped at the first mismatch, all the files are verified again instead'''
+        retries = kwargs.get('retries', REPAIR_RETRIES)
+        hash_engine = self.get_verify_engine()
+        for attempt in range(1, retries + 1):
+            if not self.bad_files and not self.extra_files:
+                return 0
+            logging.info(f'Repairing {len(self.bad_files)} files on {self.device}, attempt {attempt} of {retries}')
+            for rel_path in self.extra_files:
+                try:
+                    os.remove(os.path.join(dest_dir, rel_path))
+                except FileNotFoundError:
+                    pass
+                except OSError as oe:
+                    logging.info(f'Unable to remove {rel_path} from {self.device}: {oe}')
+                    return 1
+            self.extra_files = []
+            bad_files = []
+            verify_incomplete = self.verify_incomplete
+            for rel_path in self.bad_files:
+                dest_file = os.path.join(dest_dir, rel_path)
+                try:
+                    self.makedirs(os.path.dirname(dest_file))
+                    self.copy_engine.copy_file(os.path.join(self.source_dir, rel_path), dest_file)
+                    if not verify_incomplete and hash_engine.hash_file(dest_file) != self.source_mdsums[rel_path]:
+                        bad_files.append(rel_path)
+                except OSError as oe:
+                    logging.info(f'On repair of {rel_path} on {self.device}: {oe}')
+                    bad_files.append(rel_path)
+            self.bad_files = bad_files
+            if verify_incomplete and not bad_files:
+                if self.compare_checksums_files(dest_dir) != 0 and not (self.bad_files or self.extra_files):
+                    return 1
+        if self.bad_files or self.extra_files:
+            logging.info(f'Unable to repair on {self.device}:\n {chr(10).join(self.bad_files + self.extra_files)}')
+            return 1
+        return 0
+
     def delete_all(self, **kwargs):
         directory = kwargs.get('directory')
         if not directory:
@@ -245,14 +550,6 @@ class FdDevice:
                     return 1
         return 0
    
-    def count_files(self, directory):
-        '''Return number of files in a directory and its subdirectories'''
-        file_count = 0
-        if os.path.isdir(directory):
-            for path, dirs, filenames in os.walk(directory):
-                file_count += len(filenames)
-        return file_count
-
     def makedirs(self, dest):
         '''Create a given directory, if it doesn't exist already'''
         if not os.path.exists(dest):
@@ -269,37 +566,82 @@ class FdDevice:
 
 
     def copy_files(self, **kwargs):
+        '''Copy the files listed in the source index from source_dir to dest_dir, emitting progress by bytes copied'''
         source_dir = kwargs.get('source_dir', None)
         if source_dir == None:
             source_dir = self.source_dir
         dest_dir = kwargs.get('dest_dir', None)
         if dest_dir == None:
             dest_dir = self.device_dir
-        self.num_files = self.count_files(source_dir)
-        chunks = self.num_files // 100
-        chunks = 1 if chunks == 0 else chunks
+        try:
+            index = self.get_source_index()
+        except OSError as oe:
+            logging.info(f'Unable to read source {source_dir}: {oe}')
+            return 1
+        self.num_files = len(index)
  
         if self.num_files > 0:
             self.makedirs(dest_dir)
-            num_copied = 0
- 
-            for path, dirs, filenames in os.walk(source_dir):
-                for directory in dirs:
-                    _dest_dir = path.replace(source_dir,dest_dir)
-                    self.makedirs(os.path.join(_dest_dir, directory))
-                
-                for sfile in filenames:
-                    src_file = os.path.join(path, sfile)
-                    dest_file = os.path.join(path.replace(source_dir, dest_dir), sfile)
-                    try:
-                        shutil.copy(src_file, dest_file)
-                    except OSError as oe:
-                        logging.info(f'On copy {source_dir} to {dest_dir}: {oe}')
-                        return 1
-                    num_copied += 1
-                    if num_copied % chunks == 0:
-                        pc = 50 if self.checksums else 100
-                        self.calculate_and_emit(num_copied, self.num_files, pc=pc)
+            for directory in index.dirs:
+                self.makedirs(os.path.join(dest_dir, directory))
+            progress = BytesProgress(self, index.total_bytes, pc=50 if self.checksums else 100)
+            for rel_path, st in index.files.items():
+                try:
+                    self.copy_engine.copy_file(os.path.join(source_dir, rel_path), os.path.join(dest_dir, rel_path))
+                except OSError as oe:
+                    logging.info(f'On copy {source_dir} to {dest_dir}: {oe}')
+                    return 1
+                progress.add(st.st_size)
+            logging.info(f'{self.device}: {self.copy_engine.report()}')
+        return 0
+
+    def is_unchanged(self, rel_path, source_st, dest_st, dest_file):
+        '''Whether the copy of a file on the device is up to date: same size and modification time,
+        or, if only the time differs, the same checksum as the source's (the time is then fixed)'''
+        if source_st.st_size != dest_st.st_size:
+            return False
+        if abs(source_st.st_mtime_ns - dest_st.st_mtime_ns) <= SYNC_MTIME_TOLERANCE * 1e9:
+            return True
+        if not self.source_mdsums or rel_path not in self.source_mdsums:
+            return False
+        if self.hash_engine.hash_file(dest_file) != self.source_mdsums[rel_path]:
+            return False
+        os.utime(dest_file, ns=(source_st.st_atime_ns, source_st.st_mtime_ns))
+        return True
+
+    def sync_files(self, **kwargs):
+        '''Bring the device up to date with the source: delete the files and directories that are not
+        in the source, and copy only the files that are new or have changed (see is_unchanged)'''
+        source_dir = kwargs.get('source_dir', self.source_dir)
+        dest_dir = kwargs.get('dest_dir', self.device_dir)
+        start = time.time()
+        try:
+            source = self.get_source_index()
+            source_dirs, source_files = source.dirs, source.files
+            dest = SourceIndex(dest_dir)
+            dest_dirs, dest_files = dest.dirs, dest.files
+            deleted = 0
+            for rel_path in dest_files:
+                if rel_path not in source_files:
+                    os.remove(os.path.join(dest_dir, rel_path))
+                    deleted += 1
+            '''Deepest first, so directories are empty when they are removed'''
+            for rel_path in sorted(set(dest_dirs) - set(source_dirs), key=lambda d: d.count(os.sep), reverse=True):
+                os.rmdir(os.path.join(dest_dir, rel_path))
+            for rel_path in source_dirs:
+                self.makedirs(os.path.join(dest_dir, rel_path))
+            to_copy = [rel_path for rel_path, st in source_files.items() if rel_path not in dest_files or not 
+                    self.is_unchanged(rel_path, st, dest_files[rel_path], os.path.join(dest_dir, rel_path))]
+            progress = BytesProgress(self, sum(source_files[rel_path].st_size for rel_path in to_copy), 
+                    pc=50 if self.checksums else 100)
+            for rel_path in to_copy:
+                self.copy_engine.copy_file(os.path.join(source_dir, rel_path), os.path.join(dest_dir, rel_path))
+                progress.add(source_files[rel_path].st_size)
+        except OSError as oe:
+            logging.info(f'On sync of {source_dir} to {dest_dir}: {oe}')
+            return 1
+        logging.info(f'{self.device}: synced in {time.time() - start:.2f} seconds: {len(to_copy)} files copied '
+                f'({progress.total} bytes), {deleted} deleted, {len(source_files) - len(to_copy)} unchanged')
         return 0
 
     def check_call(self, cmd, **kwargs): 
@@ -369,45 +711,60 @@ class FdDevice:
             return 1
 
         '''# Here it is possible to create partitions with disk using parted, but we'll just format'''
-        ''' Make a file system'''
-        cmd = shlex.split(f'mkfs.vfat -I {device}')
+        ''' Make a labelled file system, in one command rather than mkfs.vfat then fatlabel'''
+        cmd = shlex.split(f'mkfs.vfat -I -n {self.label} {device}')
         logging.info(cmd)
         status = self.check_call(cmd, timeout=30)
         if status != 0:
             return 1
-        cmd = shlex.split(f'fatlabel {device} {self.label}')
-        status = self.check_call(cmd, timeout=30)
-        return status
+        return 0
     
     def check_mountpoint(self, **kwargs):
+        '''Unmount mount_dir if it is mounted, or else release the mount of device, unmounting it if it
+        isn't mounted through the mount manager'''
         mount_dir = kwargs.get('mount_dir', None)
         device = kwargs.get('device', None)
         if device == None:
             device = self.device
-        if mount_dir == None:
-            cmd = shlex.split(f'umount {device}')
-            status = self.check_call(cmd, timeout=30)
+        if mount_dir == None and self.mounts.is_mounted(device):
+            status = self.mounts.release(device)
+        elif mount_dir == None:
+            '''Like umount with a device: its most recent mount'''
+            mount_dirs = mount_table.get_mount_dirs(device)
+            status = umount(mount_dirs[0], self.check_call) if mount_dirs else 32
         else:
             ''' Check to see if directory is mounted'''
-            cmd = shlex.split(f'mountpoint -q {mount_dir}') 
-            #logging.info(cmd)
-            status = self.check_call(cmd, timeout=30) 
+            status = 0 if mount_table.is_mountpoint(mount_dir) else 1
             if status == 0:
                 logging.info(f'Unmounting {mount_dir}')
-                cmd = shlex.split(f'umount {mount_dir}')
-                status = self.check_call(cmd, timeout=30)
+                status = umount(mount_dir, self.check_call)
         if status == 32:
             logging.info(f'Device {self.device} not mounted?')
         return status
 
-    def copy_files_to_device(self):
-        ''' First mount the device, get the mount directory and status'''
-        logging.info('Copying to device...')
+    def get_mounts(self):
+        '''Return a list of (source, mount directory) from the mount table'''
+        return [(source, mount_dir) for source, mount_dir, _ in mount_table.get_mounts()]
+
+    def unmount_partitions(self):
+        '''Unmount the device and any of its partitions, so the block device can be used directly'''
+        device = self.device
+        status = 0
+        for source, mount_dir in self.get_mounts():
+            partition = source[len(device):] if source.startswith(device) else None
+            if source == device or (partition is not None and partition.lstrip('p').isdigit()):
+                if self.check_mountpoint(mount_dir=mount_dir) != 0:
+                    logging.info(f'Unable to unmount {source} from {mount_dir}')
+                    status = 1
+        return status
+
+    def prepare_device(self, **kwargs):
+        '''Mount the device (formatting it if necessary) and remove any existing files, unless delete is False'''
+        delete = kwargs.get('delete', True)
         device = self.device
         logging.info(device)
         self.device_dir, status = self.mount_device()
         if status != 0:
-            status = self.format_device()
             '''if mounting was unsuccessful, format device and create file system'''
             status = self.format_device()
             if status != 0:
@@ -418,7 +775,8 @@ class FdDevice:
             if status != 0:
                 logging.info(f'Unable to mount device {device}')
                 return status
-        ''' Copy the files from the local file directory to the device'''
+        if not delete:
+            return 0
         status = self.delete_all()
         if status != 0:
             '''if removing files was unsuccessful, format device and create file system'''
@@ -431,50 +789,188 @@ class FdDevice:
             if status != 0:
                 logging.info(f'Unable to mount device {device}')
                 return status
-            
-        logging.info('...to {device}')
-        status = self.copy_files()
-        if status != 0:
-            self.check_mountpoint()
-            return status
-        ''' Compare checksums of the newly copied files'''
+        return 0
+
+    def finish_device(self):
+        '''Compare checksums of the newly copied files, then unmount the device'''
+        device = self.device
         if self.checksums:
             status = self.compare_checksums_files(self.device_dir)
+            if status != 0 and (self.bad_files or self.extra_files):
+                '''Only the files that don't match are copied again'''
+                status = self.repair_files(self.device_dir)
             if status != 0:
                 logging.info(f'Checksums did not match on device {device}')
                 return status
+            '''Only verified copies are stamped, so only they are skipped by later runs'''
+            self.write_stamp()
         '''Unmount the device'''
         status = self.check_mountpoint()
         if status != 0:
             logging.info(f'Failed to unmount on device {device}')
-        else:
-            status = self.remove_temp_dir()
-            if status != 0:
-                print(f'Error removing temp directory: {e}')
         return 0
-    
-    def remove_temp_dir(self):
+
+    def write_stamp(self):
+        '''Write the completion stamp: the payload's manifest ID and the device's volume ID'''
+        if not COMPLETION_STAMP or not self.manifest_id:
+            return 0
         try:
-            os.rmdir(self.device_dir)
-        except OSError as e:
-            return e
+            with open(self.device, 'rb') as f:
+                volume_id = get_volume_id(f)
+            stamp = {'manifest_id': self.manifest_id, 'volume_id': volume_id, 'time': time.time(), 
+                    'replicator': socket.gethostname()}
+            with open(os.path.join(self.device_dir, STAMP_FILE), 'w') as f:
+                json.dump(stamp, f)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as oe:
+            logging.info(f'Unable to write completion stamp on {self.device}: {oe}')
+            return 1
         return 0
 
+    def check_stamp(self):
+        '''Whether the device already holds the current payload, from its completion stamp and volume ID,
+        read straight from the device without mounting it'''
+        if not COMPLETION_STAMP or not self.manifest_id:
+            return False
+        try:
+            with open(self.device, 'rb') as f:
+                '''Drop any cached blocks, the device may have been written since'''
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                volume_id = get_volume_id(f)
+                data = read_fat_root_file(f, STAMP_FILE)
+        except OSError as oe:
+            logging.info(f'Unable to read completion stamp on {self.device}: {oe}')
+            return False
+        if not data or not volume_id:
+            return False
+        try:
+            stamp = json.loads(data)
+        except ValueError:
+            return False
+        return isinstance(stamp, dict) and stamp.get('manifest_id') == self.manifest_id and \
+                stamp.get('volume_id') == volume_id
+
+    def copy_files_to_device(self):
+        ''' First mount the device, get the mount directory and status'''
+        logging.info('Copying to device...')
+        status = self.prepare_device(delete=not self.sync)
+        if status != 0:
+            return status
+        ''' Copy the files from the local file directory to the device'''
+        logging.info(f'...to {self.device}')
+        status = self.sync_files() if self.sync else self.copy_files()
+        if status != 0:
+            self.check_mountpoint()
+            return status
+        return self.finish_device()
+    
     def prepare_to_copy(self, **kwargs):
+        '''Mount the source, index it, and stage it and create its checksums if asked. If sample (the fraction
+        verified) is below 1, the digests of the source blocks are created with the checksums'''
         self.checksums = kwargs.get('checksums')
         self.progress_callback = kwargs.get('progress_callback')
+        staging = kwargs.get('staging', STAGING)
+        sample = kwargs.get('sample', VERIFY_SAMPLE)
+        self.source_mdsums = None
+        self.source_blocks = SourceBlocks() if self.checksums and sample < 1 else None
 
-        '''device_dir Mount source device'''
-        self.device_dir, status = self.mount_device(device=self.device)
+        '''device_dir Mount source device, read only'''
+        self.device_dir, status = self.mount_device(device=self.device, options=SOURCE_MOUNT_OPTIONS)
         if status != 0:
             print('Unable to mount source directory!')
             return 1
+        try:
+            self.source_index = SourceIndex(self.device_dir)
+        except OSError as oe:
+            logging.info(f'Unable to read source directory {self.device_dir}: {oe}')
+            self.check_mountpoint()
+            return 1
+        self.manifest_id = self.get_manifest_id()
+        ''' Stage the source locally, creating the checksums on the way'''
+        if staging:
+            self.stage = SourceStage(self.device_dir, device=self, index=self.source_index)
+            if self.stage.stage(checksums=self.checksums, blocks=self.source_blocks) == 0:
+                if self.checksums:
+                    self.source_mdsums = self.map_manifest(PackedManifest(self.stage.mdsums))
+                return 0
+            self.stage = None
+            logging.info('Unable to stage the source, copying directly from the source device')
         ''' Create checksums before copying'''
         if self.checksums:
-            self.source_mdsums = self.create_checksums_files()
+            self.source_mdsums = self.create_checksums_files(cache=self.get_manifest_cache(), workers=HASH_WORKERS,
+                    index=self.source_index, blocks=self.source_blocks)
             if self.source_mdsums == 1:
+                self.source_blocks = None
+                self.check_mountpoint()
                 return 1
-            #self.save_checksums(self.mdsums)
+            self.source_mdsums = self.map_manifest(self.source_mdsums)
+        return 0
+
+    def map_manifest(self, manifest):
+        '''Return the source manifest memory mapped from an unlinked temporary file, so all the workers read
+        the same pages, which the kernel can drop under memory pressure and read again'''
+        try:
+            with tempfile.TemporaryFile() as f:
+                manifest.save(f)
+                return PackedManifest.load(f)
+        except (OSError, ValueError) as e:
+            logging.info(f'Unable to map the source manifest, keeping it in memory: {e}')
+            return manifest
+
+    def get_manifest_id(self):
+        '''Return the ID of the payload on this (source) device, or None if it can't be read'''
+        try:
+            index = self.source_index or SourceIndex(self.device_dir)
+        except OSError as oe:
+            logging.info(f'Unable to read {self.device_dir}: {oe}')
+            return None
+        return get_manifest_id((rel_path, st.st_size, st.st_mtime_ns) for rel_path, st in index.files.items())
+
+    def get_manifest_cache(self):
+        '''Return the checksums cache for this (source) device's volume, or None if it has no volume ID'''
+        if not MANIFEST_CACHE or not self.device:
+            return None
+        try:
+            with open(self.device, 'rb') as f:
+                volume_id = get_volume_id(f)
+        except OSError as e:
+            logging.info(f'Unable to read volume ID of {self.device}: {e}')
+            return None
+        if not volume_id:
+            return None
+        return ManifestCache(volume_id)
+
+    def get_copy_source_dir(self):
+        '''Return the directory the copies should read from: the stage if there is one, else the mounted source'''
+        if self.stage:
+            return self.stage.stage_dir
+        return self.device_dir
+
+    def cleanup_stage(self):
+        '''Remove the local stage of the source, if there is one'''
+        if self.stage:
+            self.stage.cleanup()
+            self.stage = None
+
+    def prepare_image(self, **kwargs):
+        '''Flush and unmount the source device, so its block device can be read consistently'''
+        self.progress_callback = kwargs.get('progress_callback')
+        os.sync()
+        return self.unmount_partitions()
+
+    def prepare_golden_image(self, **kwargs):
+        '''Mount the source device and build (or reuse) a golden FAT image of its contents'''
+        self.progress_callback = kwargs.get('progress_callback')
+        self.device_dir, status = self.mount_device(device=self.device, options=SOURCE_MOUNT_OPTIONS)
+        if status != 0:
+            logging.info('Unable to mount source directory!')
+            return 1
+        builder = GoldenImageBuilder(self, progress_callback=self.progress_callback)
+        self.golden_image = builder.get_image()
+        if not self.golden_image:
+            self.check_mountpoint()
+            return 1
         return 0
 
     def emit(self, t):
@@ -485,13 +981,25 @@ class FdDevice:
             signal = t, None, None
         self.progress_callback.emit(signal)
     
-    def copy(self, source_device, source_dir, **kwargs):
-
+    def set_copy_options(self, source_device, source_dir, **kwargs):
+        '''Store the source and copy options used by the copy, checksum and progress methods'''
         self.source_device = source_device
         self.source_dir = source_dir
         self.checksums = kwargs.get('checksums')
+        self.readback = kwargs.get('readback', READBACK_VERIFY)
+        self.sample = kwargs.get('sample', VERIFY_SAMPLE)
+        self.sync = kwargs.get('sync', False)
         self.progress_callback = kwargs.get('progress_callback')
 
+    def copy(self, source_device, source_dir, **kwargs):
+
+        self.set_copy_options(source_device, source_dir, **kwargs)
+
+        if self.check_stamp():
+            logging.info(f'{self.device} already holds this payload, skipping')
+            self.emit(100)
+            return 0
+
         logging.info(f'copy from device: {source_device}')
         ''' Removed source device from devices'''
 
@@ -511,6 +1019,3 @@ class FdDevice:
         total_time = end - copy_start
 
         return results
-    
-
-
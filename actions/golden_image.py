@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import math
+import os
+import shlex
+import shutil
+import time
+
+from config.config import *
+
+FAT32_MIN_CLUSTERS = 65525
+FAT32_RESERVED_SECTORS = 32
+FAT_DIR_ENTRY_SIZE = 32
+SECTOR_SIZE = 512
+CLUSTER_SIZES = (512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+
+class GoldenImageBuilder:
+    '''Builds a FAT32 image of the (mounted) source, just large enough for its contents.
+
+    The image is built once, with mkfs.vfat and a loop mount, and cached in GOLDEN_IMAGE_DIR under a key
+    made from the source's paths, sizes and modification times, so later batches from an unchanged
+    source reuse it. Writing it to the devices is then a sequential block copy (see ImageCopier).'''
+    def __init__(self, source_object, **kwargs):
+        self.source_object = source_object
+        self.source_dir = kwargs.get('source_dir', source_object.device_dir)
+        self.image_dir = os.path.expanduser(kwargs.get('image_dir', GOLDEN_IMAGE_DIR))
+        self.label = kwargs.get('label', DEVICE_LABEL)
+        self.ignore_files = kwargs.get('ignore_files', IGNORED_FILES)
+        self.slack = kwargs.get('slack', GOLDEN_IMAGE_SLACK)
+        self.progress_callback = kwargs.get('progress_callback')
+
+    def scan_source(self):
+        '''Return {relative directory: [names]} and [(relative path, size, mtime_ns)], without the ignored files'''
+        dirs = {}
+        files = []
+        for path, dirnames, filenames in os.walk(self.source_dir):
+            rel_path = os.path.relpath(path, self.source_dir)
+            rel_path = '' if rel_path == '.' else rel_path
+            if not rel_path:
+                dirnames[:] = [d for d in dirnames if d not in self.ignore_files]
+                filenames = [f for f in filenames if f not in self.ignore_files]
+            dirnames.sort()
+            dirs[rel_path] = dirnames + sorted(filenames)
+            for fname in sorted(filenames):
+                st = os.stat(os.path.join(path, fname))
+                files.append((os.path.join(rel_path, fname), st.st_size, st.st_mtime_ns))
+        return dirs, files
+
+    def get_key(self, files):
+        '''Return a key that changes whenever a file is added, removed, resized or modified'''
+        key = hashlib.sha1(self.label.encode())
+        for rel_path, size, mtime_ns in files:
+            key.update(f'{rel_path}\0{size}\0{mtime_ns}\n'.encode('utf-8', 'surrogateescape'))
+        return key.hexdigest()
+
+    def get_image_size(self, dirs, files):
+        '''Return (image size in bytes, cluster size) of the smallest FAT32 file system that holds the files'''
+        best = None
+        for cluster_size in CLUSTER_SIZES:
+            clusters = sum(math.ceil(size / cluster_size) for _, size, _ in files)
+            for names in dirs.values():
+                '''Each name may take a short entry plus long file name entries of 13 characters each'''
+                entries = 2 + sum(1 + math.ceil(len(name) / 13) for name in names)
+                clusters += max(1, math.ceil(entries * FAT_DIR_ENTRY_SIZE / cluster_size))
+            clusters = max(math.ceil(clusters * (1 + self.slack)), FAT32_MIN_CLUSTERS) + 64
+            fat_sectors = math.ceil((clusters + 2) * 4 / SECTOR_SIZE)
+            size = (FAT32_RESERVED_SECTORS + 2 * fat_sectors) * SECTOR_SIZE + clusters * cluster_size
+            if best is None or size < best[0]:
+                best = (size, cluster_size)
+        return best
+
+    def emit(self, t):
+        if self.progress_callback:
+            self.progress_callback.emit((t, None, None))
+
+    def get_image(self):
+        '''Return the path to an image of the source, building it if there is no cached one'''
+        try:
+            dirs, files = self.scan_source()
+        except OSError as oe:
+            logging.info(f'Unable to read source {self.source_dir}: {oe}')
+            return None
+        key = self.get_key(files)
+        image = os.path.join(self.image_dir, f'{key}.img')
+        if os.access(image, os.R_OK):
+            logging.info(f'Using cached golden image {image}')
+            return image
+        return self.build(image, dirs, files)
+
+    def build(self, image, dirs, files):
+        start = time.time()
+        try:
+            os.makedirs(self.image_dir, exist_ok=True)
+            '''Only the latest image is kept, they can be large'''
+            for old_image in os.listdir(self.image_dir):
+                if old_image.endswith(('.img', '.tmp', '.tree')):
+                    os.remove(os.path.join(self.image_dir, old_image))
+        except OSError as oe:
+            logging.info(f'Unable to prepare image directory {self.image_dir}: {oe}')
+            return None
+        size, cluster_size = self.get_image_size(dirs, files)
+        tmp_image = image + '.tmp'
+        logging.info(f'Building golden image {image}: {size} bytes, {cluster_size} byte clusters')
+        cmd = shlex.split(f'mkfs.vfat -C -F 32 -S {SECTOR_SIZE} -s {cluster_size // SECTOR_SIZE} '
+                f'-R {FAT32_RESERVED_SECTORS} -n {self.label} {tmp_image} {math.ceil(size / 1024)}')
+        status = self.source_object.check_call(cmd, timeout=120)
+        if status != 0:
+            logging.info(f'Unable to create golden image file system on {tmp_image}')
+            return None
+        mount_dir, status = self.source_object.mount_device(device=tmp_image)
+        if status != 0:
+            return None
+        status = self.copy_files(mount_dir, dirs, files)
+        if self.source_object.check_mountpoint(device=tmp_image) != 0:
+            status = 1
+        if status != 0:
+            return None
+        try:
+            os.rename(tmp_image, image)
+        except OSError as oe:
+            logging.info(f'Unable to rename golden image {tmp_image}: {oe}')
+            return None
+        logging.info(f'Time building golden image: {time.time() - start} seconds')
+        return image
+
+    def copy_files(self, mount_dir, dirs, files):
+        total = sum(size for _, size, _ in files) or 1
+        done = 0
+        try:
+            for rel_path in sorted(dirs):
+                if rel_path:
+                    os.makedirs(os.path.join(mount_dir, rel_path), exist_ok=True)
+            for rel_path, size, _ in files:
+                shutil.copy2(os.path.join(self.source_dir, rel_path), os.path.join(mount_dir, rel_path))
+                done += size
+                self.emit(int(round(done / float(total) * 100)))
+        except OSError as oe:
+            logging.info(f'Error copying to golden image: {oe}')
+            return 1
+        return 0
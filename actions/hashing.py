@@ -0,0 +1,147 @@
+import concurrent.futures
+import errno
+import hashlib
+import mmap
+import os
+import zlib
+
+from actions.copy_engine import DIRECT_IO_ALIGNMENT
+from config.config import *
+
+
+class ZlibChecksum:
+    '''hashlib style wrapper for zlib.crc32 and zlib.adler32, which are much faster than md5 but not cryptographic'''
+    def __init__(self, function, initial):
+        self.function = function
+        self.value = initial
+
+    def update(self, data):
+        self.value = self.function(data, self.value)
+
+    def hexdigest(self):
+        return f'{self.value & 0xffffffff:08x}'
+
+
+ALGORITHMS = {
+        'md5': hashlib.md5,
+        'sha1': hashlib.sha1,
+        'sha256': hashlib.sha256,
+        'blake2b': hashlib.blake2b,
+        'crc32': lambda: ZlibChecksum(zlib.crc32, 0),
+        'adler32': lambda: ZlibChecksum(zlib.adler32, 1),
+        }
+
+
+def new_hash(algorithm=None):
+    '''Return a new hash object for the algorithm (HASH_ALGORITHM by default)'''
+    algorithm = algorithm or HASH_ALGORITHM
+    try:
+        return ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError(f'Unknown hash algorithm {algorithm}. Use one of {", ".join(ALGORITHMS)}')
+
+
+class HashEngine:
+    '''Hashes files in fixed size chunks (or through mmap), so memory use doesn't depend on the file size'''
+    def __init__(self, **kwargs):
+        self.algorithm = kwargs.get('algorithm', HASH_ALGORITHM)
+        self.chunk_size = kwargs.get('chunk_size', HASH_CHUNK_SIZE)
+        self.use_mmap = kwargs.get('use_mmap', HASH_MMAP)
+        self.workers = kwargs.get('workers', HASH_WORKERS) or os.cpu_count() or 1
+        self.direct = kwargs.get('direct', False)
+        if self.direct:
+            '''O_DIRECT reads need a buffer aligned to the block size'''
+            self.chunk_size = max(DIRECT_IO_ALIGNMENT, -(-self.chunk_size // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT)
+        '''Fail early on a bad algorithm'''
+        new_hash(self.algorithm)
+
+    def open_file(self, path):
+        '''Open path for reading. If self.direct the data is read back from the device, not the page cache:
+        with O_DIRECT, or, where the file system doesn't support that, after the file's cached pages are dropped'''
+        if not self.direct:
+            return open(path, 'rb')
+        try:
+            return open(os.open(path, os.O_RDONLY | os.O_DIRECT), 'rb', buffering=0)
+        except OSError as oe:
+            if oe.errno != errno.EINVAL:
+                raise
+        f = open(path, 'rb', buffering=0)
+        try:
+            '''Dirty pages can't be dropped, so write them out first'''
+            os.fsync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            f.close()
+            raise
+        return f
+
+    def hash_file(self, path, **kwargs):
+        '''Return the hex digest of a file. progress, if given, is called with the number of bytes of each chunk.
+        tree, if given, is a BlockTree also updated with the data, so the file's blocks are hashed in the same read'''
+        progress = kwargs.get('progress')
+        tree = kwargs.get('tree')
+        digest = new_hash(self.algorithm)
+        digests = [digest, tree] if tree else [digest]
+        with self.open_file(path) as f:
+            if self.use_mmap and not self.direct:
+                self.hash_mmap(f, digests, progress)
+            else:
+                self.hash_chunks(f, digests, progress)
+        if tree:
+            tree.finish()
+        return digest.hexdigest()
+
+    def hash_files(self, files, **kwargs):
+        '''Hash [(path, size)] across a pool of self.workers threads (hashlib and zlib release the GIL
+        while hashing), largest first so one big file doesn't keep a single thread busy at the end.
+        Returns {path: digest}. progress, if given, is called with the number of bytes of each chunk
+        from all the threads, and must be thread safe. workers overrides self.workers. trees, if given, is
+        {path: BlockTree} of the files whose blocks are also hashed (see hash_file).'''
+        progress = kwargs.get('progress')
+        trees = kwargs.get('trees') or {}
+        workers = kwargs.get('workers', self.workers) or os.cpu_count() or 1
+        files = sorted(files, key=lambda item: item[1], reverse=True)
+        if workers == 1 or len(files) < 2:
+            return {path: self.hash_file(path, progress=progress, tree=trees.get(path)) for path, _ in files}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {path: pool.submit(self.hash_file, path, progress=progress, tree=trees.get(path))
+                    for path, _ in files}
+            try:
+                return {path: future.result() for path, future in futures.items()}
+            except BaseException:
+                for future in futures.values():
+                    future.cancel()
+                raise
+
+    def hash_chunks(self, f, digests, progress):
+        buf = mmap.mmap(-1, self.chunk_size) if self.direct else bytearray(self.chunk_size)
+        view = memoryview(buf)
+        try:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                for digest in digests:
+                    digest.update(view[:n])
+                if progress:
+                    progress(n)
+        finally:
+            view.release()
+
+    def hash_mmap(self, f, digests, progress):
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, self.chunk_size):
+                    chunk = view[offset:offset + self.chunk_size]
+                    for digest in digests:
+                        digest.update(chunk)
+                    chunk.release()
+                    if progress:
+                        progress(min(self.chunk_size, size - offset))
+            finally:
+                view.release()
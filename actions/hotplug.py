@@ -0,0 +1,178 @@
+import ctypes
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+from actions.mounts import get_libc
+from config.config import *
+
+NETLINK_KOBJECT_UEVENT = 15
+'''Multicast groups of uevent sockets: raw kernel events, and events re-sent by udev once it has handled them
+(created the /dev/disk/by-path links)'''
+UEVENT_KERNEL_GROUP = 1
+UEVENT_UDEV_GROUP = 2
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+
+
+class NetlinkEventSource:
+    '''Uevents for block devices, from a netlink socket. Both the kernel's and udev's are received: the
+    kernel's come even where udev isn't running, udev's once the by-path links are there'''
+    def __init__(self, **kwargs):
+        groups = kwargs.get('groups', UEVENT_KERNEL_GROUP | UEVENT_UDEV_GROUP)
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        try:
+            self.sock.bind((0, groups))
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.setblocking(False)
+
+    def wait(self, timeout):
+        '''Wait up to timeout seconds. Returns True if a block device was added, removed or changed'''
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return False
+        changed = False
+        while True:
+            try:
+                message = self.sock.recv(65536)
+            except BlockingIOError:
+                return changed
+            except OSError as oe:
+                '''ENOBUFS: events were dropped, so assume something changed'''
+                if oe.errno == errno.ENOBUFS:
+                    changed = True
+                    continue
+                raise
+            '''Kernel and udev messages both hold NUL separated KEY=value properties'''
+            if b'\0SUBSYSTEM=block\0' in message:
+                changed = True
+
+    def close(self):
+        self.sock.close()
+
+
+class InotifyEventSource:
+    '''Links appearing in or disappearing from a directory (USBDIR), through inotify'''
+    def __init__(self, **kwargs):
+        directory = kwargs.get('directory', USBDIR)
+        libc = get_libc()
+        if not libc:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error), directory)
+
+    def wait(self, timeout):
+        '''Wait up to timeout seconds. Returns True if the directory changed'''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollEventSource:
+    '''The last resort: report a possible change every interval seconds'''
+    def __init__(self, **kwargs):
+        self.interval = kwargs.get('interval', HOTPLUG_POLL_INTERVAL)
+        self.next_poll = time.monotonic() + self.interval
+        self.closed = threading.Event()
+
+    def wait(self, timeout):
+        remaining = self.next_poll - time.monotonic()
+        if remaining > timeout:
+            self.closed.wait(timeout)
+            return False
+        if self.closed.wait(max(remaining, 0)):
+            return False
+        self.next_poll = time.monotonic() + self.interval
+        return True
+
+    def close(self):
+        self.closed.set()
+
+
+def new_event_source(kind=None):
+    '''Return the event source for kind, one of 'netlink', 'inotify', 'poll' or 'auto' (HOTPLUG_SOURCE by
+    default), which uses the first of them that is available'''
+    kind = kind or HOTPLUG_SOURCE
+    kinds = ('netlink', 'inotify', 'poll') if kind == 'auto' else (kind,)
+    sources = {'netlink': NetlinkEventSource, 'inotify': InotifyEventSource, 'poll': PollEventSource}
+    for name in kinds:
+        try:
+            source = sources[name]()
+        except (OSError, AttributeError) as e:
+            logging.info(f'Unable to watch for devices with {name}: {e}')
+            continue
+        logging.info(f'Watching for devices with {name}')
+        return source
+    return PollEventSource()
+
+
+class HotplugMonitor(threading.Thread):
+    '''Watches for USB devices being plugged in or removed, in a background thread.
+
+    The event source (netlink, inotify or a fake in the tests) only says that something may have
+    changed. The monitor then waits for a burst of events to settle, lists the devices once, and
+    calls callback(added, removed) with the difference from the previous list: {device: usb ids}
+    of the devices plugged in, and [device] of those removed. The latest list is kept in usb_ids.
+    The devices are listed with list_usb_ids, which leaves the shared usb_ids and inventory of
+    devices alone: those are only updated by the threads that list them with get_usb_ids.'''
+    def __init__(self, devices, callback, **kwargs):
+        super().__init__(daemon=True)
+        self.devices = devices
+        self.callback = callback
+        self.source = kwargs.get('source') or new_event_source()
+        self.debounce = kwargs.get('debounce', HOTPLUG_DEBOUNCE)
+        self.usb_ids = devices.list_usb_ids()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if not self.source.wait(1):
+                    continue
+                '''Collect the rest of the burst, e.g. a whole hub being plugged in'''
+                while self.source.wait(self.debounce):
+                    pass
+            except OSError as oe:
+                if self.stopped.is_set():
+                    break
+                logging.info(f'Device events failed: {oe}, polling instead')
+                self.source = PollEventSource()
+                continue
+            if not self.stopped.is_set():
+                self.rescan()
+
+    def rescan(self):
+        '''List the devices, and report any difference from the previous list'''
+        usb_ids = self.devices.list_usb_ids()
+        added = {device: ids for device, ids in usb_ids.items() if self.usb_ids.get(device) != ids}
+        removed = [device for device in self.usb_ids if device not in usb_ids]
+        self.usb_ids = usb_ids
+        if added or removed:
+            logging.info(f'Devices added: {sorted(added)}, removed: {sorted(removed)}')
+            self.callback(added, removed)
+
+    def stop(self):
+        self.stopped.set()
+        self.source.close()
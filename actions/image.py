@@ -0,0 +1,483 @@
+import concurrent.futures
+import fcntl
+import logging
+import mmap
+import os
+import stat
+import threading
+import time
+
+from actions.block_tree import BlockTree
+from actions.fan_out import FanOutCopier, FanOutWriter
+from actions.hashing import HashEngine
+from actions.sampling import sample_blocks
+from config.config import *
+
+SECTOR_SIZE = 512
+BLKRRPART = 0x125f
+MBR_PARTITION_TYPE_GPT = 0xee
+FAT_ROOT_MAX_CLUSTERS = 64
+
+
+def get_device_size(device):
+    '''Return the size in bytes of a block device (or image file)'''
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+def parse_fat_boot_sector(sector):
+    '''Return the FAT geometry from a boot sector, or None if it is not a FAT boot sector'''
+    if len(sector) < SECTOR_SIZE or sector[510:512] != b'\x55\xaa' or sector[0] not in (0xeb, 0xe9):
+        return None
+    bytes_per_sector = int.from_bytes(sector[11:13], 'little')
+    sectors_per_cluster = sector[13]
+    reserved_sectors = int.from_bytes(sector[14:16], 'little')
+    num_fats = sector[16]
+    root_entries = int.from_bytes(sector[17:19], 'little')
+    total_sectors = int.from_bytes(sector[19:21], 'little') or int.from_bytes(sector[32:36], 'little')
+    fat_sectors = int.from_bytes(sector[22:24], 'little') or int.from_bytes(sector[36:40], 'little')
+    if bytes_per_sector not in (512, 1024, 2048, 4096) or sectors_per_cluster == 0 \
+            or sectors_per_cluster & (sectors_per_cluster - 1) or reserved_sectors == 0 \
+            or num_fats == 0 or total_sectors == 0 or fat_sectors == 0:
+        return None
+    root_dir_sectors = (root_entries * 32 + bytes_per_sector - 1) // bytes_per_sector
+    first_data_sector = reserved_sectors + num_fats * fat_sectors + root_dir_sectors
+    if first_data_sector >= total_sectors:
+        return None
+    clusters = (total_sectors - first_data_sector) // sectors_per_cluster
+    if clusters < 4085:
+        fat_type = 12
+    elif clusters < 65525:
+        fat_type = 16
+    else:
+        fat_type = 32
+    return {'bytes_per_sector': bytes_per_sector, 'sectors_per_cluster': sectors_per_cluster,
+            'reserved_sectors': reserved_sectors, 'fat_sectors': fat_sectors, 'total_sectors': total_sectors,
+            'first_data_sector': first_data_sector, 'clusters': clusters, 'fat_type': fat_type, 'num_fats': num_fats,
+            'root_entries': root_entries, 'root_cluster': int.from_bytes(sector[44:48], 'little')}
+
+
+def get_fat_volume_id(sector, fat):
+    '''Return the volume ID (serial number) of a FAT file system, formatted like blkid does, eg: 1A2B-3C4D'''
+    offset = 67 if fat['fat_type'] == 32 else 39
+    serial = int.from_bytes(sector[offset:offset + 4], 'little')
+    return f'{serial >> 16:04X}-{serial & 0xffff:04X}'
+
+
+def find_fat(f):
+    '''Return (offset, boot sector, geometry) of the FAT file system on a device, or of its first FAT
+    partition, or None'''
+    sector = read_at(f, 0, SECTOR_SIZE)
+    fat = parse_fat_boot_sector(sector)
+    if fat:
+        return 0, sector, fat
+    for start, _ in get_partitions(f, sector) or []:
+        if start:
+            sector = read_at(f, start, SECTOR_SIZE)
+            fat = parse_fat_boot_sector(sector)
+            if fat:
+                return start, sector, fat
+    return None
+
+
+def get_volume_id(f):
+    '''Return the volume ID of the FAT file system on a device, or of its first FAT partition, or None'''
+    found = find_fat(f)
+    if not found:
+        return None
+    _, sector, fat = found
+    return get_fat_volume_id(sector, fat)
+
+
+def get_fat_short_name(name):
+    '''Return the 11 byte directory entry name of an 8.3 file name, eg: 'README  TXT' for readme.txt'''
+    base, _, ext = name.upper().partition('.')
+    return (base.ljust(8) + ext.ljust(3)).encode('ascii')
+
+
+def read_fat_root_file(f, name):
+    '''Return the contents of a small (one cluster at most) file in the root directory of the FAT file
+    system on a device, read straight from the device without mounting it, or None if it isn't there.
+    name has to be an 8.3 name'''
+    found = find_fat(f)
+    if not found:
+        return None
+    offset, _, fat = found
+    bytes_per_sector = fat['bytes_per_sector']
+    cluster_size = bytes_per_sector * fat['sectors_per_cluster']
+
+    def get_cluster_offset(cluster):
+        return offset + (fat['first_data_sector'] + (cluster - 2) * fat['sectors_per_cluster']) * bytes_per_sector
+
+    if fat['fat_type'] == 32:
+        root = b''
+        cluster = fat['root_cluster']
+        fat_offset = offset + fat['reserved_sectors'] * bytes_per_sector
+        for _ in range(FAT_ROOT_MAX_CLUSTERS):
+            if not 2 <= cluster < 0x0ffffff8:
+                break
+            root += read_at(f, get_cluster_offset(cluster), cluster_size)
+            cluster = int.from_bytes(read_at(f, fat_offset + cluster * 4, 4), 'little') & 0x0fffffff
+    else:
+        root_offset = offset + (fat['reserved_sectors'] + fat['num_fats'] * fat['fat_sectors']) * bytes_per_sector
+        root = read_at(f, root_offset, fat['root_entries'] * 32)
+    short_name = get_fat_short_name(name)
+    for i in range(0, len(root) - 31, 32):
+        entry = root[i:i + 32]
+        if entry[0] == 0:
+            break
+        '''Skip deleted entries, long file name entries, directories and the volume label'''
+        if entry[0] == 0xe5 or entry[11] & 0x18 or entry[:11] != short_name:
+            continue
+        cluster = int.from_bytes(entry[26:28], 'little')
+        if fat['fat_type'] == 32:
+            cluster |= int.from_bytes(entry[20:22], 'little') << 16
+        size = int.from_bytes(entry[28:32], 'little')
+        if size > cluster_size or (size and cluster < 2):
+            return None
+        return read_at(f, get_cluster_offset(cluster), size) if size else b''
+    return None
+
+
+def get_fat_used_size(f, offset, fat):
+    '''Return the number of bytes from the start of a FAT file system to the end of its last used cluster'''
+    fs_size = fat['total_sectors'] * fat['bytes_per_sector']
+    if fat['fat_type'] == 12:
+        '''FAT12 file systems are tiny, not worth trimming'''
+        return fs_size
+    entry_size = fat['fat_type'] // 8
+    table = read_at(f, offset + fat['reserved_sectors'] * fat['bytes_per_sector'],
+            fat['fat_sectors'] * fat['bytes_per_sector'])
+    '''Only entries 2 .. clusters + 1 describe data clusters, the rest of the table is slack'''
+    table = table[:(fat['clusters'] + 2) * entry_size]
+    last_cluster = (len(table.rstrip(b'\x00')) - 1) // entry_size
+    if last_cluster < 2:
+        used_sectors = fat['first_data_sector']
+    else:
+        used_sectors = fat['first_data_sector'] + (last_cluster - 1) * fat['sectors_per_cluster']
+    return min(used_sectors * fat['bytes_per_sector'], fs_size)
+
+
+def get_partitions(f, sector):
+    '''Return a list of (start, size) in bytes from an MBR or GPT partition table, or None if there is none'''
+    if sector[510:512] != b'\x55\xaa':
+        return None
+    entries = [sector[446 + i * 16:446 + (i + 1) * 16] for i in range(4)]
+    if any(entry[0] not in (0x00, 0x80) for entry in entries):
+        return None
+    partitions = []
+    for entry in entries:
+        part_type = entry[4]
+        start = int.from_bytes(entry[8:12], 'little')
+        count = int.from_bytes(entry[12:16], 'little')
+        if part_type == MBR_PARTITION_TYPE_GPT:
+            return get_gpt_partitions(f)
+        if part_type and count:
+            partitions.append((start * SECTOR_SIZE, count * SECTOR_SIZE))
+    return partitions or None
+
+
+def get_gpt_partitions(f):
+    header = read_at(f, SECTOR_SIZE, SECTOR_SIZE)
+    if header[:8] != b'EFI PART':
+        return None
+    entries_lba = int.from_bytes(header[72:80], 'little')
+    num_entries = int.from_bytes(header[80:84], 'little')
+    entry_size = int.from_bytes(header[84:88], 'little')
+    table = read_at(f, entries_lba * SECTOR_SIZE, num_entries * entry_size)
+    table_end = entries_lba * SECTOR_SIZE + num_entries * entry_size
+    partitions = [(0, table_end)]
+    for i in range(num_entries):
+        entry = table[i * entry_size:(i + 1) * entry_size]
+        if len(entry) < 48 or not entry[:16].strip(b'\x00'):
+            continue
+        first_lba = int.from_bytes(entry[32:40], 'little')
+        last_lba = int.from_bytes(entry[40:48], 'little')
+        partitions.append((first_lba * SECTOR_SIZE, (last_lba - first_lba + 1) * SECTOR_SIZE))
+    return partitions
+
+
+def get_image_extent(f, device_size):
+    '''Return (used, required) bytes for a device image.
+
+    used is where the last used data ends, which is all that has to be copied. required is where the
+    last partition or file system ends, which is the smallest target that can hold the image.'''
+    sector = read_at(f, 0, SECTOR_SIZE)
+    fat = parse_fat_boot_sector(sector)
+    if fat:
+        '''Unpartitioned (superfloppy) FAT file system, as created by format_device'''
+        required = fat['total_sectors'] * fat['bytes_per_sector']
+        return get_fat_used_size(f, 0, fat), required
+    partitions = get_partitions(f, sector)
+    if not partitions:
+        logging.info('No partition table or FAT file system found, copying the whole device')
+        return device_size, device_size
+    used = SECTOR_SIZE
+    required = SECTOR_SIZE
+    for start, size in partitions:
+        required = max(required, start + size)
+        fat = parse_fat_boot_sector(read_at(f, start, SECTOR_SIZE)) if start else None
+        if fat:
+            used = max(used, start + min(get_fat_used_size(f, start, fat), size))
+        else:
+            used = max(used, start + size)
+    return min(used, device_size), required
+
+
+class ImageWriter(FanOutWriter):
+    '''Writes the shared buffers raw to the target's block device.
+
+    With dedupe each block of the target is read first, and only written if it differs from the
+    source, which is much faster for sticks that already hold (most of) the image, as flash reads are
+    faster than writes'''
+    def __init__(self, target, total_bytes, **kwargs):
+        super().__init__(target, total_bytes, **kwargs)
+        self.dedupe = kwargs.get('dedupe', False)
+        self.block_size = kwargs.get('block_size', IMAGE_DEDUPE_BLOCK_SIZE)
+        self.offset = 0
+        self.blocks_same = 0
+        self.blocks_written = 0
+
+    def handle(self, item):
+        action, value = item
+        if action == 'open':
+            self.dest_file = open(self.target.device, 'r+b')
+        elif action == 'data' and self.dedupe:
+            self.write_changed(value)
+            self.bytes_written += len(value)
+            self.emit_progress()
+        elif action == 'close':
+            '''Make sure the data is on the device, then have the kernel read the new partition table'''
+            self.dest_file.flush()
+            os.fsync(self.dest_file.fileno())
+            try:
+                fcntl.ioctl(self.dest_file.fileno(), BLKRRPART)
+            except OSError as oe:
+                logging.info(f'{self.target.device}: unable to reread partition table: {oe}')
+            self.close_dest_file()
+            if self.dedupe:
+                total = self.blocks_same + self.blocks_written
+                logging.info(f'{self.target.device}: {self.blocks_written} of {total} blocks of {self.block_size} '
+                        f'bytes written, {self.blocks_same} unchanged')
+        else:
+            super().handle(item)
+
+    def write_changed(self, data):
+        '''Write only the blocks of data that differ from what is on the device at the current offset'''
+        fd = self.dest_file.fileno()
+        view = memoryview(data)
+        for start in range(0, len(view), self.block_size):
+            block = view[start:start + self.block_size]
+            offset = self.offset + start
+            if os.pread(fd, len(block), offset) == block:
+                self.blocks_same += 1
+                continue
+            written = 0
+            while written < len(block):
+                written += os.pwrite(fd, block[written:], offset + written)
+            self.blocks_written += 1
+        self.offset += len(view)
+
+
+class ImageCopier(FanOutCopier):
+    '''Clones the source block device to all the target devices, up to the end of the source's used data'''
+    def __init__(self, source_device, targets, **kwargs):
+        kwargs.setdefault('chunk_size', IMAGE_CHUNK_SIZE)
+        super().__init__(source_device, targets, **kwargs)
+        self.source_device = source_device
+        self.image_size = None
+        self.tree = None
+        self.dedupe = kwargs.get('dedupe', IMAGE_DEDUPE)
+
+    def prepare(self, target):
+        return target.unmount_partitions()
+
+    def release(self, target):
+        '''The targets are written as block devices and never mounted, so there is nothing to release'''
+        pass
+
+    def get_tree_file(self):
+        '''Return the path and key of the block tree saved next to the source if it is an image file,
+        or (None, None) for a block device, whose tree is rebuilt on every copy'''
+        try:
+            st = os.stat(self.source_device)
+        except OSError:
+            return None, None
+        if not stat.S_ISREG(st.st_mode):
+            return None, None
+        return self.source_device + '.tree', f'{st.st_size}:{st.st_mtime_ns}'
+
+    def copy(self, **kwargs):
+        '''Copy the source image to all the targets. Returns a list of statuses, in target order'''
+        pc = kwargs.get('pc', 100)
+        targets = kwargs.get('targets', self.targets)
+        start = time.time()
+        statuses = {}
+        try:
+            source = open(self.source_device, 'rb')
+        except OSError as oe:
+            logging.info(f'Unable to open source device {self.source_device}: {oe}')
+            return [1] * len(targets)
+        with source:
+            try:
+                self.image_size, required = get_image_extent(source, get_device_size(self.source_device))
+            except OSError as oe:
+                logging.info(f'Unable to read source device {self.source_device}: {oe}')
+                return [1] * len(targets)
+            logging.info(f'Image of {self.source_device}: {self.image_size} bytes used, {required} bytes required')
+            writers = []
+            for target in targets:
+                try:
+                    target_size = get_device_size(target.device)
+                except OSError as oe:
+                    logging.info(f'Unable to open device {target.device}: {oe}')
+                    statuses[target] = 1
+                    continue
+                if target_size < required:
+                    logging.info(f'Device {target.device} is too small for the image: {target_size} < {required}')
+                    statuses[target] = 1
+                    continue
+                writers.append(ImageWriter(target, self.image_size, pc=pc, queue_depth=self.queue_depth, 
+                    dedupe=self.dedupe))
+            if not writers:
+                return [statuses[target] for target in targets]
+            for writer in writers:
+                writer.start()
+            read_status = 0
+            tree_file, key = self.get_tree_file()
+            self.tree = BlockTree.load(tree_file, key) if tree_file else None
+            if self.tree and self.tree.size != self.image_size:
+                self.tree = None
+            tree = BlockTree() if self.tree is None else None
+            try:
+                self.broadcast(writers, ('open', None))
+                source.seek(0)
+                remaining = self.image_size
+                while remaining > 0:
+                    buf = source.read(min(self.chunk_size, remaining))
+                    if not buf:
+                        raise OSError(f'Unexpected end of device at {self.image_size - remaining} bytes')
+                    if tree:
+                        tree.update(buf)
+                    self.broadcast(writers, ('data', buf))
+                    remaining -= len(buf)
+                self.broadcast(writers, ('close', None))
+            except OSError as oe:
+                logging.info(f'Error reading from source device {self.source_device}: {oe}')
+                read_status = 1
+            finally:
+                self.broadcast(writers, ('done', None))
+                for writer in writers:
+                    writer.join()
+        if tree and read_status == 0:
+            self.tree = tree.finish()
+            if tree_file:
+                self.tree.save(tree_file, key)
+        for writer in writers:
+            statuses[writer.target] = read_status or writer.status
+        logging.info(f'Image copy of {self.image_size} bytes to {len(writers)} devices: {time.time() - start} seconds')
+        return [statuses[target] for target in targets]
+
+    def finish(self, target):
+        '''Compare the block hashes of the image on the target with those of the source, rewriting and
+        verifying again only the blocks that don't match, up to REPAIR_RETRIES times. If target.readback
+        is set the image is read from the device itself, bypassing the page cache. If target.sample is below
+        1 only that fraction of the blocks (and the first and last) is compared'''
+        if not target.checksums:
+            return 0
+        leaves = sample_blocks(self.image_size, self.tree.leaf_size, target.sample)
+        bad_leaves = self.verify_leaves(target, leaves)
+        if target.sample < 1:
+            logging.info(f'{target.device}: sampled {len(leaves)} of {len(self.tree.leaves)} blocks')
+        for attempt in range(1, REPAIR_RETRIES + 1):
+            if not bad_leaves:
+                break
+            logging.info(f'{target.device}: rewriting {len(bad_leaves)} blocks of {self.tree.leaf_size} bytes, '
+                    f'attempt {attempt} of {REPAIR_RETRIES}')
+            if self.rewrite_leaves(target, bad_leaves) != 0:
+                return 1
+            bad_leaves = self.verify_leaves(target, bad_leaves, progress=False)
+        if bad_leaves is None:
+            return 1
+        if bad_leaves:
+            logging.info(f'Image on device {target.device} does not match the source at {self.tree.get_ranges(bad_leaves)}')
+            return 1
+        return 0
+
+    def verify_leaves(self, target, leaves, **kwargs):
+        '''Hash the given leaves of the image on the target, in BLOCK_TREE_VERIFY_THREADS parallel ranges.
+        Returns the leaves that don't match the source, or None if the target couldn't be read'''
+        progress = kwargs.get('progress', True)
+        leaves = list(leaves)
+        total = sum(self.tree.get_leaf_range(leaf)[1] for leaf in leaves)
+        hash_engine = HashEngine(chunk_size=self.tree.leaf_size, direct=target.readback)
+        lock = threading.Lock()
+        done = [0, None]
+
+        def verify(group):
+            bad_leaves = []
+            buf = mmap.mmap(-1, hash_engine.chunk_size)
+            view = memoryview(buf)
+            try:
+                with hash_engine.open_file(target.device) as f:
+                    for leaf in group:
+                        offset, length = self.tree.get_leaf_range(leaf)
+                        f.seek(offset)
+                        n = f.readinto(buf)
+                        if n < length or self.tree.hash_leaf(view[:length]) != self.tree.leaves[leaf]:
+                            bad_leaves.append(leaf)
+                        if progress:
+                            with lock:
+                                done[0] += length
+                                pc = int(done[0] * 100 / total)
+                                if pc == done[1]:
+                                    continue
+                                done[1] = pc
+                            target.calculate_and_emit(min(done[0], total), total, pc=50, adj=50)
+            finally:
+                view.release()
+                buf.close()
+            return bad_leaves
+
+        threads = max(1, min(BLOCK_TREE_VERIFY_THREADS, len(leaves)))
+        size = -(-len(leaves) // threads)
+        groups = [leaves[i:i + size] for i in range(0, len(leaves), size)]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                return sorted(leaf for bad_leaves in executor.map(verify, groups) for leaf in bad_leaves)
+        except OSError as oe:
+            logging.info(f'Unable to read back device {target.device}: {oe}')
+            return None
+
+    def rewrite_leaves(self, target, leaves):
+        '''Copy the byte ranges of the given leaves from the source to the target again'''
+        try:
+            with open(self.source_device, 'rb') as source:
+                fd = os.open(target.device, os.O_WRONLY)
+                try:
+                    for offset, length in self.tree.get_ranges(leaves):
+                        source.seek(offset)
+                        while length > 0:
+                            buf = source.read(min(self.chunk_size, length))
+                            if not buf:
+                                raise OSError(f'Unexpected end of source at {offset}')
+                            written = 0
+                            while written < len(buf):
+                                written += os.pwrite(fd, buf[written:], offset + written)
+                            offset += len(buf)
+                            length -= len(buf)
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        except OSError as oe:
+            logging.info(f'Unable to rewrite blocks on device {target.device}: {oe}')
+            return 1
+        return 0
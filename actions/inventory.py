@@ -0,0 +1,123 @@
+import logging
+import os
+import threading
+
+from config.config import *
+
+'''Link speeds (Mbit/s) reported by sysfs'''
+USB_SUPER_SPEED = 5000
+
+
+class DeviceInfo:
+    '''What sysfs says about a device: capacity in bytes, negotiated link speed (Mbit/s), the USB version
+    the stick supports, and its vendor, product and serial. Anything sysfs doesn't have is None'''
+    def __init__(self, device, **kwargs):
+        self.device = device
+        self.usb_id = kwargs.get('usb_id')
+        self.size = kwargs.get('size')
+        self.speed = kwargs.get('speed')
+        self.version = kwargs.get('version')
+        self.vendor_id = kwargs.get('vendor_id')
+        self.product_id = kwargs.get('product_id')
+        self.serial = kwargs.get('serial')
+
+
+class Inventory:
+    '''DeviceInfo of each device, read from sysfs (sys_dir, SYSFS_DIR by default) when the device is
+    first listed and kept until it is removed or moves to another port'''
+    def __init__(self, **kwargs):
+        self.sys_dir = kwargs.get('sys_dir', SYSFS_DIR)
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def read_attribute(self, directory, name):
+        try:
+            with open(os.path.join(directory, name)) as f:
+                return f.read().strip() or None
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    def to_number(self, value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def get_usb_dir(self, block_dir):
+        '''Return the sysfs directory of the USB device (the one with an idVendor) a disk belongs to'''
+        path = os.path.realpath(os.path.join(block_dir, 'device'))
+        sys_dir = os.path.realpath(self.sys_dir)
+        while path.startswith(sys_dir + os.sep):
+            if os.path.isfile(os.path.join(path, 'idVendor')):
+                return path
+            path = os.path.dirname(path)
+        return None
+
+    def read(self, device, **kwargs):
+        '''Read the DeviceInfo of a device (e.g. /dev/sdb) from sysfs'''
+        block_dir = os.path.join(self.sys_dir, 'block', os.path.basename(device))
+        sectors = self.to_number(self.read_attribute(block_dir, 'size'))
+        info = DeviceInfo(device, usb_id=kwargs.get('usb_id'), size=int(sectors) * 512 if sectors is not None else None)
+        usb_dir = self.get_usb_dir(block_dir)
+        if usb_dir:
+            info.speed = self.to_number(self.read_attribute(usb_dir, 'speed'))
+            info.version = self.to_number(self.read_attribute(usb_dir, 'version'))
+            info.vendor_id = self.read_attribute(usb_dir, 'idVendor')
+            info.product_id = self.read_attribute(usb_dir, 'idProduct')
+            info.serial = self.read_attribute(usb_dir, 'serial')
+        if info.size is None or usb_dir is None:
+            logging.info(f'Incomplete sysfs information for {device}')
+        return info
+
+    def update(self, usb_ids):
+        '''Read the devices of a listing ({device: usb ids}) that are new or have moved, and forget those
+        that are gone'''
+        with self.lock:
+            known = {device: info for device, info in self.devices.items() if device in usb_ids}
+        for device, usb_id in usb_ids.items():
+            if device not in known or known[device].usb_id != usb_id:
+                known[device] = self.read(device, usb_id=usb_id)
+        with self.lock:
+            self.devices = known
+
+    def get(self, device):
+        '''Return the DeviceInfo of a device, reading it if it hasn't been listed'''
+        with self.lock:
+            info = self.devices.get(device)
+        if info is None:
+            info = self.read(device)
+            with self.lock:
+                self.devices[device] = info
+        return info
+
+
+def preflight(devices, payload_size, inventory, **kwargs):
+    '''Check the targets before a batch starts. Returns ({device: reason} of the devices that can't take
+    the payload, [warnings]): sticks that are too small fail, sticks on a slow link (slower than
+    min_speed, MIN_LINK_SPEED by default, or a USB 3 stick that didn't get a USB 3 link) and sticks
+    sharing a serial number are warned about'''
+    min_speed = kwargs.get('min_speed', MIN_LINK_SPEED)
+    failures = {}
+    warnings = []
+    serials = {}
+    for device in devices:
+        info = inventory.get(device)
+        if info.size is None:
+            warnings.append(f'{device}: capacity unknown')
+        elif payload_size is not None and info.size < payload_size:
+            failures[device] = f'{info.size} bytes, payload is {payload_size} bytes'
+        if info.speed is not None:
+            if info.speed < min_speed:
+                warnings.append(f'{device}: slow USB link ({info.speed:g} Mbit/s)')
+            elif info.version is not None and info.version >= 3 and info.speed < USB_SUPER_SPEED:
+                warnings.append(f'{device}: USB {info.version:g} stick on a {info.speed:g} Mbit/s link')
+        if info.serial:
+            serials.setdefault((info.vendor_id, info.product_id, info.serial), []).append(device)
+    for (_, _, serial), same in serials.items():
+        if len(same) > 1:
+            warnings.append(f'Serial number {serial} shared by {", ".join(sorted(same))}')
+    for device, reason in failures.items():
+        logging.info(f'Preflight: {device} is too small: {reason}')
+    for warning in warnings:
+        logging.info(f'Preflight: {warning}')
+    return failures, warnings
@@ -0,0 +1,208 @@
+import collections.abc
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from config.config import *
+
+
+MANIFEST_MAGIC = b'FDM1'
+'''magic, digest size, number of files, size of the path table'''
+MANIFEST_HEADER = struct.Struct('<4sIQQ')
+MANIFEST_OFFSET = struct.Struct('<Q')
+
+
+def encode_path(rel_path):
+    return rel_path.encode('utf-8', 'surrogateescape')
+
+
+def iter_manifest(manifest):
+    '''Yield (encoded path, raw digest) of a manifest in path order. Anything that isn't a mapping is taken
+    to already be such a stream'''
+    if isinstance(manifest, PackedManifest):
+        return manifest.iter_raw()
+    if not isinstance(manifest, collections.abc.Mapping):
+        return iter(manifest)
+    return iter(sorted((encode_path(rel_path), bytes.fromhex(digest)) for rel_path, digest in manifest.items()))
+
+
+def compare_manifests(source, dest):
+    '''Compare two {relative path: digest} manifests (dicts, PackedManifests or streams, see iter_manifest)
+    in a single merge of their sorted paths. Returns sorted lists of the (missing, extra, corrupted) paths of dest'''
+    missing, extra, corrupted = [], [], []
+    source_entries, dest_entries = iter_manifest(source), iter_manifest(dest)
+    source_entry, dest_entry = next(source_entries, None), next(dest_entries, None)
+    while source_entry or dest_entry:
+        if dest_entry is None or (source_entry and source_entry[0] < dest_entry[0]):
+            missing.append(source_entry[0])
+            source_entry = next(source_entries, None)
+        elif source_entry is None or dest_entry[0] < source_entry[0]:
+            extra.append(dest_entry[0])
+            dest_entry = next(dest_entries, None)
+        else:
+            if source_entry[1] != dest_entry[1]:
+                corrupted.append(source_entry[0])
+            source_entry, dest_entry = next(source_entries, None), next(dest_entries, None)
+    return tuple(sorted(path.decode('utf-8', 'surrogateescape') for path in paths) 
+            for paths in (missing, extra, corrupted))
+
+
+class PackedManifest(collections.abc.Mapping):
+    '''A read-only {relative path: hex digest} manifest packed into one buffer: a sorted table of the
+    encoded paths and a packed array of the raw digests, found by binary search.
+
+    A million files take tens of MB instead of hundreds, and the same buffer is shared by all the
+    workers. The buffer is also the file format, so a saved manifest is memory mapped, not read.'''
+    def __init__(self, mdsums=None, **kwargs):
+        self.buffer = kwargs.get('buffer')
+        if self.buffer is None:
+            self.buffer = self.pack(mdsums or {})
+        magic, self.digest_size, self.count, paths_size = MANIFEST_HEADER.unpack_from(self.buffer)
+        if magic != MANIFEST_MAGIC:
+            raise ValueError('Not a packed manifest')
+        self.digests_start = MANIFEST_HEADER.size + (self.count + 1) * MANIFEST_OFFSET.size
+        self.paths_start = self.digests_start + self.count * self.digest_size
+
+    @staticmethod
+    def pack(mdsums):
+        entries = sorted((encode_path(rel_path), bytes.fromhex(digest)) for rel_path, digest in mdsums.items())
+        digest_size = len(entries[0][1]) if entries else 0
+        offsets = [0]
+        for path, _ in entries:
+            offsets.append(offsets[-1] + len(path))
+        return b''.join([MANIFEST_HEADER.pack(MANIFEST_MAGIC, digest_size, len(entries), offsets[-1]),
+                struct.pack(f'<{len(offsets)}Q', *offsets)] + [digest for _, digest in entries] + 
+                [path for path, _ in entries])
+
+    @classmethod
+    def load(cls, f):
+        '''Return the manifest saved in the open file f, memory mapped'''
+        return cls(buffer=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def save(self, f):
+        '''Write the manifest to the open file f'''
+        f.write(self.buffer)
+        f.flush()
+
+    def get_path(self, i):
+        start, end = struct.unpack_from('<2Q', self.buffer, MANIFEST_HEADER.size + i * MANIFEST_OFFSET.size)
+        return self.buffer[self.paths_start + start:self.paths_start + end]
+
+    def get_digest(self, i):
+        start = self.digests_start + i * self.digest_size
+        return self.buffer[start:start + self.digest_size]
+
+    def find(self, path):
+        '''Return the index of an encoded path, or None'''
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_path(middle) < path:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < self.count and self.get_path(low) == path else None
+
+    def iter_raw(self):
+        for i in range(self.count):
+            yield self.get_path(i), self.get_digest(i)
+
+    def __getitem__(self, rel_path):
+        i = self.find(encode_path(rel_path)) if isinstance(rel_path, str) else None
+        if i is None:
+            raise KeyError(rel_path)
+        return self.get_digest(i).hex()
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.get_path(i).decode('utf-8', 'surrogateescape')
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        '''Stream (relative path, hex digest) in path order'''
+        return ((path.decode('utf-8', 'surrogateescape'), digest.hex()) for path, digest in self.iter_raw())
+
+
+def get_manifest_id(files):
+    '''Return an ID for a payload, from [(relative path, size, mtime_ns)] of its files, that changes whenever
+    a file is added, removed, resized or modified'''
+    key = hashlib.sha1()
+    for rel_path, size, mtime_ns in sorted(files):
+        key.update(f'{rel_path}\0{size}\0{mtime_ns}\n'.encode('utf-8', 'surrogateescape'))
+    return key.hexdigest()
+
+
+class ManifestCache:
+    '''Source file digests saved between batches, keyed by the source's volume ID.
+
+    A file's digest is reused while its relative path, size and modification time are unchanged, so a
+    batch from the same, unchanged master stick doesn't rehash it. FAT keeps modification times to
+    2 seconds, so a file rewritten with the same size within 2 seconds would not be noticed. The digests
+    of a file's blocks, for sampled verification, are kept with its digest.'''
+    def __init__(self, volume_id, **kwargs):
+        self.volume_id = volume_id
+        self.cache_file = os.path.expanduser(kwargs.get('cache_file', CHECKSUMS_FILE))
+        self.algorithm = kwargs.get('algorithm', HASH_ALGORITHM)
+        self.max_volumes = kwargs.get('max_volumes', MANIFEST_CACHE_VOLUMES)
+        self.volumes = self.load()
+        volume = self.volumes.get(volume_id, {})
+        self.files = volume.get('files', {}) if volume.get('algorithm') == self.algorithm else {}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        try:
+            with open(self.cache_file) as f:
+                volumes = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.info(f'Unable to read checksums cache {self.cache_file}: {e}')
+            return {}
+        return volumes if isinstance(volumes, dict) else {}
+
+    def get(self, rel_path, size, mtime_ns):
+        '''Return the cached digest of a file, or None if it isn't cached or has changed'''
+        entry = self.files.get(rel_path)
+        if entry and entry[0] == size and entry[1] == mtime_ns:
+            self.hits += 1
+            self.entries[rel_path] = entry
+            return entry[2]
+        self.misses += 1
+        return None
+
+    def get_blocks(self, rel_path, size, mtime_ns, block_size):
+        '''Return the cached block digests of a file (see SourceBlocks), or None'''
+        entry = self.files.get(rel_path)
+        if entry and entry[:2] == [size, mtime_ns] and len(entry) == 5 and entry[3] == block_size:
+            return entry[4]
+        return None
+
+    def set(self, rel_path, size, mtime_ns, digest, **kwargs):
+        '''blocks, if given, is (block size, [block digests]) of the file'''
+        self.entries[rel_path] = [size, mtime_ns, digest] + list(kwargs.get('blocks', ()))
+
+    def save(self):
+        '''Save the files seen in this run, replacing the volume's previous entries'''
+        self.volumes[self.volume_id] = {'algorithm': self.algorithm, 'updated': time.time(), 'files': self.entries}
+        '''Only keep the most recently used volumes'''
+        volumes = sorted(self.volumes.items(), key=lambda item: item[1].get('updated', 0), reverse=True)
+        self.volumes = dict(volumes[:self.max_volumes])
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(tmp_file, 'w') as f:
+                json.dump(self.volumes, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            logging.info(f'Unable to save checksums cache {self.cache_file}: {e}')
+            return 1
+        logging.info(f'Checksums cache for volume {self.volume_id}: {self.hits} reused, {self.misses} hashed')
+        return 0
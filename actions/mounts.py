@@ -0,0 +1,263 @@
+import atexit
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import re
+import select
+import stat
+import threading
+
+from config.config import *
+
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_SYNCHRONOUS = 16
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+'''Mount options that are flags of mount(2). The others are passed on to the file system'''
+MOUNT_FLAGS = {'ro': MS_RDONLY, 'nosuid': MS_NOSUID, 'nodev': MS_NODEV, 'noexec': MS_NOEXEC, 'sync': MS_SYNCHRONOUS,
+        'noatime': MS_NOATIME, 'nodiratime': MS_NODIRATIME}
+'''Options that only ask for the default'''
+DEFAULT_OPTIONS = ('', 'rw', 'async', 'atime', 'diratime', 'defaults')
+
+libc = None
+
+
+def get_libc():
+    '''Return the C library, or None where it (or mount(2)) isn't available'''
+    global libc
+    if libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            libc.mount.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p)
+            libc.umount2.argtypes = (ctypes.c_char_p, ctypes.c_int)
+        except (OSError, AttributeError, TypeError):
+            libc = False
+    return libc or None
+
+
+def split_options(options):
+    '''Return the mount(2) flags and the file system data string for comma separated mount options'''
+    flags = 0
+    data = []
+    for option in (options or '').split(','):
+        if option in MOUNT_FLAGS:
+            flags |= MOUNT_FLAGS[option]
+        elif option not in DEFAULT_OPTIONS:
+            data.append(option)
+    return flags, ','.join(data)
+
+
+def sys_mount(device, mount_dir, fs_type, options):
+    '''Mount device on mount_dir with mount(2). Raises OSError'''
+    c = get_libc()
+    if not c:
+        raise OSError(errno.ENOSYS, 'mount(2) is not available')
+    flags, data = split_options(options)
+    if c.mount(os.fsencode(device), os.fsencode(mount_dir), fs_type.encode(), flags, data.encode() or None) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), device)
+
+
+def sys_umount(mount_dir, flags=0):
+    '''Unmount mount_dir with umount2(2). Raises OSError'''
+    c = get_libc()
+    if not c:
+        raise OSError(errno.ENOSYS, 'umount2(2) is not available')
+    if c.umount2(os.fsencode(mount_dir), flags) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), mount_dir)
+
+
+def mount(device, mount_dir, check_call, **kwargs):
+    '''Mount a block device with mount(2), falling back to the mount command (run by check_call) if that
+    fails or device is an image file. Returns 0, or the status of the mount command'''
+    options = kwargs.get('options', DEVICE_MOUNT_OPTIONS)
+    fs_type = kwargs.get('fs_type', MOUNT_FS_TYPE)
+    native = kwargs.get('native', NATIVE_MOUNT)
+    try:
+        if native and stat.S_ISBLK(os.stat(device).st_mode):
+            sys_mount(device, mount_dir, fs_type, options)
+            mount_table.invalidate()
+            return 0
+    except OSError as oe:
+        logging.info(f'mount(2) of {device} failed: {oe}, running mount')
+    cmd = ['mount'] + (['-o', options] if options else []) + [device, mount_dir]
+    status = check_call(cmd, timeout=30)
+    mount_table.invalidate()
+    return status
+
+
+def umount(mount_dir, check_call, **kwargs):
+    '''Unmount mount_dir with umount2(2), falling back to the umount command (run by check_call).
+    Returns 0, or the status of the umount command'''
+    native = kwargs.get('native', NATIVE_MOUNT)
+    try:
+        if native:
+            sys_umount(mount_dir)
+            mount_table.invalidate()
+            return 0
+    except OSError as oe:
+        logging.info(f'umount2(2) of {mount_dir} failed: {oe}, running umount')
+    status = check_call(['umount', mount_dir], timeout=30)
+    mount_table.invalidate()
+    return status
+
+
+def unescape(field):
+    '''Undo the octal escapes (\\040 for a space...) of a mountinfo field'''
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+class MountTable:
+    '''The mounts of this process, parsed from /proc/self/mountinfo.
+
+    The parse is cached until the kernel reports that the mount table changed (polling mountinfo
+    returns POLLPRI), or until the mounts are changed through this module, so asking whether
+    something is mounted costs no process and, most of the time, no read.'''
+    def __init__(self, **kwargs):
+        self.path = kwargs.get('path', '/proc/self/mountinfo')
+        self.mounts = None
+        self.f = None
+        self.poller = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.mounts = None
+
+    def changed(self):
+        if self.mounts is None or self.poller is None:
+            return True
+        return bool(self.poller.poll(0))
+
+    def read(self):
+        if self.f is None:
+            self.f = open(self.path, 'rb')
+            self.poller = select.poll()
+            self.poller.register(self.f, select.POLLPRI | select.POLLERR)
+        self.f.seek(0)
+        mounts = []
+        for line in self.f.read().decode('utf-8', 'surrogateescape').splitlines():
+            fields = line.split(' ')
+            try:
+                separator = fields.index('-', 6)
+                mounts.append((unescape(fields[separator + 2]), unescape(fields[4]), fields[separator + 1]))
+            except (ValueError, IndexError):
+                continue
+        return mounts
+
+    def get_mounts(self):
+        '''Return a list of (source, mount directory, file system type)'''
+        with self.lock:
+            if self.changed():
+                try:
+                    self.mounts = self.read()
+                except OSError as oe:
+                    logging.info(f'Unable to read mounts: {oe}')
+                    return []
+            return self.mounts
+
+    def is_mountpoint(self, path):
+        path = os.path.abspath(path)
+        return any(mount_dir == path for _, mount_dir, _ in self.get_mounts())
+
+    def get_mount_dirs(self, source):
+        '''Return the directories source is mounted on, most recent first'''
+        return [mount_dir for mount_source, mount_dir, _ in reversed(self.get_mounts()) if mount_source == source]
+
+
+class Mount:
+    def __init__(self, mount_dir):
+        self.mount_dir = mount_dir
+        self.refs = 0
+        self.check_call = None
+        '''Held while the device is being mounted or unmounted'''
+        self.lock = threading.Lock()
+
+
+class MountManager:
+    '''Mounts devices for the workers, sharing each mount by reference count.
+
+    Each device gets one mount point below mount_dir, named after it and reused from one mount to
+    the next, instead of a new temporary directory every time. The first acquire of a device
+    mounts it, and the last release unmounts it. Whatever is still mounted at exit is unmounted
+    and the mount points are removed.'''
+    def __init__(self, **kwargs):
+        self.mount_dir = os.path.expanduser(kwargs.get('mount_dir', MOUNT_DIR))
+        self.mounts = {}
+        self.lock = threading.Lock()
+
+    def get_mount(self, device):
+        with self.lock:
+            if device not in self.mounts:
+                name = device.strip('/').replace('/', '_')
+                self.mounts[device] = Mount(os.path.join(self.mount_dir, name))
+            return self.mounts[device]
+
+    def acquire(self, device, check_call, **kwargs):
+        '''Mount device, or share its existing mount. check_call runs the mount command and returns its status.
+        Returns the mount directory, or None if the device could not be mounted'''
+        options = kwargs.get('options', DEVICE_MOUNT_OPTIONS)
+        entry = self.get_mount(device)
+        with entry.lock:
+            if entry.refs == 0:
+                try:
+                    os.makedirs(entry.mount_dir, exist_ok=True)
+                except OSError as oe:
+                    logging.info(f'Unable to create mount point {entry.mount_dir}: {oe}')
+                    return None
+                if mount_table.is_mountpoint(entry.mount_dir):
+                    '''Left mounted by a run that didn't exit cleanly'''
+                    logging.info(f'Unmounting stale mount {entry.mount_dir}')
+                    umount(entry.mount_dir, check_call)
+                if mount(device, entry.mount_dir, check_call, options=options) != 0:
+                    logging.info(f'Unable to mount device {device}.')
+                    return None
+                entry.check_call = check_call
+            entry.refs += 1
+            return entry.mount_dir
+
+    def release(self, device):
+        '''Drop a reference to the mount of device, unmounting it when it was the last one. Returns the
+        umount status, 0 while the mount is still in use, or None if the device isn't mounted here'''
+        with self.lock:
+            entry = self.mounts.get(device)
+        if not entry:
+            return None
+        with entry.lock:
+            if entry.refs == 0:
+                return None
+            entry.refs -= 1
+            if entry.refs:
+                return 0
+            return umount(entry.mount_dir, entry.check_call)
+
+    def is_mounted(self, device):
+        with self.lock:
+            entry = self.mounts.get(device)
+        return bool(entry and entry.refs)
+
+    def release_all(self):
+        '''Unmount everything still mounted and remove the mount points'''
+        with self.lock:
+            mounts = list(self.mounts.values())
+        for entry in mounts:
+            with entry.lock:
+                if entry.refs:
+                    entry.refs = 0
+                    umount(entry.mount_dir, entry.check_call)
+                try:
+                    os.rmdir(entry.mount_dir)
+                except OSError:
+                    pass
+
+
+'''Shared by all the devices of the process'''
+mount_table = MountTable()
+mount_manager = MountManager()
+atexit.register(mount_manager.release_all)
@@ -0,0 +1,160 @@
+import concurrent.futures
+import logging
+import os
+import time
+
+from actions.image import get_device_size
+from config.config import *
+
+
+class ProbeResult:
+    '''What probing a device found: write and read speeds in MB/s, the offsets that didn't read back what was
+    written there, and the error that stopped the probe, if any'''
+    def __init__(self, device, **kwargs):
+        self.device = device
+        self.size = kwargs.get('size')
+        self.write_speed = kwargs.get('write_speed')
+        self.read_speed = kwargs.get('read_speed')
+        self.bad_offsets = kwargs.get('bad_offsets', [])
+        self.error = kwargs.get('error')
+        self.min_speed = kwargs.get('min_speed', PROBE_MIN_WRITE_SPEED)
+
+    @property
+    def fake(self):
+        '''Blocks that don't read back mean the stick is smaller than it says (or broken)'''
+        return bool(self.bad_offsets)
+
+    @property
+    def slow(self):
+        return self.write_speed is not None and self.write_speed < self.min_speed
+
+    @property
+    def flagged(self):
+        '''Whether the device should be left out of the batch'''
+        return bool(self.error) or self.fake or self.slow
+
+    def describe(self):
+        if self.error:
+            return f'probe failed: {self.error}'
+        text = f'write {self.write_speed:.1f} MB/s, read {self.read_speed:.1f} MB/s'
+        if self.fake:
+            text += f', {len(self.bad_offsets)} blocks did not read back (fake capacity?)'
+        elif self.slow:
+            text += f', slower than {self.min_speed:g} MB/s'
+        return text
+
+
+class DeviceProber:
+    '''Writes blocks of random data at offsets spread over a device, up to its advertised end, and reads them
+    back.
+
+    A counterfeit stick that reports more than it holds wraps or drops the writes beyond its real capacity,
+    so those blocks (or the ones they wrap onto) don't read back. As evenly spaced blocks rarely wrap onto
+    each other, there is also a block at every power of two: the real capacity of a fake is a power of two
+    or a sum of a few, so a block written at a power of two beyond it wraps onto a lower one.
+
+    The write and read speeds are timed separately, over one sequential run of speed_blocks blocks at
+    the start of the device, as the copies write sequentially. What was on the device at each offset is
+    read first and written back afterwards, so the probe leaves the device as it found it.'''
+    def __init__(self, **kwargs):
+        self.blocks = max(2, kwargs.get('blocks', PROBE_BLOCKS))
+        self.block_size = kwargs.get('block_size', PROBE_BLOCK_SIZE)
+        self.speed_blocks = max(1, kwargs.get('speed_blocks', PROBE_SPEED_BLOCKS))
+        self.min_speed = kwargs.get('min_speed', PROBE_MIN_WRITE_SPEED)
+        self.threads = kwargs.get('threads', DEFAULT_THREAD_NUM)
+
+    def get_offsets(self, size):
+        '''Return the offsets of the blocks of a device of size bytes: blocks evenly spaced from the start to
+        the end, and a block at each power of two (of block_size, itself a power of two)'''
+        last = (size - self.block_size) // self.block_size * self.block_size
+        if last < 0:
+            return []
+        offsets = {last // self.block_size * i // (self.blocks - 1) * self.block_size for i in range(self.blocks)}
+        power = self.block_size
+        while power <= last:
+            offsets.add(power)
+            power *= 2
+        return sorted(offsets)
+
+    def read_block(self, fd, offset, **kwargs):
+        length = kwargs.get('length', self.block_size)
+        data = b''
+        while len(data) < length:
+            buf = os.pread(fd, length - len(data), offset + len(data))
+            if not buf:
+                raise OSError(f'Short read at {offset + len(data)}')
+            data += buf
+        return data
+
+    def time_run(self, fd, result, length):
+        '''Write a sequential run of length bytes at the start of the device and read it back, timing both.
+        Sets the speeds of result, and adds the offsets of the blocks of the run that didn't read back'''
+        pattern = os.urandom(length)
+        start = time.monotonic()
+        self.write_block(fd, pattern, 0)
+        os.fdatasync(fd)
+        result.write_speed = length / max(time.monotonic() - start, 1e-6) / 1e6
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        start = time.monotonic()
+        data = self.read_block(fd, 0, length=length)
+        result.read_speed = length / max(time.monotonic() - start, 1e-6) / 1e6
+        result.bad_offsets.extend(offset for offset in range(0, length, self.block_size)
+                if data[offset:offset + self.block_size] != pattern[offset:offset + self.block_size])
+
+    def write_block(self, fd, data, offset):
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd, data[written:], offset + written)
+
+    def probe(self, device):
+        '''Probe a device (block device or image file). Returns a ProbeResult'''
+        result = ProbeResult(device, min_speed=self.min_speed)
+        try:
+            result.size = get_device_size(device)
+            fd = os.open(device, os.O_RDWR)
+        except OSError as oe:
+            result.error = str(oe)
+            logging.info(f'Unable to probe {device}: {oe}')
+            return result
+        saved = []
+        try:
+            offsets = self.get_offsets(result.size)
+            if not offsets:
+                raise OSError(f'Too small to probe: {result.size} bytes')
+            run = min(self.speed_blocks, result.size // self.block_size) * self.block_size
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            '''Everything is read before anything is written, so blocks that alias each other all save
+            what was really there'''
+            saved.append((0, self.read_block(fd, 0, length=run)))
+            for offset in offsets:
+                saved.append((offset, self.read_block(fd, offset)))
+            self.time_run(fd, result, run)
+            patterns = [os.urandom(self.block_size) for _ in offsets]
+            for offset, pattern in zip(offsets, patterns):
+                self.write_block(fd, pattern, offset)
+            os.fdatasync(fd)
+            '''Read back from the device, not from the page cache'''
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            result.bad_offsets.extend(offset for offset, pattern in zip(offsets, patterns)
+                    if self.read_block(fd, offset) != pattern)
+            result.bad_offsets = sorted(set(result.bad_offsets))
+        except OSError as oe:
+            result.error = str(oe)
+        finally:
+            try:
+                '''In reverse, so blocks that alias each other end up with the data of the first'''
+                for offset, data in reversed(saved):
+                    self.write_block(fd, data, offset)
+                os.fdatasync(fd)
+            except OSError as oe:
+                logging.info(f'Unable to restore the probed blocks of {device}: {oe}')
+            os.close(fd)
+        logging.info(f'Probe of {device}: {result.describe()}')
+        return result
+
+    def probe_all(self, devices):
+        '''Probe the devices in parallel. Returns {device: ProbeResult}'''
+        if not devices:
+            return {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.threads, len(devices)))) as executor:
+            return dict(zip(devices, executor.map(self.probe, devices)))
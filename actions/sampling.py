@@ -0,0 +1,107 @@
+import math
+import mmap
+import random
+
+from actions.block_tree import BlockTree
+from actions.copy_engine import DIRECT_IO_ALIGNMENT
+from actions.hashing import HashEngine
+from config.config import *
+
+
+def sample_blocks(size, block_size, fraction, rng=random):
+    '''Return the sorted indices of the blocks of a size byte file to check: the first and last blocks
+    always, and fraction of the others chosen at random'''
+    blocks = math.ceil(size / block_size)
+    if blocks <= 2 or fraction >= 1:
+        return list(range(blocks))
+    middle = rng.sample(range(1, blocks - 1), math.ceil((blocks - 2) * fraction))
+    return [0] + sorted(middle) + [blocks - 1]
+
+
+def get_block_size(block_size):
+    '''Round block_size up to the O_DIRECT alignment, so sampled blocks can be read back from the device'''
+    return max(DIRECT_IO_ALIGNMENT, -(-block_size // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT)
+
+
+class SourceBlocks:
+    '''Digests of each block_size block of the source files, {relative path: [hex digest]}.
+
+    Built in the same pass that creates the source checksums (see new_tree and add), so sampled
+    verification compares the blocks read from each device with these instead of reading the source
+    again. Only files of more than two blocks are kept: all the blocks of the others are checked
+    anyway, against the file's digest in the manifest.'''
+    def __init__(self, **kwargs):
+        self.block_size = get_block_size(kwargs.get('block_size', VERIFY_SAMPLE_BLOCK_SIZE))
+        self.algorithm = kwargs.get('algorithm', HASH_ALGORITHM)
+        self.files = {}
+
+    def wants(self, size):
+        '''Whether the blocks of a file of size bytes are kept'''
+        return math.ceil(size / self.block_size) > 2
+
+    def new_tree(self):
+        '''Return a BlockTree to update with the data of a file as it is hashed'''
+        return BlockTree(leaf_size=self.block_size, algorithm=self.algorithm)
+
+    def add(self, rel_path, leaves):
+        self.files[rel_path] = leaves
+
+    def get(self, rel_path):
+        '''Return the block digests of a file, or None if they weren't kept'''
+        return self.files.get(rel_path)
+
+
+class SampledVerifier:
+    '''Compares a random sample of the blocks of copied files with the digests of the source blocks.
+
+    The destination is read through HashEngine.open_file, so with direct=True the blocks come back
+    from the device rather than the page cache. The bytes and blocks checked are counted, so the
+    coverage of each device can be reported.'''
+    def __init__(self, **kwargs):
+        self.fraction = kwargs.get('fraction', VERIFY_SAMPLE)
+        self.block_size = get_block_size(kwargs.get('block_size', VERIFY_SAMPLE_BLOCK_SIZE))
+        self.algorithm = kwargs.get('algorithm', HASH_ALGORITHM)
+        self.rng = kwargs.get('rng', random.Random())
+        self.hash_engine = HashEngine(algorithm=self.algorithm, chunk_size=self.block_size,
+                direct=kwargs.get('direct', False))
+        self.bytes_checked = 0
+        self.bytes_total = 0
+        self.blocks_checked = 0
+        self.files_checked = 0
+
+    def compare_file(self, dest_path, size, digest, **kwargs):
+        '''Check the first size bytes of dest_path against the source. leaves, if given, are the digests
+        of the source file's blocks, and only the sampled blocks are hashed, otherwise the whole file is
+        hashed and compared with digest. Returns True if they all match'''
+        leaves = kwargs.get('leaves')
+        self.bytes_total += size
+        self.files_checked += 1
+        if leaves is None:
+            if self.hash_engine.hash_file(dest_path) != digest:
+                return False
+            self.bytes_checked += size
+            self.blocks_checked += math.ceil(size / self.block_size)
+            return True
+        tree = BlockTree(leaf_size=self.block_size, algorithm=self.algorithm, leaves=leaves, size=size)
+        buf = mmap.mmap(-1, self.block_size)
+        view = memoryview(buf)
+        try:
+            with self.hash_engine.open_file(dest_path) as dest:
+                for block in sample_blocks(size, self.block_size, self.fraction, self.rng):
+                    offset, length = tree.get_leaf_range(block)
+                    dest.seek(offset)
+                    n = dest.readinto(buf)
+                    if n < length or tree.hash_leaf(view[:length]) != leaves[block]:
+                        return False
+                    self.bytes_checked += length
+                    self.blocks_checked += 1
+        finally:
+            view.release()
+            buf.close()
+        return True
+
+    def report(self):
+        '''Return a summary of what was covered, for the device log'''
+        pc = self.bytes_checked / self.bytes_total * 100 if self.bytes_total else 100
+        return (f'sampled {self.fraction:.0%} of the blocks: {self.blocks_checked} blocks, {self.bytes_checked} of '
+                f'{self.bytes_total} bytes ({pc:.1f}%) in {self.files_checked} files')
@@ -0,0 +1,60 @@
+import collections
+import os
+import types
+
+
+def iter_sorted_files(directory, rel_dir=''):
+    '''Yield (relative path, stat) of the files under directory in the order of their encoded paths, the
+    order of a PackedManifest, holding only the listings of the directories on the way down. A directory
+    sorts as its name followed by a separator, as all the paths below it do'''
+    with os.scandir(os.path.join(directory, rel_dir)) as it:
+        entries = []
+        for entry in it:
+            descend = entry.is_dir() and not entry.is_symlink()
+            key = entry.name.encode('utf-8', 'surrogateescape') + (os.sep.encode() if descend else b'')
+            entries.append((key, descend, entry))
+    entries.sort(key=lambda item: item[0])
+    for _, descend, entry in entries:
+        rel_path = os.path.join(rel_dir, entry.name)
+        if descend:
+            yield from iter_sorted_files(directory, rel_path)
+        elif not entry.is_dir():
+            '''Like os.walk, list symlinked directories but don't descend into them'''
+            yield rel_path, entry.stat()
+
+
+class SourceIndex:
+    '''An immutable index of a directory tree: its relative directories, parents first, and
+    {relative path: stat} of its files, both in sorted order.
+
+    Built once per batch with os.scandir and shared by all the copy workers, so the source stick is
+    scanned once rather than once or twice for every device. The paths are relative, so the same
+    index serves a local stage of the source.'''
+    def __init__(self, directory):
+        dirs = []
+        files = {}
+        pending = collections.deque([''])
+        while pending:
+            rel_dir = pending.popleft()
+            with os.scandir(os.path.join(directory, rel_dir)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                if entry.is_dir():
+                    dirs.append(rel_path)
+                    '''Like os.walk, list symlinked directories but don't descend into them'''
+                    if not entry.is_symlink():
+                        pending.append(rel_path)
+                else:
+                    files[rel_path] = entry.stat()
+        self.directory = directory
+        self.dirs = tuple(dirs)
+        self.files = types.MappingProxyType(files)
+        self.total_bytes = sum(st.st_size for st in files.values())
+
+    def __len__(self):
+        return len(self.files)
+
+    def get_sizes(self):
+        '''Return {relative path: size} of the files'''
+        return {rel_path: st.st_size for rel_path, st in self.files.items()}
@@ -0,0 +1,134 @@
+import logging
+import os
+import shutil
+import time
+
+from actions.hashing import new_hash
+from actions.source_index import SourceIndex
+from config.config import *
+
+
+def get_mount_fs_type(path):
+    '''Return the file system type of the mount that holds path, from /proc/mounts'''
+    path = os.path.abspath(path)
+    fs_type = None
+    best = ''
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_dir = fields[1].replace('\\040', ' ')
+                if (path == mount_dir or path.startswith(mount_dir.rstrip('/') + '/')) and len(mount_dir) > len(best):
+                    best, fs_type = mount_dir, fields[2]
+    except OSError as e:
+        logging.info(f'Unable to read mounts: {e}')
+    return fs_type
+
+
+def get_available_memory():
+    '''Return MemAvailable from /proc/meminfo in bytes, or None if unknown'''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError) as e:
+        logging.info(f'Unable to read memory info: {e}')
+    return None
+
+
+class SourceStage:
+    '''A snapshot of the source files in a fast local directory (tmpfs by default).
+
+    The source is read from the flash drive once, hashed on the way, and all the copies then read
+    from the stage, where the files are in the page cache shared by all the worker threads.'''
+    def __init__(self, source_dir, **kwargs):
+        self.source_dir = source_dir
+        self.stage_dir = kwargs.get('stage_dir', STAGING_DIR)
+        self.reserve = kwargs.get('reserve', STAGING_RESERVE)
+        self.chunk_size = kwargs.get('chunk_size', FAN_OUT_CHUNK_SIZE)
+        self.device = kwargs.get('device')
+        self.index = kwargs.get('index')
+        self.mdsums = {}
+
+    def scan_source(self):
+        '''Return the relative directories and (relative path, size) of the files in the source'''
+        index = self.index or SourceIndex(self.source_dir)
+        return list(index.dirs), [(rel_path, st.st_size) for rel_path, st in index.files.items()]
+
+    def get_free_space(self):
+        '''Return the space available for staging. On tmpfs that is also limited by the available memory'''
+        parent = self.stage_dir
+        while not os.access(parent, os.W_OK) and os.path.dirname(parent) != parent:
+            parent = os.path.dirname(parent)
+        free = shutil.disk_usage(parent).free
+        if get_mount_fs_type(parent) in ('tmpfs', 'ramfs'):
+            memory = get_available_memory()
+            if memory is not None:
+                free = min(free, memory)
+        return free - self.reserve
+
+    def stage(self, **kwargs):
+        '''Copy the source to the stage, creating checksums on the way if checksums is True. blocks, if given,
+        is a SourceBlocks that the digests of the files' blocks are added to as well.
+
+        Returns 0 on success, or 1 if the source does not fit or could not be staged, in which case
+        the copies should read directly from the source.'''
+        checksums = kwargs.get('checksums')
+        blocks = kwargs.get('blocks') if checksums else None
+        start = time.time()
+        try:
+            dirs, files = self.scan_source()
+            total = sum(size for _, size in files)
+            free = self.get_free_space()
+        except OSError as oe:
+            logging.info(f'Unable to prepare staging of {self.source_dir}: {oe}')
+            return 1
+        if total > free:
+            logging.info(f'Source ({total} bytes) does not fit in {self.stage_dir} ({free} bytes free), not staging')
+            return 1
+        self.cleanup()
+        self.mdsums = {}
+        done = 0
+        try:
+            os.makedirs(self.stage_dir)
+            for directory in dirs:
+                os.makedirs(os.path.join(self.stage_dir, directory), exist_ok=True)
+            for rel_path, size in files:
+                digest = new_hash()
+                tree = blocks.new_tree() if blocks and blocks.wants(size) else None
+                with open(os.path.join(self.source_dir, rel_path), 'rb') as src, \
+                        open(os.path.join(self.stage_dir, rel_path), 'wb') as dest:
+                    while True:
+                        buf = src.read(self.chunk_size)
+                        if not buf:
+                            break
+                        dest.write(buf)
+                        digest.update(buf)
+                        if tree:
+                            tree.update(buf)
+                        done += len(buf)
+                        if self.device and total:
+                            self.device.calculate_and_emit(done, total)
+                shutil.copystat(os.path.join(self.source_dir, rel_path), os.path.join(self.stage_dir, rel_path))
+                if checksums:
+                    self.mdsums[rel_path] = digest.hexdigest()
+                if tree:
+                    blocks.add(rel_path, tree.finish().leaves)
+        except OSError as oe:
+            logging.info(f'Error staging {self.source_dir} to {self.stage_dir}: {oe}')
+            self.cleanup()
+            return 1
+        logging.info(f'Time staging {total} bytes to {self.stage_dir}: {time.time() - start} seconds')
+        return 0
+
+    def cleanup(self):
+        '''Remove the stage, freeing the memory or disk space it uses'''
+        try:
+            shutil.rmtree(self.stage_dir)
+        except FileNotFoundError:
+            pass
+        except OSError as oe:
+            logging.info(f'Error removing {self.stage_dir}: {oe}')
@@ -0,0 +1,78 @@
+import logging
+
+from config.config import *
+
+
+class HubLayout:
+    '''The ports of one hub in display order, indexed by port path, and their (row, column) on the hub's
+    tab: column after column of rows ports each'''
+    def __init__(self, ports, rows):
+        self.ports = tuple(ports)
+        self.rows = max(1, rows)
+        self.index = {port: i for i, port in enumerate(self.ports)}
+        self.columns = max(1, -(-len(self.ports) // self.rows))
+
+    def __len__(self):
+        return len(self.ports)
+
+    def get_position(self, i):
+        '''Return the (row, column) of the i-th port'''
+        return (i % self.rows, i // self.rows)
+
+    def get_positions(self):
+        return [self.get_position(i) for i in range(len(self.ports))]
+
+    def get_location(self, port):
+        '''Return the (row, column) of a port path, or None if it isn't mapped'''
+        i = self.index.get(port)
+        return None if i is None else self.get_position(i)
+
+
+class UsbTopology:
+    '''The USB ports of the station, parsed once from the lines of the mapping file.
+
+    Each line is the path of a port below a root port (e.g. 6.4.4, a device on port 4 of a hub on port 4
+    of the hub on port 6), in the order they are shown. Paths can be nested to any depth. The ports listed
+    before any section are those of every root port; a line [1.4] starts a section with the ports of the
+    root port 1.4 only, where a root port (one of USB_PORTS) can itself be a port of a hub. Each column of
+    a hub's tab has hub_rows (HUB_ROWS) rows, or those given for its root port in HUB_ROWS_BY_PORT.'''
+    def __init__(self, mappings, **kwargs):
+        self.hub_rows = kwargs.get('hub_rows', HUB_ROWS)
+        self.hub_rows_by_port = kwargs.get('hub_rows_by_port', HUB_ROWS_BY_PORT)
+        '''{section: {port path: None}}, dicts keeping the order of the ports'''
+        sections = {None: {}}
+        section = None
+        for line in mappings:
+            line = str(line).strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1].strip()
+                sections.setdefault(section, {})
+                continue
+            if line in sections[section]:
+                logging.info(f'Port {line} is mapped twice, ignoring the second')
+                continue
+            sections[section][line] = None
+        default = list(sections.pop(None))
+        self.default = HubLayout(default, self.hub_rows)
+        '''Root ports with their own rows but no section of their own share the default ports'''
+        for hub in self.hub_rows_by_port:
+            sections.setdefault(hub, default)
+        self.hubs = {hub: HubLayout(ports, self.get_rows(hub)) for hub, ports in sections.items()}
+
+    def get_rows(self, hub):
+        return self.hub_rows_by_port.get(hub, self.hub_rows)
+
+    def get_hub(self, hub):
+        '''Return the HubLayout of a root port'''
+        return self.hubs.get(hub, self.default)
+
+    def locate(self, usb_id, roots):
+        '''Return (root port, port path) of a device from its usb ids (e.g. ['1', '4', '2']), using the
+        longest of the roots (a set of root ports) that it is below, or None'''
+        for i in range(len(usb_id) - 1, 0, -1):
+            hub = '.'.join(usb_id[:i])
+            if hub in roots:
+                return hub, '.'.join(usb_id[i:])
+        return None
@@ -1,15 +1,106 @@
-CHECKSUMS_FILE = '/tmp/md5sums/fd_md5.txt'
+# Source checksums are cached here between batches, for the last MANIFEST_CACHE_VOLUMES source volumes
+CHECKSUMS_FILE = '~/.cache/fd_replicator/checksums.json'
+MANIFEST_CACHE = True
+MANIFEST_CACHE_VOLUMES = 20
 MAPPING_FILE = 'dev_port_mapping'
 USB_PORTS = ['00']
 USBDIR = '/dev/disk/by-path'
 HUB_ROWS = 27
+# Rows per column for the root ports whose hubs are laid out differently, e.g. {'2': 10}
+HUB_ROWS_BY_PORT = {}
+# Capacity, link speed and serial numbers of the devices are read from sysfs. Before a batch, devices on a link
+# slower than MIN_LINK_SPEED Mbit/s (480 is USB 2.0) are warned about
+SYSFS_DIR = '/sys'
+MIN_LINK_SPEED = 480
+# Probe the devices before copying (the 'Probe devices' checkbox): PROBE_BLOCKS blocks of PROBE_BLOCK_SIZE, spread up
+# to the end of each device, are written and read back (and then restored). Devices that don't read them back (fake
+# capacity) or write slower than PROBE_MIN_WRITE_SPEED MB/s, timed over a sequential run of PROBE_SPEED_BLOCKS blocks
+# at the start of the device, are left out of the batch
+PROBE = False
+PROBE_BLOCKS = 16
+PROBE_BLOCK_SIZE = 1024 * 1024
+PROBE_SPEED_BLOCKS = 16
+PROBE_MIN_WRITE_SPEED = 2.0
 EMAIL_SETTINGS_FILE = './config/email_config.yaml'
 LOGFILE = '~/.replicator.log'
 HELP_FILE = './config/help.html'
 
+# Devices are mounted on one reusable mount point each below MOUNT_DIR. The source is mounted read only. noatime
+# saves a write for every file read; add 'flush' to have vfat write out early (slower, but safer if a stick is
+# pulled), or uid=/gid= to give the files to a user other than root
+MOUNT_DIR = '/tmp/fd_replicator'
+SOURCE_MOUNT_OPTIONS = 'ro,noatime'
+DEVICE_MOUNT_OPTIONS = 'rw,noatime,async'
+# Mount and unmount with the mount(2) and umount2(2) system calls, as MOUNT_FS_TYPE, rather than running mount and
+# umount. The commands are still used when the system calls fail (not root, another file system, image files)
+NATIVE_MOUNT = True
+MOUNT_FS_TYPE = 'vfat'
 DEVICE_LABEL = 'MyDeviceLabel'
-IGNORED_FILES = ['.Trashes', 'System Volume Information', '.Spotlight-V100', '.fseventsd']
+# Written to the root of each device once it has been copied and verified, with the ID of the payload, so a re-run
+# can skip the devices that already hold it (must be an 8.3 name, it is read without mounting the device)
+STAMP_FILE = 'FDSTAMP.TXT'
+COMPLETION_STAMP = True
+IGNORED_FILES = ['.Trashes', 'System Volume Information', '.Spotlight-V100', '.fseventsd', STAMP_FILE]
 ICON_RED_LED = 'config/icons/led-circle-red.png'
 ICON_GREEN_LED = 'config/icons/led-circle-green.png'
 ICON_GREY_LED = 'config/icons/led-circle-grey.png'
 DEFAULT_THREAD_NUM = 7
+# Devices plugged in or removed are noticed through 'netlink' (kernel uevents), 'inotify' (on USBDIR) or 'poll'
+# (every HOTPLUG_POLL_INTERVAL seconds); 'auto' uses the first available. The devices are listed again once no event
+# has come for HOTPLUG_DEBOUNCE seconds
+HOTPLUG_SOURCE = 'auto'
+HOTPLUG_DEBOUNCE = 0.2
+HOTPLUG_POLL_INTERVAL = 6
+
+# Copy modes: 'per_device' (each device reads the source itself), 'fan_out' (source read once, written to all devices)
+# 'image' (source block device cloned raw to all devices) or 'golden_image' (a FAT32 image built from the source files
+# once, then cloned raw to all devices) or 'sync' (like per_device, but only new or changed files are copied, and
+# only the files not in the source are deleted)
+COPY_MODE = 'per_device'
+FAN_OUT_CHUNK_SIZE = 4 * 1024 * 1024
+# Max buffers queued per device. Bounds memory to roughly (FAN_OUT_QUEUE_DEPTH + 2) * FAN_OUT_CHUNK_SIZE
+FAN_OUT_QUEUE_DEPTH = 8
+# Raw image mode ('image' COPY_MODE) reads and writes the block devices in chunks of this size
+IMAGE_CHUNK_SIZE = 8 * 1024 * 1024
+# Read each IMAGE_DEDUPE_BLOCK_SIZE block of the target first, and only write the blocks that differ from the image
+IMAGE_DEDUPE = False
+IMAGE_DEDUPE_BLOCK_SIZE = 1024 * 1024
+# Images are verified (and repaired) in blocks of BLOCK_TREE_LEAF_SIZE, hashed by BLOCK_TREE_VERIFY_THREADS per device
+BLOCK_TREE_LEAF_SIZE = 1024 * 1024
+BLOCK_TREE_VERIFY_THREADS = 2
+# Golden images are cached here, and sized to the contents plus this fraction of free space
+GOLDEN_IMAGE_DIR = '~/.cache/fd_replicator/images'
+GOLDEN_IMAGE_SLACK = 0.02
+# Stage the source in a local directory (tmpfs by default) once, and copy to the devices from there.
+# Falls back to reading the source device directly if the files don't fit, leaving STAGING_RESERVE bytes free
+STAGING = False
+STAGING_DIR = '/dev/shm/fd_replicator'
+STAGING_RESERVE = 256 * 1024 * 1024
+# File copy backend for the per-device copies: 'auto' (copy_file_range, then sendfile, then buffered), 'copy_file_range',
+# 'sendfile', 'buffered' or 'direct' (buffered with O_DIRECT writes). If COPY_PREALLOCATE is True, the clusters of each
+# file are reserved with fallocate before it is written (without zero filling it)
+COPY_STRATEGY = 'auto'
+COPY_BLOCK_SIZE = 1024 * 1024
+COPY_PREALLOCATE = True
+# Copies keep the source's modification times, which the 'sync' copy mode relies on
+COPY_PRESERVE_TIMES = True
+# 'sync' copy mode: files whose size matches and whose modification time is within this many seconds (FAT keeps
+# them to 2 seconds) are not copied again
+SYNC_MTIME_TOLERANCE = 2
+# Checksums: 'md5' (compatible with md5sum), 'sha1', 'sha256', 'blake2b', or the much faster (non-cryptographic)
+# 'crc32' and 'adler32'. Files are hashed HASH_CHUNK_SIZE bytes at a time, or through mmap if HASH_MMAP is True
+HASH_ALGORITHM = 'md5'
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_MMAP = False
+# Threads hashing the source files in parallel, 0 for one per CPU
+HASH_WORKERS = 0
+# Verify the copies as read back from the devices, bypassing the page cache (the 'Verify from flash' checkbox)
+READBACK_VERIFY = False
+# Fraction of the blocks of each file compared with the source when verifying (the 'Verify %' field).
+# Below 1, the directory tree and file sizes are still checked in full, but only the first and last
+# blocks of each file plus a random sample of the others, of VERIFY_SAMPLE_BLOCK_SIZE bytes each
+# (rounded up to 4096), are compared, with digests of the source blocks created along with the source checksums
+VERIFY_SAMPLE = 1
+VERIFY_SAMPLE_BLOCK_SIZE = 1024 * 1024
+# Times the files that fail verification are copied again, before the device is marked as failed
+REPAIR_RETRIES = 2
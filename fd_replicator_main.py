@@ -1,14 +1,20 @@
 import os
 import yaml
 
-from actions.fd_devices import Devices, FdDevice
+from actions.fan_out import FanOutCopier
+from actions.fd_devices import FdDevice, get_registry
+from actions.hotplug import HotplugMonitor
+from actions.image import ImageCopier
+from actions.inventory import preflight
+from actions.probe import DeviceProber
+from actions.sampling import SourceBlocks
 from actions.mail import Mail
 from config.config import *
 
 class ReplicatorMain:
     '''Replicator Main class'''
-    def __init__(self):
-        self.fd_devices = Devices()
+    def __init__(self, **kwargs):
+        self.fd_devices = kwargs.get('devices') or get_registry()
         self.config_dir = os.path.expanduser('~/.config/fd_replicator')
         ## Do this after ReplicationMain is called?
         #self.check_and_create_dir(self.config_dir)()
@@ -16,10 +22,50 @@ class ReplicatorMain:
         #self.email_settings_file = os.path.join(self.config_dir, 'email_config.yaml')
         self.email_settings_file = EMAIL_SETTINGS_FILE # Change to the above
 
+    def preflight(self, source_object, devices, **kwargs):
+        '''Check the target devices (paths) against the payload of the source before a batch in copy_mode.
+        Returns ({device: reason} of the devices that can't be used, [warnings])'''
+        payload_size = source_object.get_payload_size(copy_mode=kwargs.get('copy_mode', COPY_MODE))
+        return preflight(devices, payload_size, self.fd_devices.inventory)
+
+    def probe_devices(self, devices, **kwargs):
+        '''Probe the speed and real capacity of the devices (paths), threads at a time. Returns {device: ProbeResult}'''
+        return DeviceProber(threads=kwargs.get('threads', DEFAULT_THREAD_NUM)).probe_all(devices)
+
     def new_device(self, **kwargs):
         '''create and return a new device'''
         return FdDevice(**kwargs)
 
+    def fan_out_copy(self, source_object, dest_objects, **kwargs):
+        '''Copy from the source object to all the destination objects, reading the source only once.
+        If the source checksums don't exist yet, they are created during the copy, with the digests of the
+        source blocks if only a sample is verified'''
+        threads = kwargs.get('threads', DEFAULT_THREAD_NUM)
+        hash_source = bool(kwargs.get('checksums')) and not source_object.source_mdsums
+        blocks = SourceBlocks() if hash_source and kwargs.get('sample', VERIFY_SAMPLE) < 1 else None
+        source_dir = source_object.get_copy_source_dir()
+        for dest_object in dest_objects:
+            dest_object.set_copy_options(source_object.device, source_dir, **kwargs)
+        copier = FanOutCopier(source_dir, dest_objects, threads=threads, hash_source=hash_source,
+                blocks=blocks, index=source_object.source_index)
+        return copier.replicate()
+
+    def image_copy(self, source_object, dest_objects, **kwargs):
+        '''Clone the source object's block device (or the given image) to all the destination objects'''
+        threads = kwargs.get('threads', DEFAULT_THREAD_NUM)
+        image = kwargs.get('image', source_object.device)
+        for dest_object in dest_objects:
+            dest_object.set_copy_options(source_object.device, source_object.device_dir, **kwargs)
+        copier = ImageCopier(image, dest_objects, threads=threads, dedupe=kwargs.get('dedupe', IMAGE_DEDUPE))
+        return copier.replicate()
+
+    def start_hotplug(self, callback, **kwargs):
+        '''Start watching for devices being plugged in or removed. callback(added, removed) is called from
+        the monitor's thread. source, if given, replaces the event source (netlink, inotify or polling)'''
+        monitor = HotplugMonitor(self.fd_devices, callback, source=kwargs.get('source'))
+        monitor.start()
+        return monitor
+
     def check_and_create_dir(self, directory):
         '''Create directory if it doesn't exist'''
         if not os.path.isdir(os.path.expanduser(directory)):
@@ -59,16 +105,19 @@ class ReplicatorMain:
             text = t.read()
         return text
 
-    def get_devices(self):
-        '''Returns a list of hubs [], and a dict with hub and connected ports'''
-        devices = self.fd_devices.get_usb_ids()
+    def get_devices(self, **kwargs):
+        '''Returns a list of hubs [], and a dict with hub and connected ports. usb_ids, if given, is the
+        listing of the devices to use (see HotplugMonitor), instead of listing them again'''
+        devices = kwargs.get('usb_ids')
+        if devices is None:
+            devices = self.fd_devices.get_usb_ids()
         connected_ports = self.fd_devices.get_hubs_with_mappings(devices)
         hubs = sorted(list(connected_ports.keys()))
         return hubs, connected_ports
 
-    def get_direct_dev(self):
+    def get_direct_dev(self, **kwargs):
         '''get devices connected directly to the box'''
-        direct_devices = self.fd_devices.get_direct_dev()
+        direct_devices = self.fd_devices.get_direct_dev(**kwargs)
         if direct_devices:
             return direct_devices
         else:
@@ -320,21 +320,53 @@ class MainWidgetTests(unittest.TestCase):
         self.assertEqual(self.mw.total_devices, 3)
         self.mw.device_widget.set_led_on_active.assert_called()
 
-    @patch('widgets.main_widget.QTimer')
-    def test_start_timer(self, mock_QTimer):
+    def test_start_hotplug(self):
         self.mw.check_devices = MagicMock()
-        self.mw.start_timer()
-        mock_QTimer.assert_called()
-        self.mw.timer.timeout.connect.assert_called_with(self.mw.check_devices)
-        self.mw.timer.start.assert_called_with(6000)
+        self.mw.start_hotplug()
+        self.assertEqual(self.mw.hotplug, self.mw.replicator_main.start_hotplug.return_value)
+        self.mw.replicator_main.start_hotplug.assert_called()
+
+        '''Changes are applied from the monitor's listing, without listing the devices again'''
+        self.mw.hotplug.usb_ids = {'/dev/sdb': ['01', '2', '3']}
+        self.mw.hotplug_signals.changed.emit({'/dev/sdb': ['01', '2', '3']}, [])
+        self.mw.check_devices.assert_called_with(usb_ids={'/dev/sdb': ['01', '2', '3']})
+
+        '''Not while copying'''
+        self.mw.check_devices.reset_mock()
+        self.mw.hotplug_paused = True
+        self.mw.devices_changed({}, ['/dev/sdb'])
+        self.mw.devices_changed({'/dev/sdc': ['01', '2', '4']}, [])
+        self.mw.check_devices.assert_not_called()
+        self.assertEqual(self.mw.hotplug_changes, {'/dev/sdb', '/dev/sdc'})
 
     def test_toggle_checksums(self):
+        self.mw.readback_check_box = MagicMock()
         state = Qt.Checked
         self.mw.toggle_checksums(state)
         self.assertEqual(self.mw.checksums, True)
+        self.mw.readback_check_box.setEnabled.assert_called_with(True)
         state = ''
         self.mw.toggle_checksums(state)
         self.assertEqual(self.mw.checksums, False)
+        self.mw.readback_check_box.setEnabled.assert_called_with(False)
+
+    def test_set_sample(self):
+        self.mw.sample_line_edit = MagicMock()
+        self.mw.sample_line_edit.text = MagicMock(return_value='25')
+        self.mw.set_sample()
+        self.assertEqual(self.mw.sample, 0.25)
+
+    def test_toggle_readback(self):
+        self.mw.toggle_readback(Qt.Checked)
+        self.assertEqual(self.mw.readback, True)
+        self.mw.toggle_readback('')
+        self.assertEqual(self.mw.readback, False)
+
+    def test_toggle_probe(self):
+        self.mw.toggle_probe(Qt.Checked)
+        self.assertEqual(self.mw.probe, True)
+        self.mw.toggle_probe('')
+        self.assertEqual(self.mw.probe, False)
 
     def test_set_workers(self):
         self.mw.thread_line_edit = MagicMock()
@@ -371,9 +403,40 @@ class MainWidgetTests(unittest.TestCase):
         fn = MagicMock()
         worker = Worker(fn)
         status = self.mw.prepare_checksums(progress_callback=worker.signals.progress)
-        self.mw.source_object.prepare_to_copy.assert_called_with(checksums=False, progress_callback=worker.signals.progress)
+        self.mw.source_object.prepare_to_copy.assert_called_with(checksums=False, sample=1, progress_callback=worker.signals.progress)
         self.assertEqual(status, 0)
 
+        self.mw.copy_mode = 'fan_out'
+        self.mw.checksums = True
+        status = self.mw.prepare_checksums(progress_callback=worker.signals.progress)
+        self.mw.source_object.prepare_to_copy.assert_called_with(checksums=False, sample=1, progress_callback=worker.signals.progress)
+
+        self.mw.copy_mode = 'image'
+        self.mw.source_object.prepare_image = MagicMock(return_value=0)
+        status = self.mw.prepare_checksums(progress_callback=worker.signals.progress)
+        self.mw.source_object.prepare_image.assert_called_with(progress_callback=worker.signals.progress)
+        self.assertEqual(status, 0)
+
+        self.mw.copy_mode = 'golden_image'
+        self.mw.source_object.prepare_golden_image = MagicMock(return_value=1)
+        status = self.mw.prepare_checksums(progress_callback=worker.signals.progress)
+        self.mw.source_object.prepare_golden_image.assert_called_with(progress_callback=worker.signals.progress)
+        self.assertEqual(status, 1)
+
+        '''Probe the devices that passed the preflight'''
+        self.mw.probe = True
+        self.mw.thread_num = 7
+        self.mw.hubs = ['01']
+        self.mw.devices =  {'01': [('2.6', '/dev/sdh', (5, 1)), ('2.1', '/dev/sdp', (3, 1))]}
+        self.mw.preflight_failures = {'/dev/sdp': 'too small'}
+        self.mw.replicator_main.probe_devices = MagicMock(return_value={'/dev/sdh': MagicMock()})
+        self.mw.prepare_checksums(progress_callback=worker.signals.progress)
+        self.mw.replicator_main.probe_devices.assert_not_called()
+        self.mw.source_object.prepare_golden_image.return_value = 0
+        self.mw.prepare_checksums(progress_callback=worker.signals.progress)
+        self.mw.replicator_main.probe_devices.assert_called_with(['/dev/sdh'], threads=7)
+        self.assertEqual(list(self.mw.probe_results), ['/dev/sdh'])
+
     def test_copy(self):
         hub = '01'
         device = ('2.6', '/dev/sdh', (5, 1))
@@ -389,8 +452,8 @@ class MainWidgetTests(unittest.TestCase):
         progress_callback = worker.signals.progress
 
         dest_object, results = self.mw.copy(hub, device, progress_callback=progress_callback)
-        self.mw.replicator_main.new_device.assert_called_with(device='/dev/sdh', port='2.6', hub='01', hub_coordinates=(5,1), source_mdsums=self.mw.source_object.source_mdsums)
-        new_device.copy.assert_called_with(self.mw.source_object.device, self.mw.source_object.device_dir, checksums=True, progress_callback=progress_callback)
+        self.mw.replicator_main.new_device.assert_called_with(device='/dev/sdh', port='2.6', hub='01', hub_coordinates=(5,1), source_mdsums=self.mw.source_object.source_mdsums, source_blocks=self.mw.source_object.source_blocks, manifest_id=self.mw.source_object.manifest_id, source_index=self.mw.source_object.source_index)
+        new_device.copy.assert_called_with(self.mw.source_object.device, self.mw.source_object.get_copy_source_dir(), checksums=True, readback=False, sample=1, sync=False, progress_callback=progress_callback)
         
     @patch('widgets.main_widget.QMessageBox.question', return_value=QMessageBox.Yes)
     @patch('widgets.main_widget.QThreadPool', side_effect=[MagicMock(), MagicMock()])
@@ -399,18 +462,34 @@ class MainWidgetTests(unittest.TestCase):
         self.mw.source_object = MagicMock()
         self.mw.source_object.delete_ignored = MagicMock(return_value=0)
         self.mw.refresh = MagicMock()
-        self.mw.timer = MagicMock()
         self.mw.thread_num = 7
         self.mw.checksums_progress_bar = MagicMock()
         self.mw.prepare_checksums = MagicMock()
         self.mw.checksums_finished_actions = MagicMock()
         self.mw.update_checksums_progress_bar = MagicMock()
+        self.mw.check_preflight = MagicMock(return_value=False)
+        self.mw.initialize_devices = MagicMock()
 
+        '''Stopped by the preflight'''
+        self.mw.copy_to_devices()
+        self.assertFalse(self.mw.hotplug_paused)
+        mock_Worker.assert_not_called()
+
+        '''Devices changed while the preflight was shown are caught up with afterwards'''
+        self.mw.check_devices = MagicMock()
+        self.mw.hotplug = MagicMock(usb_ids={'/dev/sdb': ['01', '2', '3']})
+        self.mw.check_preflight.side_effect = lambda: self.mw.devices_changed({'/dev/sdb': ['01', '2', '3']}, []) or False
+        self.mw.copy_to_devices()
+        self.assertFalse(self.mw.hotplug_paused)
+        self.mw.check_devices.assert_called_once_with(usb_ids={'/dev/sdb': ['01', '2', '3']})
+        self.mw.check_preflight.side_effect = None
+
+        self.mw.check_preflight.return_value = True
         self.mw.copy_to_devices()
 
         self.mw.source_object.delete_ignored.assert_called()
         self.mw.refresh.assert_called()
-        self.mw.timer.stop.assert_called()
+        self.assertTrue(self.mw.hotplug_paused)
         self.assertEqual(self.mw.finished_devices, 0)
         self.assertEqual(len(mock_QThreadPool.call_args_list), 2)
         self.mw.threadpool.setMaxThreadCount.assert_called_with(7)
@@ -441,6 +520,157 @@ class MainWidgetTests(unittest.TestCase):
         self.mw.worker.signals.progress.connect.assert_called_with(self.mw.update_progress_bar)
         self.mw.threadpool.start.assert_called_with(self.mw.worker)
 
+    @patch('widgets.main_widget.Worker')
+    def test_copy_files_preflight_failures(self, mock_Worker):
+        self.mw.initialize_devices = MagicMock()
+        self.mw.hubs = ['01', '02']
+        self.mw.devices =  {'01': [('2.6', '/dev/sdh', (5, 1))],
+                '02': [('2.1', '/dev/sdp', (3, 1))]}
+        self.mw.preflight_failures = {'/dev/sdh': 'too small'}
+        self.mw.threadpool = MagicMock()
+
+        self.mw.copy_files()
+
+        mock_Worker.assert_called_once_with(self.mw.copy, '02', ('2.1', '/dev/sdp', (3, 1)))
+        self.assertEqual(self.mw.total_devices, 1)
+
+    @patch('widgets.main_widget.Worker')
+    def test_copy_files_hotplug_changes(self, mock_Worker):
+        '''Devices plugged in or removed since the preflight aren't copied to'''
+        self.mw.hubs = ['01', '02']
+        self.mw.devices =  {'01': [('2.6', '/dev/sdh', (5, 1))],
+                '02': [('2.1', '/dev/sdp', (3, 1))]}
+        self.mw.threadpool = MagicMock()
+        self.mw.hotplug_paused = True
+        self.mw.devices_changed({'/dev/sdh': ['02', '2', '6']}, ['/dev/sdh'])
+
+        self.mw.copy_files()
+
+        mock_Worker.assert_called_once_with(self.mw.copy, '02', ('2.1', '/dev/sdp', (3, 1)))
+        self.assertEqual(self.mw.total_devices, 1)
+
+    @patch('widgets.main_widget.QMessageBox.warning')
+    @patch('widgets.main_widget.Worker')
+    def test_copy_files_probe_results(self, mock_Worker, mock_warning):
+        self.mw.initialize_devices = MagicMock()
+        self.mw.hubs = ['01', '02']
+        self.mw.devices =  {'01': [('2.6', '/dev/sdh', (5, 1))],
+                '02': [('2.1', '/dev/sdp', (3, 1))]}
+        self.mw.device_widget = MagicMock()
+        self.mw.device_widget.progress_bars = {'01': {(5, 1): MagicMock()}, '02': {(3, 1): MagicMock()}}
+        self.mw.source_object = MagicMock()
+        self.mw.threadpool = MagicMock()
+        self.mw.hotplug_paused = True
+        flagged = MagicMock(flagged=True)
+        flagged.describe.return_value = 'write 0.5 MB/s, read 10.0 MB/s, slower than 2 MB/s'
+        self.mw.probe_results = {'/dev/sdh': flagged, '/dev/sdp': MagicMock(flagged=False)}
+
+        self.mw.copy_files()
+
+        progress_info = self.mw.device_widget.progress_bars['01'][(5, 1)]
+        self.assertEqual(progress_info.probe, flagged)
+        self.assertEqual(progress_info.status, 1)
+        progress_info.progress_bar.setToolTip.assert_called_with('write 0.5 MB/s, read 10.0 MB/s, slower than 2 MB/s')
+        mock_Worker.assert_called_once_with(self.mw.copy, '02', ('2.1', '/dev/sdp', (3, 1)))
+
+        '''Nothing left to copy to'''
+        mock_Worker.reset_mock()
+        self.mw.probe_results['/dev/sdp'].flagged = True
+        self.mw.devices =  {'01': [('2.6', '/dev/sdh', (5, 1))],
+                '02': [('2.1', '/dev/sdp', (3, 1))]}
+        self.mw.copy_files()
+        mock_Worker.assert_not_called()
+        mock_warning.assert_called()
+        self.mw.source_object.cleanup_stage.assert_called()
+        self.assertFalse(self.mw.hotplug_paused)
+
+        '''A device whose place is no longer in the grid, after the mapping file changed, is still left out'''
+        del self.mw.device_widget.progress_bars['02'][(3, 1)]
+        self.mw.devices =  {'01': [('2.6', '/dev/sdh', (5, 1))],
+                '02': [('2.1', '/dev/sdp', (3, 1))]}
+        self.mw.copy_files()
+        mock_Worker.assert_not_called()
+
+    @patch('widgets.main_widget.QMessageBox.question', return_value=QMessageBox.Yes)
+    @patch('widgets.main_widget.QThreadPool')
+    @patch('widgets.main_widget.Worker')
+    def test_copy_to_devices_plugged_in_later(self, mock_Worker, mock_QThreadPool, mock_question):
+        '''A device plugged in after startup is preflighted, and one removed since isn't'''
+        self.mw.source_object = MagicMock()
+        self.mw.source_object.delete_ignored = MagicMock(return_value=0)
+        self.mw.refresh = MagicMock()
+        self.mw.thread_num = 7
+        self.mw.checksums_progress_bar = MagicMock()
+        self.mw.device_widget = MagicMock()
+        self.mw.hubs = ['01']
+        self.mw.devices =  {'01': [('2.6', '/dev/sdh', (5, 1))]}
+        self.mw.replicator_main.get_devices = MagicMock(return_value=(['01'], {'01': [('2.1', '/dev/sdp', (3, 1))]}))
+        self.mw.replicator_main.preflight = MagicMock(return_value=({}, []))
+
+        self.mw.copy_to_devices()
+
+        self.mw.replicator_main.preflight.assert_called_with(self.mw.source_object, ['/dev/sdp'], 
+                copy_mode=self.mw.copy_mode)
+        self.assertEqual(self.mw.total_devices, 1)
+
+    @patch('widgets.main_widget.QMessageBox.warning')
+    @patch('widgets.main_widget.QMessageBox.question', return_value=QMessageBox.No)
+    def test_check_preflight(self, mock_question, mock_warning):
+        self.mw.hubs = ['01']
+        self.mw.devices =  {'01': [('2.6', '/dev/sdh', (5, 1)), ('2.1', '/dev/sdp', (3, 1))]}
+        self.mw.device_widget = MagicMock()
+        self.mw.device_widget.progress_bars = {'01': {(5, 1): MagicMock(), (3, 1): MagicMock()}}
+        self.mw.replicator_main.preflight = MagicMock(return_value=({}, []))
+        self.assertTrue(self.mw.check_preflight())
+        self.mw.replicator_main.preflight.assert_called_with(self.mw.source_object, ['/dev/sdh', '/dev/sdp'], 
+                copy_mode=self.mw.copy_mode)
+        mock_question.assert_not_called()
+
+        '''A device too small is marked failed, and the user asked'''
+        self.mw.replicator_main.preflight.return_value = ({'/dev/sdh': '10 bytes'}, ['/dev/sdp: slow USB link'])
+        self.assertFalse(self.mw.check_preflight())
+        self.assertEqual(self.mw.device_widget.progress_bars['01'][(5, 1)].status, 1)
+        self.assertIn('/dev/sdh is too small: 10 bytes\n/dev/sdp: slow USB link', mock_question.call_args[0][2])
+        mock_question.return_value = QMessageBox.Yes
+        self.assertTrue(self.mw.check_preflight())
+
+        '''No device left'''
+        self.mw.replicator_main.preflight.return_value = ({'/dev/sdh': '10 bytes', '/dev/sdp': '10 bytes'}, [])
+        self.assertFalse(self.mw.check_preflight())
+        mock_warning.assert_called()
+
+        '''Devices whose place is no longer in the grid, after the mapping file changed, are skipped'''
+        del self.mw.device_widget.progress_bars['01'][(3, 1)]
+        self.mw.hubs = ['01', '02']
+        self.mw.devices['02'] = [('3.1', '/dev/sdq', (0, 0))]
+        self.mw.replicator_main.preflight.return_value = ({'/dev/sdp': '10 bytes', '/dev/sdq': '10 bytes'}, [])
+        self.assertTrue(self.mw.check_preflight())
+
+    @patch('widgets.main_widget.Worker')
+    def test_copy_files_fan_out(self, mock_Worker):
+        self.mw.initialize_devices = MagicMock()
+        self.mw.copy_mode = 'fan_out'
+        self.mw.hubs = ['01', '02']
+        self.mw.devices =  {'01': [('2.6', '/dev/sdh', (5, 1))],
+                '02': [('2.1', '/dev/sdp', (3, 1))]}
+        self.mw.threadpool = MagicMock()
+
+        self.mw.copy_files()
+
+        mock_Worker.assert_called_once_with(self.mw.fan_out_copy, [('01', ('2.6', '/dev/sdh', (5, 1))), 
+            ('02', ('2.1', '/dev/sdp', (3, 1)))])
+        self.mw.worker.signals.result.connect.assert_called_with(self.mw.update_fan_out_results)
+        self.mw.worker.signals.progress.connect.assert_called_with(self.mw.update_progress_bar)
+        self.mw.threadpool.start.assert_called_once_with(self.mw.worker)
+
+    def test_update_fan_out_results(self):
+        self.mw.update_result = MagicMock()
+        self.mw.do_completed_actions = MagicMock()
+        results = [('device1', 0), ('device2', 1)]
+        self.mw.update_fan_out_results(results)
+        self.mw.update_result.assert_has_calls([call(('device1', 0)), call(('device2', 1))])
+        self.assertEqual(self.mw.do_completed_actions.call_count, 2)
+
     @patch('widgets.main_widget.QMessageBox.warning')
     @patch('widgets.main_widget.QMessageBox.Ok')
     def test_get_checksums_results(self, mock_Ok, mock_warning):
@@ -527,7 +757,8 @@ class MainWidgetTests(unittest.TestCase):
         self.mw.total_devices = 54
         self.mw.start_time = 500
         self.mw.source_object = MagicMock()
-        self.mw.timer = MagicMock()
+        self.mw.hotplug_paused = True
+        self.mw.check_devices = MagicMock()
         self.mw.replicator_main = MagicMock()
         self.mw.file_list = ['file1', 'file2', 'file3']
         self.mw.failed_devices = 5
@@ -536,7 +767,9 @@ class MainWidgetTests(unittest.TestCase):
 
         self.assertEqual(self.mw.finished_devices, 54)
         self.mw.source_object.check_mountpoint.assert_called()
-        self.mw.timer.start.assert_called()
+        self.mw.source_object.cleanup_stage.assert_called()
+        self.assertFalse(self.mw.hotplug_paused)
+        self.mw.check_devices.assert_called()
         self.mw.replicator_main.send_notification.assert_called_with(54, 5, 500, self.mw.file_list)
         mock_QMessageBox.information.assert_called_with(self.mw, 'Finished', 'Copied 54 devices. Failures: 5. Time Elapsed 500', mock_QMessageBox.Ok)
 
@@ -617,6 +850,10 @@ class MainWidgetTests(unittest.TestCase):
         self.mw.add_source_list.assert_called()
         self.mw.device_widget.set_led_on_active.assert_called()
 
+        self.mw.check_devices(usb_ids={})
+        self.mw.add_source_list.assert_called_with(usb_ids={})
+        self.mw.device_widget.set_led_on_active.assert_called_with(usb_ids={})
+
     def test_reset_devices(self):
         self.mw.checksums_progress_bar = MagicMock()
         self.mw.device_widget = MagicMock()
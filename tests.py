@@ -1,19 +1,49 @@
 #!/usr/bin/python
 
 from email.mime.multipart import MIMEMultipart
+import errno
 import hashlib
+import io
+import json
+import mmap
+import os
+import queue
+import random
 import shlex
 import string
 import subprocess
+import tempfile
 import unittest
+import zlib
 from unittest.mock import MagicMock, patch, mock_open, call, DEFAULT
 
 import fd_replicator_main
 from fd_replicator_main import *
 import actions.fd_devices as fd_devices
+from actions.fan_out import FanOutCopier, FanOutWriter
 from actions.fd_devices import Devices, FdDevice
+from actions.hotplug import HotplugMonitor, PollEventSource
+from actions.inventory import Inventory, preflight
+from actions.probe import DeviceProber
+import actions.image as image
+from actions.copy_engine import CopyEngine
+from actions.golden_image import GoldenImageBuilder
+from actions.hashing import HashEngine, new_hash
+from actions.block_tree import BlockTree
+from actions.manifest import ManifestCache, PackedManifest, compare_manifests
+import actions.mounts as mounts
+from actions.mounts import MountManager, MountTable
+from actions.sampling import SampledVerifier, SourceBlocks, sample_blocks
+from actions.source_index import SourceIndex, iter_sorted_files
+import actions.staging as staging
+from actions.staging import SourceStage
+from actions.topology import UsbTopology
+from actions.image import ImageCopier, ImageWriter
 from actions.mail import Mail
 
+'''Some tests replace these directly, they are put back in tearDown'''
+OS_PATH_FUNCTIONS = (os.path.isfile, os.path.isdir, os.path.realpath)
+
 
 class ReplicatorMainTests(unittest.TestCase):
     def setUp(self):
@@ -98,6 +128,21 @@ class ReplicatorMainTests(unittest.TestCase):
             ('2.5', '/dev/sdd', (6, 1)), ('2.3', '/dev/sdb', (1, 1))]})
         hubs, connected_ports = self.replicator_main.get_devices()
 
+    @patch('fd_replicator_main.preflight', return_value=({}, []))
+    def test_preflight(self, mock_preflight):
+        source_object = MagicMock()
+        source_object.get_payload_size = MagicMock(return_value=1000)
+        self.assertEqual(self.replicator_main.preflight(source_object, ['/dev/sdb'], copy_mode='image'), ({}, []))
+        source_object.get_payload_size.assert_called_with(copy_mode='image')
+        mock_preflight.assert_called_with(['/dev/sdb'], 1000, self.replicator_main.fd_devices.inventory)
+
+    @patch('fd_replicator_main.DeviceProber')
+    def test_probe_devices(self, mock_DeviceProber):
+        results = self.replicator_main.probe_devices(['/dev/sdb'], threads=3)
+        mock_DeviceProber.assert_called_with(threads=3)
+        mock_DeviceProber.return_value.probe_all.assert_called_with(['/dev/sdb'])
+        self.assertEqual(results, mock_DeviceProber.return_value.probe_all.return_value)
+
     def test_get_direct_dev(self):
         self.replicator_main.fd_devices.get_direct_dev = MagicMock(side_effect=[{'/dev/sda': '00'}, None])
         direct_devices = self.replicator_main.get_direct_dev()
@@ -172,6 +217,9 @@ class DevicesTests(unittest.TestCase):
                 '/dev/sdd': ['2', '2', '5'], '/dev/sdb': ['2', '2', '3']} 
         self.devices = Devices()
 
+    def tearDown(self):
+        fd_devices.os.path.isfile, fd_devices.os.path.isdir, fd_devices.os.path.realpath = OS_PATH_FUNCTIONS
+
     def test_get_mappings(self):
         mappings = self.devices.get_mappings()
         self.assertEqual(mappings[0], '3.6')
@@ -185,6 +233,11 @@ class DevicesTests(unittest.TestCase):
         usb_ids = self.devices.get_usb_ids()
         mock_listdir.assert_called_with(self.devices.usbdir)
         self.assertEqual(usb_ids,{'/dev/sda': ['00']}) 
+        self.assertEqual(self.devices.usb_ids, usb_ids)
+        '''Listing only'''
+        self.devices.usb_ids = {}
+        self.assertEqual(self.devices.list_usb_ids(), {'/dev/sda': ['00']})
+        self.assertEqual(self.devices.usb_ids, {})
 
         fd_devices.os.path.realpath = MagicMock(side_effect=FileNotFoundError())
         usb_ids = self.devices.get_usb_ids()
@@ -199,7 +252,7 @@ class DevicesTests(unittest.TestCase):
         self.assertEqual(direct_dev, {'/dev/sda': '00'})
         
     def test_get_dev_loc_from_mapping(self):
-        self.devices.mappings = ['3.6', '3.7', '3.8', 1.7]
+        self.devices.topology = UsbTopology(['3.6', '3.7', '3.8', 1.7])
         dev_add = '3.7'
         dev_loc = self.devices.get_dev_loc_from_mapping(dev_add)
         self.assertEqual(dev_loc, 1)
@@ -227,11 +280,12 @@ class DevicesTests(unittest.TestCase):
         dev_map_location = self.devices.get_dev_map_location(dev_addr)
         self.assertEqual(dev_map_location, (0, 1))
 
+        '''Stations with more ports get more columns'''
         self.devices.get_dev_loc_from_mapping = MagicMock(return_value=54)
         self.devices.hub_rows = 27
         dev_addr = '1.7'
         dev_map_location = self.devices.get_dev_map_location(dev_addr)
-        self.assertEqual(dev_map_location, (27, 1))
+        self.assertEqual(dev_map_location, (0, 2))
 
     def test_get_hubs_with_mappings(self):
         self.devices.usb_ports = {'1', '2'}
@@ -250,10 +304,240 @@ class DevicesTests(unittest.TestCase):
                 self.assertEqual(dev[0], '3.7')
                 self.assertEqual(dev[2], (1,0))
 
+    def test_get_hubs_with_mappings_nested(self):
+        '''A root port can be a port of a hub, with a section of its own in the mapping file'''
+        devices = Devices(usb_ports=['1', '2.4'])
+        devices.topology = UsbTopology(['1.1', '1.2', '[2.4]', '3', '1', '2'], hub_rows=2)
+        hubs = devices.get_hubs_with_mappings({'/dev/sdb': ['1', '1', '2'], '/dev/sdc': ['2', '4', '2'],
+            '/dev/sdd': ['2', '4', '3'], '/dev/sde': ['2', '1', '1'], '/dev/sdf': ['1']})
+        self.assertEqual(hubs, {'1': [('1.2', '/dev/sdb', (1, 0))],
+            '2.4': [('2', '/dev/sdc', (0, 1)), ('3', '/dev/sdd', (0, 0))]})
+
+
+    def test_get_topology(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.devices.mapping_file = os.path.join(tmp, 'mapping')
+            with open(self.devices.mapping_file, 'w') as f:
+                f.write('1.1\n1.2\n')
+            os.utime(self.devices.mapping_file, ns=(1, 1))
+            topology = self.devices.get_topology()
+            self.assertEqual(topology.default.ports, ('1.1', '1.2'))
+
+            '''Parsed again only when the file changes'''
+            with patch.object(self.devices, 'get_mappings', wraps=self.devices.get_mappings) as mock_get_mappings:
+                self.assertIs(self.devices.get_topology(), topology)
+                mock_get_mappings.assert_not_called()
+                with open(self.devices.mapping_file, 'w') as f:
+                    f.write('1.2\n1.1\n')
+                os.utime(self.devices.mapping_file, ns=(2, 2))
+                self.assertEqual(self.devices.get_topology().default.ports, ('1.2', '1.1'))
+                self.assertEqual(mock_get_mappings.call_count, 1)
+
+            '''The last parse is kept if the file goes away'''
+            os.remove(self.devices.mapping_file)
+            self.assertEqual(self.devices.get_topology().default.ports, ('1.2', '1.1'))
+
+    def test_get_registry(self):
+        self.assertIs(fd_devices.get_registry(), fd_devices.get_registry())
+        self.assertIs(FdDevice().devices, FdDevice().devices)
+        self.assertIs(ReplicatorMain().fd_devices, fd_devices.get_registry())
+
+
+class FakeCapacityProber(DeviceProber):
+    '''A stick that says it is bigger than it is: offsets wrap around at real_size'''
+    def __init__(self, real_size, **kwargs):
+        super().__init__(**kwargs)
+        self.real_size = real_size
+
+    def read_block(self, fd, offset, **kwargs):
+        return super().read_block(fd, offset % self.real_size, **kwargs)
+
+    def write_block(self, fd, data, offset):
+        super().write_block(fd, data, offset % self.real_size)
+
+
+class DeviceProberTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.device = os.path.join(self.tmp.name, 'device.img')
+        self.contents = os.urandom(1024 * 1024)
+        with open(self.device, 'wb') as f:
+            f.write(self.contents)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_device(self):
+        with open(self.device, 'rb') as f:
+            return f.read()
+
+    def test_get_offsets(self):
+        prober = DeviceProber(blocks=4, block_size=4096)
+        self.assertEqual(prober.get_offsets(10 * 4096 + 100), [0, 4096, 2 * 4096, 3 * 4096, 4 * 4096, 6 * 4096, 
+            8 * 4096, 9 * 4096])
+        self.assertEqual(prober.get_offsets(2 * 4096), [0, 4096])
+        self.assertEqual(prober.get_offsets(100), [])
+
+    def test_probe(self):
+        result = DeviceProber(blocks=8, block_size=65536, min_speed=0).probe(self.device)
+        self.assertEqual(result.size, 1024 * 1024)
+        self.assertEqual(result.bad_offsets, [])
+        self.assertGreater(result.write_speed, 0)
+        self.assertGreater(result.read_speed, 0)
+        self.assertFalse(result.flagged)
+        self.assertIn('MB/s', result.describe())
+        '''Left as it was'''
+        self.assertEqual(self.read_device(), self.contents)
+
+        result = DeviceProber(blocks=8, block_size=65536, min_speed=1e12).probe(self.device)
+        self.assertTrue(result.slow)
+        self.assertTrue(result.flagged)
+
+    def test_probe_speed_run(self):
+        '''The speeds are timed over one sequential write of speed_blocks blocks at the start of the device'''
+        prober = DeviceProber(blocks=8, block_size=65536, speed_blocks=4, min_speed=0)
+        with patch.object(prober, 'write_block', wraps=prober.write_block) as write_block:
+            result = prober.probe(self.device)
+        self.assertFalse(result.flagged)
+        data, offset = write_block.call_args_list[0][0][1:]
+        self.assertEqual((len(data), offset), (4 * 65536, 0))
+        self.assertEqual(self.read_device(), self.contents)
+        '''Cut short on a device smaller than the run'''
+        result = DeviceProber(blocks=8, block_size=65536, speed_blocks=32, min_speed=0).probe(self.device)
+        self.assertFalse(result.flagged)
+        self.assertEqual(self.read_device(), self.contents)
+
+    def test_probe_fake_capacity(self):
+        result = FakeCapacityProber(256 * 1024, blocks=8, block_size=65536, min_speed=0).probe(self.device)
+        self.assertTrue(result.fake)
+        self.assertTrue(result.flagged)
+        self.assertIn('fake capacity', result.describe())
+        self.assertEqual(self.read_device(), self.contents)
+
+    def test_probe_fake_capacity_sizes(self):
+        '''Sticks advertised as (GiB) holding only (GiB), in sparse files'''
+        GiB = 1024 ** 3
+        for advertised, real in ((64, 8), (32, 4), (128, 16), (64, 7.5)):
+            with open(self.device, 'wb') as f:
+                f.truncate(int(advertised * GiB))
+            result = FakeCapacityProber(int(real * GiB), block_size=65536, min_speed=0).probe(self.device)
+            self.assertTrue(result.fake, (advertised, real))
+        '''A genuine one'''
+        result = DeviceProber(block_size=65536, min_speed=0).probe(self.device)
+        self.assertFalse(result.flagged)
+
+    def test_probe_errors(self):
+        result = DeviceProber().probe(os.path.join(self.tmp.name, 'missing'))
+        self.assertTrue(result.error)
+        self.assertTrue(result.flagged)
+        result = DeviceProber(block_size=2 * 1024 * 1024).probe(self.device)
+        self.assertIn('Too small', result.error)
+
+    def test_probe_all(self):
+        results = DeviceProber(blocks=4, block_size=65536, min_speed=0, threads=2).probe_all([self.device, 
+            os.path.join(self.tmp.name, 'missing')])
+        self.assertFalse(results[self.device].flagged)
+        self.assertTrue(results[os.path.join(self.tmp.name, 'missing')].flagged)
+        self.assertEqual(DeviceProber().probe_all([]), {})
+
+
+def make_sysfs(sys_dir, name, sectors, usb_path, **attributes):
+    '''Add a disk to a fake sysfs tree: /sys/block/<name> linked to a SCSI device below its USB device'''
+    usb_dir = os.path.join(sys_dir, 'devices', 'pci0000:00', '0000:00:14.0', 'usb1', usb_path)
+    scsi_dir = os.path.join(usb_dir, f'{usb_path}:1.0', 'host0', 'target0:0:0', '0:0:0:0')
+    os.makedirs(scsi_dir)
+    for attribute, value in attributes.items():
+        with open(os.path.join(usb_dir, attribute), 'w') as f:
+            f.write(f'{value}\n')
+    block_dir = os.path.join(sys_dir, 'block', name)
+    os.makedirs(block_dir)
+    with open(os.path.join(block_dir, 'size'), 'w') as f:
+        f.write(f'{sectors}\n')
+    os.symlink(scsi_dir, os.path.join(block_dir, 'device'))
+
+
+class InventoryTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sys_dir = self.tmp.name
+        make_sysfs(self.sys_dir, 'sdb', 1000, '1-1.1', idVendor='0781', idProduct='5567', serial='AA01', speed='480',
+                version=' 2.00')
+        make_sysfs(self.sys_dir, 'sdc', 2000, '1-1.2', idVendor='0781', idProduct='5567', serial='AA01', speed='480',
+                version=' 3.20')
+        make_sysfs(self.sys_dir, 'sdd', 2000, '1-1.3', idVendor='0781', idProduct='5567', serial='AA02', speed='12')
+        self.inventory = Inventory(sys_dir=self.sys_dir)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read(self):
+        info = self.inventory.read('/dev/sdc')
+        self.assertEqual((info.size, info.speed, info.version, info.vendor_id, info.product_id, info.serial),
+                (1024000, 480, 3.2, '0781', '5567', 'AA01'))
+        info = self.inventory.read('/dev/sdd')
+        self.assertIsNone(info.version)
+        info = self.inventory.read('/dev/sdx')
+        self.assertEqual((info.size, info.speed, info.serial), (None, None, None))
+
+    def test_update(self):
+        with patch.object(self.inventory, 'read', wraps=self.inventory.read) as mock_read:
+            self.inventory.update({'/dev/sdb': ['1', '1'], '/dev/sdc': ['1', '2']})
+            self.assertEqual(mock_read.call_count, 2)
+            '''Only new devices, or devices on another port, are read again'''
+            self.inventory.update({'/dev/sdb': ['1', '1'], '/dev/sdc': ['1', '3']})
+            self.assertEqual(mock_read.call_count, 3)
+            self.assertEqual(self.inventory.get('/dev/sdc').usb_id, ['1', '3'])
+            self.inventory.update({'/dev/sdb': ['1', '1']})
+            self.assertEqual(list(self.inventory.devices), ['/dev/sdb'])
+            self.inventory.get('/dev/sdb')
+            self.assertEqual(mock_read.call_count, 3)
+
+    def test_preflight(self):
+        failures, warnings = preflight(['/dev/sdb', '/dev/sdc', '/dev/sdd', '/dev/sdx'], 600000, self.inventory)
+        self.assertEqual(list(failures), ['/dev/sdb'])
+        self.assertEqual(warnings, ['/dev/sdc: USB 3.2 stick on a 480 Mbit/s link', '/dev/sdd: slow USB link (12 Mbit/s)',
+            '/dev/sdx: capacity unknown', 'Serial number AA01 shared by /dev/sdb, /dev/sdc'])
+        failures, warnings = preflight(['/dev/sdb'], 100, self.inventory)
+        self.assertEqual((failures, warnings), ({}, []))
+
+
+class UsbTopologyTests(unittest.TestCase):
+    def test_layout(self):
+        ports = [f'{hub}.{port}' for hub in range(1, 41) for port in range(1, 8)]
+        topology = UsbTopology(['# station 4'] + ports + ['[3]', '1.1', '1.1', '1.2'], hub_rows=27,
+                hub_rows_by_port={'2': 10})
+        layout = topology.get_hub('1')
+        self.assertEqual(len(layout), 280)
+        self.assertEqual(layout.columns, 11)
+        self.assertEqual(layout.get_location('40.7'), (9, 10))
+        self.assertEqual(len(set(layout.get_positions())), 280)
+        self.assertIsNone(layout.get_location('41.1'))
+        self.assertEqual(topology.get_hub('2').columns, 28)
+
+        '''Section, with the duplicate ignored'''
+        self.assertEqual(topology.get_hub('3').ports, ('1.1', '1.2'))
+
+    def test_locate(self):
+        topology = UsbTopology(['1.1'])
+        self.assertEqual(topology.locate(['1', '4', '1', '1'], {'1', '1.4'}), ('1.4', '1.1'))
+        self.assertEqual(topology.locate(['1', '4', '1', '1'], {'1'}), ('1', '4.1.1'))
+        self.assertIsNone(topology.locate(['1'], {'1'}))
+        self.assertIsNone(topology.locate(['3', '1'], {'1'}))
+
 class FdDeviceTests(unittest.TestCase):
     def setUp(self):
         self.devices = Devices()
-        self.fd_device = FdDevice(port='1.2.3', device_dir='/foo/bar/')
+        self.mount_tmp = tempfile.TemporaryDirectory()
+        '''Never mount or unmount anything for real'''
+        native_patcher = patch('actions.mounts.NATIVE_MOUNT', False)
+        native_patcher.start()
+        self.addCleanup(native_patcher.stop)
+        self.fd_device = FdDevice(port='1.2.3', device_dir='/foo/bar/', mounts=MountManager(mount_dir=self.mount_tmp.name),
+                devices=self.devices)
+
+    def tearDown(self):
+        self.mount_tmp.cleanup()
+        fd_devices.os.path.isfile, fd_devices.os.path.isdir, fd_devices.os.path.realpath = OS_PATH_FUNCTIONS
 
     def test_get_device_from_port(self):
         self.fd_device.port = '1.2.6'
@@ -261,26 +545,32 @@ class FdDeviceTests(unittest.TestCase):
         self.fd_device.get_device_from_port() 
         self.assertEqual(self.fd_device.device, '/dev/sda')
 
-    @patch('actions.fd_devices.tempfile.mkdtemp', return_value='foo/bar')
-    def test_mount_device(self, mock_tempfile):
+    def test_mount_device(self):
         self.fd_device.check_call = MagicMock(return_value=0)
         results = self.fd_device.mount_device(device='/dev/sdb')
-        self.assertIsInstance(results, tuple)
-        self.assertEqual(results[0], 'foo/bar')
-        self.assertEqual(results[1], 0)
+        self.assertEqual(results, (os.path.join(self.mount_tmp.name, 'dev_sdb'), 0))
+        self.fd_device.check_call.assert_called_with(['mount', '-o', DEVICE_MOUNT_OPTIONS, '/dev/sdb', results[0]], 
+                timeout=30)
 
         self.fd_device.device = '/dev/sdc'
-        self.fd_device.check_call = MagicMock(return_value=0)
-        results = self.fd_device.mount_device()
-        self.assertIsInstance(results, tuple)
-        self.assertEqual(results[0], 'foo/bar')
-        self.assertEqual(results[1], 0)
+        results = self.fd_device.mount_device(options='ro')
+        self.assertEqual(results, (os.path.join(self.mount_tmp.name, 'dev_sdc'), 0))
+        self.fd_device.check_call.assert_called_with(['mount', '-o', 'ro', '/dev/sdc', results[0]], timeout=30)
 
         self.fd_device.check_call = MagicMock(return_value=1)
-        results = self.fd_device.mount_device(device='/dev/sdb')
-        self.assertIsInstance(results, tuple)
-        self.assertEqual(results[0], None)
-        self.assertEqual(results[1], 1)
+        results = self.fd_device.mount_device(device='/dev/sdd')
+        self.assertEqual(results, (None, 1))
+
+    def test_check_mountpoint_release(self):
+        '''A device mounted through the mount manager is released rather than unmounted by device'''
+        self.fd_device.device = '/dev/sdb'
+        self.fd_device.check_call = MagicMock(return_value=0)
+        mount_dir, _ = self.fd_device.mount_device()
+        self.assertEqual(self.fd_device.check_mountpoint(), 0)
+        self.fd_device.check_call.assert_called_with(['umount', mount_dir], timeout=30)
+        self.fd_device.check_call.reset_mock()
+        self.assertEqual(self.fd_device.check_mountpoint(), 32)
+        self.fd_device.check_call.assert_not_called()
 
     @patch('actions.fd_devices.os.makedirs',side_effect=OSError('OS Error'))
     @patch('actions.fd_devices.logging.info')
@@ -296,37 +586,412 @@ class FdDeviceTests(unittest.TestCase):
         files = self.fd_device.get_file_list()
         self.assertIsInstance(files, list)
         self.assertEqual(files, ['a.txt', 'b.txt'])
+        self.fd_device.mount_device.assert_called_with(options=SOURCE_MOUNT_OPTIONS)
+        self.fd_device.check_mountpoint.assert_called_with()
 
         self.fd_device.mount_device = MagicMock(return_value=(None, 1))
         self.fd_device.check_mountpoint = MagicMock(return_value=0)
         files = self.fd_device.get_file_list()
         self.assertEqual(files, None)
 
-    @patch('actions.fd_devices.time.time')
-    @patch('actions.fd_devices.logging.info')
-    @patch('actions.fd_devices.hashlib')
-    @patch('actions.fd_devices.os.walk',return_value=[('.', ['a', 'b'], ['a.txt']), ('./a', [], ['1.txt', '2.txt', '3.txt']), ('./b', [], ['4.txt', '5.txt', '6.txt'])])     
-    @patch('actions.fd_devices.os.path.join')
-    @patch('actions.fd_devices.open')
-    def test_create_checksums_files(self, mock_open, mock_join, mock_walk, mock_hashlib, mock_info, mock_time):
-        self.fd_device.device_dir = '/foo/bar'
-        md5_test = hashlib.md5(string.ascii_letters.encode())
-        mock_hashlib.md5 = MagicMock(return_value=md5_test)
-        self.fd_device.calculate_and_emit = MagicMock()
-        self.fd_device.count_files = MagicMock(return_value=100)
-        mdsums = self.fd_device.create_checksums_files(source_dir='/foo/bar')
-        self.assertEqual(mdsums[0], 'a.txt ' + md5_test.hexdigest())
+    @patch('actions.fd_devices.os.statvfs')
+    def test_get_payload_size(self, mock_statvfs):
+        mock_statvfs.return_value = os.statvfs_result((4096, 4096, 100, 40, 40, 0, 0, 0, 0, 255))
+        self.fd_device.mount_device = MagicMock(return_value=('/foo/bar', 0))
+        self.fd_device.check_mountpoint = MagicMock(return_value=0)
+        self.assertEqual(self.fd_device.get_payload_size(copy_mode='fan_out'), 60 * 4096)
+        self.fd_device.mount_device.assert_called_with(options=SOURCE_MOUNT_OPTIONS)
+        self.fd_device.check_mountpoint.assert_called_with()
+
+        self.fd_device.mount_device = MagicMock(return_value=(None, 1))
+        self.assertIsNone(self.fd_device.get_payload_size(copy_mode='fan_out'))
+
+        '''A raw clone needs the extent of the image'''
+        with tempfile.TemporaryDirectory() as tmp:
+            self.fd_device.device = os.path.join(tmp, 'source.img')
+            with open(self.fd_device.device, 'wb') as f:
+                f.truncate(1024 * 1024)
+            with patch('actions.fd_devices.get_image_extent', return_value=(1000, 2000)) as mock_extent:
+                self.assertEqual(self.fd_device.get_payload_size(copy_mode='image'), 2000)
+                self.assertEqual(mock_extent.call_args[0][1], 1024 * 1024)
+        self.assertIsNone(self.fd_device.get_payload_size(copy_mode='image'))
+
+    def test_create_checksums_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'a'))
+            for rel_path, data in (('a.txt', string.ascii_letters.encode()), (os.path.join('a', '1.txt'), b'x' * 300)):
+                with open(os.path.join(tmp, rel_path), 'wb') as f:
+                    f.write(data)
+            self.fd_device.calculate_and_emit = MagicMock()
+            self.fd_device.hash_engine = HashEngine(chunk_size=100)
+            mdsums = self.fd_device.create_checksums_files(source_dir=tmp)
+            self.assertEqual(mdsums, {'a.txt': hashlib.md5(string.ascii_letters.encode()).hexdigest(),
+                os.path.join('a', '1.txt'): hashlib.md5(b'x' * 300).hexdigest()})
+            self.assertEqual(self.fd_device.num_files, 2)
+            '''Progress is in bytes, and only emitted when the percentage changes'''
+            self.fd_device.calculate_and_emit.assert_called_with(352, 352, pc=50, adj=50)
+            self.assertEqual(self.fd_device.calculate_and_emit.call_count, 4)
+
+            '''The same checksums, and all the bytes counted, with a pool of hashing threads'''
+            self.fd_device.calculate_and_emit.reset_mock()
+            self.assertEqual(self.fd_device.create_checksums_files(source_dir=tmp, workers=4), mdsums)
+            self.fd_device.calculate_and_emit.assert_called_with(352, 352, pc=50, adj=50)
+
+            self.fd_device.hash_engine.hash_file = MagicMock(side_effect=OSError('I/O error'))
+            self.assertEqual(self.fd_device.create_checksums_files(source_dir=tmp), 1)
+            self.assertEqual(self.fd_device.create_checksums_files(source_dir=tmp, workers=4), 1)
+
+    def test_create_checksums_files_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_dir = os.path.join(tmp, 'source')
+            os.makedirs(os.path.join(source_dir, 'a'))
+            for rel_path in ('a.txt', os.path.join('a', 'a.txt')):
+                with open(os.path.join(source_dir, rel_path), 'wb') as f:
+                    f.write(rel_path.encode())
+            self.fd_device.calculate_and_emit = MagicMock()
+            cache_file = os.path.join(tmp, 'cache.json')
+            mdsums = self.fd_device.create_checksums_files(source_dir=source_dir, 
+                    cache=ManifestCache('1234-ABCD', cache_file=cache_file))
+
+            '''Second run: nothing is rehashed, unless it changed'''
+            self.fd_device.hash_engine.hash_file = MagicMock()
+            cache = ManifestCache('1234-ABCD', cache_file=cache_file)
+            self.assertEqual(self.fd_device.create_checksums_files(source_dir=source_dir, cache=cache), mdsums)
+            self.fd_device.hash_engine.hash_file.assert_not_called()
+            self.assertEqual(cache.hits, 2)
+
+            with open(os.path.join(source_dir, 'a', 'a.txt'), 'ab') as f:
+                f.write(b'changed')
+            self.fd_device.hash_engine.hash_file = MagicMock(return_value='1234')
+            self.fd_device.create_checksums_files(source_dir=source_dir, cache=ManifestCache('1234-ABCD', cache_file=cache_file))
+            self.fd_device.hash_engine.hash_file.assert_called_once_with(os.path.join(source_dir, 'a', 'a.txt'), 
+                    progress=unittest.mock.ANY, tree=None)
+
+    def test_create_checksums_files_blocks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_file = os.path.join(tmp, 'cache.json')
+            tmp = os.path.join(tmp, 'source')
+            os.makedirs(tmp)
+            files = {'big.bin': os.urandom(5 * 4096 + 5), 'small.bin': os.urandom(2 * 4096)}
+            for rel_path, data in files.items():
+                with open(os.path.join(tmp, rel_path), 'wb') as f:
+                    f.write(data)
+            self.fd_device.calculate_and_emit = MagicMock()
+            blocks = SourceBlocks(block_size=4096)
+            mdsums = self.fd_device.create_checksums_files(source_dir=tmp, blocks=blocks, workers=2,
+                    cache=ManifestCache('1234-ABCD', cache_file=cache_file))
+            self.assertEqual(mdsums['big.bin'], hashlib.md5(files['big.bin']).hexdigest())
+            '''Only files of more than two blocks have their blocks kept'''
+            big = files['big.bin']
+            self.assertEqual(blocks.files, {'big.bin': [hashlib.md5(big[i:i + 4096]).hexdigest() for i in range(0, len(big), 4096)]})
+
+            '''The blocks are cached with the digest, so the next run doesn't read the files'''
+            self.fd_device.hash_engine.hash_file = MagicMock()
+            cached = SourceBlocks(block_size=4096)
+            self.assertEqual(self.fd_device.create_checksums_files(source_dir=tmp, blocks=cached,
+                    cache=ManifestCache('1234-ABCD', cache_file=cache_file)), mdsums)
+            self.fd_device.hash_engine.hash_file.assert_not_called()
+            self.assertEqual(cached.files, blocks.files)
+
+            '''Cached blocks of another size don't count'''
+            self.fd_device.hash_engine.hash_file = MagicMock(return_value=mdsums['big.bin'])
+            self.fd_device.create_checksums_files(source_dir=tmp, blocks=SourceBlocks(block_size=2 * 4096),
+                    cache=ManifestCache('1234-ABCD', cache_file=cache_file))
+            self.fd_device.hash_engine.hash_file.assert_called_once_with(os.path.join(tmp, 'big.bin'), 
+                    progress=unittest.mock.ANY, tree=unittest.mock.ANY)
+
+    @patch('actions.fd_devices.MANIFEST_CACHE', True)
+    @patch('actions.fd_devices.ManifestCache')
+    def test_get_manifest_cache(self, mock_ManifestCache):
+        self.fd_device.device = None
+        self.assertEqual(self.fd_device.get_manifest_cache(), None)
+        with tempfile.TemporaryDirectory() as tmp:
+            self.fd_device.device = os.path.join(tmp, 'device')
+            with open(self.fd_device.device, 'wb') as f:
+                f.write(make_fat_boot_sector(5073, 20, root_entries=512))
+            self.assertEqual(self.fd_device.get_manifest_cache(), mock_ManifestCache.return_value)
+            mock_ManifestCache.assert_called_with('0000-0000')
 
     def test_compare_checksums_files(self):
-        checksums = ['seg-221.m4s c59b6068f8e29144a8843dae91417a46', 'seg-222.m4s d303ee4ea9b83b23bd8ef575ba91e0c9', 'seg-224.m4s fd938e0661353df437cf71297f614e79', 'seg-223.m4s 19fcaa424456d3daf69e9e63d7c8cae4', 'seg-225.m4s f35f8f20db85b49abbd4204ba767d710', 'seg-226.m4s 10061ed9b33de483c5757d075e8c4eba', 'seg-227.m4s d58560ecc2d37039ab190c3f1be4aed7', 'seg-228.m4s ba4 2fb9edf72c11f92395b646baa74d', 'seg-229.m4s ee2dd1ee204d471bac4764a1f611c973', 'seg-230.m4s 9af2ec530ddf9feeea9241dd7da9ce21', 'seg-233.m4s fc5d352bbedd7327b00e034a5f33f79c', 'seg-231.m4s 4990ffd97e014b5e315671c26195744d', 'seg-232.m4s 4a2e62338083729cd114ddcf4685e00b']
-        bad_checksums = ['seg-221.m4s c59b6068f8e29144a8843dae91417a46', 'seg-222.m4s d303ee4ea9b83b23bd8ef575ba91e0c9', 'seg-224.m4s fd938e0661353df437cf71297f614e79', 'seg-223.m4s 41caab57470a3696c106f7edd0e79ad5', 'seg-225.m4s f35f8f20db85b49abbd4204ba767d710', 'seg-226.m4s 10061ed9b33de483c5757d075e8c4eba', 'seg-227.m4s d58560ecc2d37039ab190c3f1be4aed7', 'seg-228.m4s ba4 2fb9edf72c11f92395b646baa74d', 'seg-229.m4s ee2dd1ee204d471bac4764a1f611c973', 'seg-230.m4s 9af2ec530ddf9feeea9241dd7da9ce21', 'seg-233.m4s fc5d352bbedd7327b00e034a5f33f79c', 'seg-231.m4s 4990ffd97e014b5e315671c26195744d', 'seg-232.m4s 4a2e62338083729cd114ddcf4685e00b']
-        self.fd_device.source_mdsums = checksums
-        self.fd_device.create_checksums_files = MagicMock(return_value=checksums)
-        status = self.fd_device.compare_checksums_files('/tmp/tmpb8y1qgwb')
-        self.assertEqual(status, 0)
-        self.fd_device.create_checksums_files = MagicMock(return_value=bad_checksums)
-        status = self.fd_device.compare_checksums_files('/tmp/tmpb8y1qgwb')
-        self.assertEqual(status, 1)
+        files = {'seg-221.m4s': b'221', 'seg-222.m4s': b'222', 'a/seg-223.m4s': b'a223', 'b/seg-223.m4s': b'b223',
+                'a.m4s': b'a'}
+        checksums = {rel_path: hashlib.md5(data).hexdigest() for rel_path, data in files.items()}
+        with tempfile.TemporaryDirectory() as tmp:
+            for rel_path, data in files.items():
+                os.makedirs(os.path.dirname(os.path.join(tmp, rel_path)), exist_ok=True)
+                with open(os.path.join(tmp, rel_path), 'wb') as f:
+                    f.write(data)
+            self.fd_device.calculate_and_emit = MagicMock()
+            self.fd_device.source_index = SourceIndex(tmp)
+            for source_mdsums in (checksums, PackedManifest(checksums)):
+                self.fd_device.source_mdsums = source_mdsums
+                status = self.fd_device.compare_checksums_files(tmp)
+                self.assertEqual(status, 0)
+                self.assertEqual((self.fd_device.bad_files, self.fd_device.extra_files), ([], []))
+            self.fd_device.calculate_and_emit.assert_called_with(sum(map(len, files.values())), 
+                    sum(map(len, files.values())), pc=50, adj=50)
+
+            '''Files with the same name in different directories are told apart'''
+            with open(os.path.join(tmp, 'a/seg-223.m4s'), 'wb') as f:
+                f.write(files['b/seg-223.m4s'])
+            os.remove(os.path.join(tmp, 'seg-222.m4s'))
+            with open(os.path.join(tmp, 'seg-224.m4s'), 'wb') as f:
+                f.write(b'224')
+            status = self.fd_device.compare_checksums_files(tmp)
+            self.assertEqual(status, 1)
+            self.assertEqual(self.fd_device.bad_files, ['a/seg-223.m4s', 'seg-222.m4s'])
+            self.assertEqual(self.fd_device.extra_files, ['seg-224.m4s'])
+
+            self.fd_device.hash_engine.hash_file = MagicMock(side_effect=OSError('I/O error'))
+            self.assertEqual(self.fd_device.compare_checksums_files(tmp), 1)
+
+    def test_repair_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_dir = os.path.join(tmp, 'source')
+            dest_dir = os.path.join(tmp, 'dest')
+            files = {'a.txt': b'a' * 100, os.path.join('b', 'a.txt'): b'b' * 100, 'c.txt': b'c' * 100}
+            for directory in (source_dir, dest_dir):
+                os.makedirs(os.path.join(directory, 'b'))
+                for rel_path, data in files.items():
+                    with open(os.path.join(directory, rel_path), 'wb') as f:
+                        f.write(data)
+            with open(os.path.join(dest_dir, 'c.txt'), 'wb') as f:
+                f.write(b'corrupted')
+            os.remove(os.path.join(dest_dir, 'b', 'a.txt'))
+            os.rmdir(os.path.join(dest_dir, 'b'))
+            with open(os.path.join(dest_dir, 'extra.txt'), 'wb') as f:
+                f.write(b'extra')
+            self.fd_device.source_dir = source_dir
+            self.fd_device.source_mdsums = {rel_path: hashlib.md5(data).hexdigest() for rel_path, data in files.items()}
+            self.fd_device.calculate_and_emit = MagicMock()
+            self.assertEqual(self.fd_device.compare_checksums_files(dest_dir), 1)
+
+            self.fd_device.copy_engine = CopyEngine()
+            self.fd_device.copy_engine.copy_file = MagicMock(wraps=self.fd_device.copy_engine.copy_file)
+            self.assertEqual(self.fd_device.repair_files(dest_dir), 0)
+            '''Only the bad files are copied again'''
+            self.assertEqual(sorted(c.args[0] for c in self.fd_device.copy_engine.copy_file.call_args_list), 
+                    [os.path.join(source_dir, 'b', 'a.txt'), os.path.join(source_dir, 'c.txt')])
+            self.assertEqual(self.fd_device.compare_checksums_files(dest_dir), 0)
+
+            '''Gives up after retries attempts'''
+            self.fd_device.bad_files = ['c.txt']
+            self.fd_device.hash_engine.hash_file = MagicMock(return_value='123')
+            self.fd_device.copy_engine.copy_file.reset_mock()
+            self.assertEqual(self.fd_device.repair_files(dest_dir, retries=3), 1)
+            self.assertEqual(self.fd_device.copy_engine.copy_file.call_count, 3)
+
+    def test_verify_readback(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_dir = os.path.join(tmp, 'source')
+            dest_dir = os.path.join(tmp, 'dest')
+            files = {'a.txt': b'a' * 100, 'b.txt': b'b' * 100, 'c.txt': b'c' * 100}
+            for directory in (source_dir, dest_dir):
+                os.makedirs(directory)
+                for rel_path, data in files.items():
+                    with open(os.path.join(directory, rel_path), 'wb') as f:
+                        f.write(data)
+            self.fd_device.set_copy_options('/dev/sdz', source_dir, checksums=True, readback=True)
+            self.fd_device.source_mdsums = {rel_path: hashlib.md5(data).hexdigest() for rel_path, data in files.items()}
+            self.fd_device.calculate_and_emit = MagicMock()
+            self.assertEqual(self.fd_device.compare_checksums_files(dest_dir), 0)
+            self.fd_device.calculate_and_emit.assert_called_with(300, 300, pc=50, adj=50)
+
+            '''Stops at the first mismatch'''
+            for rel_path in ('b.txt', 'c.txt'):
+                with open(os.path.join(dest_dir, rel_path), 'wb') as f:
+                    f.write(b'corrupted')
+            self.assertEqual(self.fd_device.compare_checksums_files(dest_dir), 1)
+            self.assertEqual(self.fd_device.bad_files, ['b.txt'])
+            self.assertTrue(self.fd_device.verify_incomplete)
+
+            '''So the repair verifies everything again, and finds the second one'''
+            self.assertEqual(self.fd_device.repair_files(dest_dir), 0)
+            self.assertEqual(self.fd_device.compare_checksums_files(dest_dir), 0)
+            with open(os.path.join(dest_dir, 'c.txt'), 'rb') as f:
+                self.assertEqual(f.read(), files['c.txt'])
+
+    def test_verify_sampled(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_dir = os.path.join(tmp, 'source')
+            dest_dir = os.path.join(tmp, 'dest')
+            files = {'a.txt': os.urandom(10 * 4096), 'b.txt': b'b' * 100}
+            for directory in (source_dir, dest_dir):
+                os.makedirs(directory)
+                for rel_path, data in files.items():
+                    with open(os.path.join(directory, rel_path), 'wb') as f:
+                        f.write(data)
+            self.fd_device.calculate_and_emit = MagicMock()
+            self.fd_device.source_blocks = SourceBlocks(block_size=4096)
+            self.fd_device.source_mdsums = self.fd_device.create_checksums_files(source_dir=source_dir,
+                    blocks=self.fd_device.source_blocks)
+            self.fd_device.source_index = SourceIndex(source_dir)
+            '''The source is not read again: the sample is compared with the digests of its blocks'''
+            for rel_path in files:
+                os.remove(os.path.join(source_dir, rel_path))
+            self.fd_device.set_copy_options('/dev/sdz', source_dir, checksums=True, sample=0.25)
+            self.fd_device.calculate_and_emit.reset_mock()
+            verifier = SampledVerifier(fraction=0.25, block_size=4096, rng=random.Random(1))
+            self.assertEqual(self.fd_device.verify_sampled(dest_dir, verifier=verifier), 0)
+            '''First, last and 2 of the 8 other blocks of a.txt, and all of b.txt'''
+            self.assertEqual((verifier.blocks_checked, verifier.bytes_checked, verifier.bytes_total), 
+                    (5, 4 * 4096 + 100, 10 * 4096 + 100))
+            self.fd_device.calculate_and_emit.assert_called_with(10 * 4096, 41060, pc=50, adj=50)
+
+            '''Sizes are always checked'''
+            with open(os.path.join(dest_dir, 'b.txt'), 'ab') as f:
+                f.write(b'b')
+            self.assertEqual(self.fd_device.compare_checksums_files(dest_dir), 1)
+            self.assertEqual(self.fd_device.bad_files, ['b.txt'])
+            with open(os.path.join(dest_dir, 'b.txt'), 'wb') as f:
+                f.write(files['b.txt'])
+
+            '''The last block is always sampled'''
+            with open(os.path.join(dest_dir, 'a.txt'), 'r+b') as f:
+                f.seek(10 * 4096 - 1)
+                f.write(b'x')
+            self.assertEqual(self.fd_device.compare_checksums_files(dest_dir), 1)
+            self.assertEqual(self.fd_device.bad_files, ['a.txt'])
+            self.assertTrue(self.fd_device.verify_incomplete)
+
+    def test_sync_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_dir = os.path.join(tmp, 'source')
+            dest_dir = os.path.join(tmp, 'dest')
+            for directory in (source_dir, dest_dir):
+                os.makedirs(os.path.join(directory, 'a'))
+            source = {'same.txt': b'same', os.path.join('a', 'changed.txt'): b'newer', 'touched.txt': b'touched', 
+                    os.path.join('new', 'new.txt'): b'new'}
+            dest = {'same.txt': b'same', os.path.join('a', 'changed.txt'): b'old', 'touched.txt': b'touched', 
+                    os.path.join('old', 'old.txt'): b'old'}
+            for directory, files in ((source_dir, source), (dest_dir, dest)):
+                for rel_path, data in files.items():
+                    os.makedirs(os.path.join(directory, os.path.dirname(rel_path)), exist_ok=True)
+                    with open(os.path.join(directory, rel_path), 'wb') as f:
+                        f.write(data)
+                    os.utime(os.path.join(directory, rel_path), ns=(0, 1600000000 * 10 ** 9))
+            '''Same size and contents, only the time differs: checked with the checksum'''
+            os.utime(os.path.join(dest_dir, 'touched.txt'), ns=(0, 1700000000 * 10 ** 9))
+            self.fd_device.set_copy_options('/dev/sdz', source_dir, checksums=True, sync=True)
+            self.fd_device.device_dir = dest_dir
+            self.fd_device.source_mdsums = {'touched.txt': hashlib.md5(b'touched').hexdigest()}
+            self.fd_device.calculate_and_emit = MagicMock()
+            self.fd_device.copy_engine = CopyEngine()
+            self.fd_device.copy_engine.copy_file = MagicMock(wraps=self.fd_device.copy_engine.copy_file)
+
+            self.assertEqual(self.fd_device.sync_files(), 0)
+            self.assertEqual(sorted(c.args[0] for c in self.fd_device.copy_engine.copy_file.call_args_list), 
+                    [os.path.join(source_dir, 'a', 'changed.txt'), os.path.join(source_dir, 'new', 'new.txt')])
+            self.assertEqual(SourceIndex(dest_dir).dirs, SourceIndex(source_dir).dirs)
+            for rel_path, data in source.items():
+                with open(os.path.join(dest_dir, rel_path), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+                self.assertEqual(os.stat(os.path.join(dest_dir, rel_path)).st_mtime_ns, 1600000000 * 10 ** 9)
+
+            '''Nothing to do the second time'''
+            self.fd_device.copy_engine.copy_file.reset_mock()
+            self.fd_device.hash_engine.hash_file = MagicMock()
+            self.assertEqual(self.fd_device.sync_files(), 0)
+            self.fd_device.copy_engine.copy_file.assert_not_called()
+            self.fd_device.hash_engine.hash_file.assert_not_called()
+
+    def test_copy_files_to_device_sync(self):
+        self.fd_device.sync = True
+        self.fd_device.prepare_device = MagicMock(return_value=0)
+        self.fd_device.sync_files = MagicMock(return_value=0)
+        self.fd_device.copy_files = MagicMock(return_value=0)
+        self.fd_device.finish_device = MagicMock(return_value=0)
+        self.assertEqual(self.fd_device.copy_files_to_device(), 0)
+        self.fd_device.prepare_device.assert_called_with(delete=False)
+        self.fd_device.sync_files.assert_called()
+        self.fd_device.copy_files.assert_not_called()
+
+    def test_stamp(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.fd_device.device = os.path.join(tmp, 'device')
+            self.fd_device.device_dir = os.path.join(tmp, 'mount')
+            os.makedirs(self.fd_device.device_dir)
+            boot_sector = bytearray(make_fat_boot_sector(5073, 20, root_entries=512))
+            boot_sector[39:43] = (0x1234abcd).to_bytes(4, 'little')
+            with open(self.fd_device.device, 'wb') as f:
+                f.write(boot_sector + bytes(100 * 512))
+            self.fd_device.manifest_id = None
+            self.assertEqual(self.fd_device.write_stamp(), 0)
+            self.assertFalse(os.path.exists(os.path.join(self.fd_device.device_dir, STAMP_FILE)))
+
+            self.fd_device.manifest_id = 'abc'
+            self.assertEqual(self.fd_device.write_stamp(), 0)
+            with open(os.path.join(self.fd_device.device_dir, STAMP_FILE)) as f:
+                stamp = json.load(f)
+            self.assertEqual((stamp['manifest_id'], stamp['volume_id']), ('abc', '1234-ABCD'))
+
+            with patch('actions.fd_devices.read_fat_root_file', return_value=json.dumps(stamp).encode()):
+                self.assertTrue(self.fd_device.check_stamp())
+                self.fd_device.manifest_id = 'def'
+                self.assertFalse(self.fd_device.check_stamp())
+            '''Another volume with a copy of the stamp'''
+            stamp['volume_id'] = '1234-ABCE'
+            self.fd_device.manifest_id = 'abc'
+            with patch('actions.fd_devices.read_fat_root_file', return_value=json.dumps(stamp).encode()):
+                self.assertFalse(self.fd_device.check_stamp())
+            with patch('actions.fd_devices.read_fat_root_file', return_value=None):
+                self.assertFalse(self.fd_device.check_stamp())
+
+    def test_copy_stamped(self):
+        self.fd_device.check_stamp = MagicMock(return_value=True)
+        self.fd_device.copy_files_to_device = MagicMock(return_value=0)
+        self.fd_device.emit = MagicMock()
+        self.assertEqual(self.fd_device.copy('/dev/sdz', '/tmp/source', checksums=True), 0)
+        self.fd_device.copy_files_to_device.assert_not_called()
+        self.fd_device.emit.assert_called_with(100)
+
+    def test_get_manifest_id(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'a.txt'), 'wb') as f:
+                f.write(b'a')
+            self.fd_device.device_dir = tmp
+            manifest_id = self.fd_device.get_manifest_id()
+            self.assertEqual(manifest_id, self.fd_device.get_manifest_id())
+            with open(os.path.join(tmp, 'a.txt'), 'ab') as f:
+                f.write(b'a')
+            self.assertNotEqual(manifest_id, self.fd_device.get_manifest_id())
+
+    def test_finish_device_repair(self):
+        self.fd_device.checksums = True
+        self.fd_device.compare_checksums_files = MagicMock(return_value=1)
+        self.fd_device.repair_files = MagicMock(return_value=0)
+        self.fd_device.check_mountpoint = MagicMock(return_value=0)
+        self.fd_device.remove_temp_dir = MagicMock(return_value=0)
+        self.fd_device.bad_files = ['a.txt']
+        self.assertEqual(self.fd_device.finish_device(), 0)
+        self.fd_device.repair_files = MagicMock(return_value=1)
+        self.assertEqual(self.fd_device.finish_device(), 1)
+        '''Nothing to repair if the device couldn't be read'''
+        self.fd_device.bad_files = []
+        self.fd_device.repair_files.reset_mock()
+        self.assertEqual(self.fd_device.finish_device(), 1)
+        self.fd_device.repair_files.assert_not_called()
+
+    def test_finish_device_stamp(self):
+        self.fd_device.compare_checksums_files = MagicMock(return_value=0)
+        self.fd_device.check_mountpoint = MagicMock(return_value=0)
+        self.fd_device.write_stamp = MagicMock(return_value=0)
+        self.fd_device.checksums = True
+        self.assertEqual(self.fd_device.finish_device(), 0)
+        self.fd_device.write_stamp.assert_called_once_with()
+
+        '''Not when the copy wasn't verified'''
+        self.fd_device.write_stamp.reset_mock()
+        self.fd_device.checksums = False
+        self.assertEqual(self.fd_device.finish_device(), 0)
+        self.fd_device.write_stamp.assert_not_called()
+        self.fd_device.check_mountpoint.assert_called()
+
+        '''Nor when it failed verification'''
+        self.fd_device.checksums = True
+        self.fd_device.compare_checksums_files = MagicMock(return_value=1)
+        self.assertEqual(self.fd_device.finish_device(), 1)
+        self.fd_device.write_stamp.assert_not_called()
 
     @patch('actions.fd_devices.os.walk', return_value=[('./a', [], ['1.txt', '2.txt', '3.txt']), 
             ('./b', [], ['4.txt', '5.txt', '6.txt']), ('.', ['a', 'b'], ['a.txt'])]) 
@@ -371,17 +1036,6 @@ class FdDeviceTests(unittest.TestCase):
         status = self.fd_device.delete_ignored(directory='/foo/bar')
         self.assertEqual(status, 1)
 
-    @patch('actions.fd_devices.os.walk', return_value=[('./a', [], ['1.txt', '2.txt', '3.txt']), 
-            ('./b', [], ['4.txt', '5.txt', '6.txt']), ('.', ['a', 'b'], ['a.txt'])])
-    def test_count_files(self, mock_walk):
-        fd_devices.os.path.isdir = MagicMock(return_value=True)
-        #fd_devices.os.walk = MagicMock(return_value=[('./a', [], ['1.txt', '2.txt', '3.txt']), 
-        #    ('./b', [], ['4.txt', '5.txt', '6.txt']), ('.', ['a', 'b'], ['a.txt'])])
-        num_files = self.fd_device.count_files('/foo/bar')
-        self.assertEqual(num_files, 7)
-        mock_walk.assert_called()
-
-
     @patch('actions.fd_devices.os.path.exists', return_value=False)
     @patch('actions.fd_devices.os.makedirs', side_effect=OSError())
     @patch('actions.fd_devices.logging.info')
@@ -402,23 +1056,37 @@ class FdDeviceTests(unittest.TestCase):
         self.fd_device.calculate_and_emit(10, 100, adj=50, pc=50)
         self.assertEqual(self.x, 55)
     
-    @patch('actions.fd_devices.os.walk', return_value=[('/tmp/sda/a', [], ['1.txt', '2.txt', '3.txt']), 
-            ('/tmp/sda/b', [], ['4.txt', '5.txt', '6.txt']), ('/tmp/sda', ['a', 'b'], ['a.txt'])])
-    @patch('actions.fd_devices.shutil.copy')
-    def test_copy_files(self, mock_copy, mock_walk):
-        self.fd_device.source_dir = '/tmp/sda'
-        self.fd_device.dest_dir = '/tmp/sdb'
-        self.fd_device.count_files = MagicMock(return_value=10)
-        self.fd_device.makedirs = MagicMock()
-        self.fd_device.calculate_and_emit = MagicMock()
-        self.fd_device.checksums = MagicMock(return_value=True)
-
-        status = self.fd_device.copy_files()
-        mock_walk.assert_called_with(self.fd_device.source_dir)
-        self.assertEqual(status, 0)
-        self.fd_device.calculate_and_emit.assert_called()
-
-        self.assertEqual(self.fd_device.calculate_and_emit.call_count, 7)
+    def test_copy_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_dir = os.path.join(tmp, 'source')
+            files = {'a.txt': b'a' * 100, os.path.join('b', '1.txt'): b'1' * 300, os.path.join('b', 'c', '2.txt'): b''}
+            os.makedirs(os.path.join(source_dir, 'b', 'c'))
+            os.makedirs(os.path.join(source_dir, 'empty'))
+            for rel_path, data in files.items():
+                with open(os.path.join(source_dir, rel_path), 'wb') as f:
+                    f.write(data)
+            self.fd_device.source_dir = source_dir
+            self.fd_device.device_dir = os.path.join(tmp, 'dest')
+            self.fd_device.source_index = SourceIndex(source_dir)
+            self.fd_device.calculate_and_emit = MagicMock()
+            self.fd_device.checksums = False
+
+            with patch('actions.fd_devices.os.walk') as mock_walk, patch('actions.source_index.os.scandir') as mock_scandir:
+                status = self.fd_device.copy_files()
+            '''The shared index is used, the source isn't scanned again'''
+            mock_walk.assert_not_called()
+            mock_scandir.assert_not_called()
+            self.assertEqual(status, 0)
+            self.assertTrue(os.path.isdir(os.path.join(tmp, 'dest', 'empty')))
+            for rel_path, data in files.items():
+                with open(os.path.join(tmp, 'dest', rel_path), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            '''Progress by bytes: the empty file adds none'''
+            self.assertEqual([c.args[:2] for c in self.fd_device.calculate_and_emit.call_args_list], [(100, 400), (400, 400)])
+
+            self.fd_device.copy_engine.copy_file = MagicMock(side_effect=OSError('No space left on device'))
+            status = self.fd_device.copy_files()
+            self.assertEqual(status, 1)
 
     @patch('actions.fd_devices.subprocess.check_call', side_effect=[0, 0, 0, OSError('OS Error')])
     @patch('actions.fd_devices.logging.info')
@@ -461,16 +1129,40 @@ class FdDeviceTests(unittest.TestCase):
         mount_dir = '/foo/bar'
         device = '/dev/sdf'
         self.fd_device.check_call = MagicMock(return_value=0)
-        status = self.fd_device.check_mountpoint(mount_dir=mount_dir, device=device)
-        self.assertIn(call(['umount', '/foo/bar'], timeout=30), self.fd_device.check_call.mock_calls)
-        self.assertIn(call(['mountpoint', '-q', '/foo/bar'], timeout=30), self.fd_device.check_call.mock_calls)
-        self.assertEqual(status, 0)
-
-        status = self.fd_device.check_mountpoint(device=device)
-        self.assertEqual(status, 0)
-        self.assertIn(call(['umount', '/dev/sdf'], timeout=30), self.fd_device.check_call.mock_calls)
+        with patch('actions.fd_devices.mount_table') as mock_mount_table:
+            mock_mount_table.is_mountpoint.return_value = True
+            mock_mount_table.get_mount_dirs.return_value = ['/media/sdf', '/foo/sdf']
+            status = self.fd_device.check_mountpoint(mount_dir=mount_dir, device=device)
+            self.fd_device.check_call.assert_called_with(['umount', '/foo/bar'], timeout=30)
+            self.assertEqual(status, 0)
+
+            status = self.fd_device.check_mountpoint(device=device)
+            self.assertEqual(status, 0)
+            mock_mount_table.get_mount_dirs.assert_called_with(device)
+            self.fd_device.check_call.assert_called_with(['umount', '/media/sdf'], timeout=30)
+
+            '''Nothing to unmount'''
+            self.fd_device.check_call.reset_mock()
+            mock_mount_table.is_mountpoint.return_value = False
+            mock_mount_table.get_mount_dirs.return_value = []
+            self.assertEqual(self.fd_device.check_mountpoint(mount_dir=mount_dir), 1)
+            self.assertEqual(self.fd_device.check_mountpoint(device=device), 32)
+            self.fd_device.check_call.assert_not_called()
         
     
+    def test_unmount_partitions(self):
+        self.fd_device.device = '/dev/sdb'
+        self.fd_device.get_mounts = MagicMock(return_value=[('/dev/sda1', '/'), ('/dev/sdb1', '/tmp/a'),
+            ('/dev/sdb', '/tmp/b'), ('/dev/sdbb1', '/tmp/c')])
+        self.fd_device.check_mountpoint = MagicMock(return_value=0)
+        status = self.fd_device.unmount_partitions()
+        self.assertEqual(status, 0)
+        self.assertEqual(self.fd_device.check_mountpoint.mock_calls, [call(mount_dir='/tmp/a'), call(mount_dir='/tmp/b')])
+
+        self.fd_device.check_mountpoint = MagicMock(return_value=1)
+        status = self.fd_device.unmount_partitions()
+        self.assertEqual(status, 1)
+
     @patch('actions.fd_devices.logging.info')
     def test_copy_files_to_device(self, mock_info):
         self.fd_device.device = '/dev/sda'
@@ -495,21 +1187,51 @@ class FdDeviceTests(unittest.TestCase):
         status = self.fd_device.copy_files_to_device()
         self.assertEqual(status, 1)
 
-    @patch('actions.fd_devices.os.rmdir')
-    def test_remove_temp_dir(self, mock_rmdir):
-        self.fd_device.device = '/dev/sda'
-        self.fd_device.device_dir = '/foo/bar'
-        status = self.fd_device.remove_temp_dir()
-        self.assertEqual(status, 0)
-        mock_rmdir.assert_called_with('/foo/bar')
-        
-
     def test_prepare_to_copy(self):
-        self.fd_device.mount_device = MagicMock(return_value=('/tmp/tmpdir', 0))
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        with open(os.path.join(tmp.name, 'a.txt'), 'w') as f:
+            f.write('a')
+        self.fd_device.mount_device = MagicMock(return_value=(tmp.name, 0))
         self.fd_device.delete_ignored = MagicMock(return_value=0)
-        self.fd_device.create_checksums_files = MagicMock(return_value=0)
+        self.fd_device.create_checksums_files = MagicMock(return_value=PackedManifest({'a.txt': '1234'}))
         status = self.fd_device.prepare_to_copy(checksums=True)
         self.assertEqual(status, 0)
+        '''The source is indexed once, and the index is handed on to the checksums'''
+        self.assertEqual(list(self.fd_device.source_index.files), ['a.txt'])
+        self.assertIs(self.fd_device.create_checksums_files.call_args.kwargs['index'], self.fd_device.source_index)
+
+        self.fd_device.mount_device = MagicMock(return_value=(os.path.join(tmp.name, 'missing'), 0))
+        self.fd_device.check_mountpoint = MagicMock(return_value=0)
+        self.assertEqual(self.fd_device.prepare_to_copy(checksums=True), 1)
+        self.fd_device.check_mountpoint.assert_called_with()
+
+    @patch('actions.fd_devices.SourceStage')
+    def test_prepare_to_copy_staging(self, mock_SourceStage):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.fd_device.mount_device = MagicMock(return_value=(tmp.name, 0))
+        self.fd_device.create_checksums_files = MagicMock(return_value=PackedManifest({'a.txt': '1234'}))
+        mock_SourceStage.return_value.stage = MagicMock(return_value=0)
+        mock_SourceStage.return_value.mdsums = {'a.txt': '4567'}
+        mock_SourceStage.return_value.stage_dir = '/dev/shm/stage'
+        status = self.fd_device.prepare_to_copy(checksums=True, staging=True)
+        self.assertEqual(status, 0)
+        mock_SourceStage.assert_called_with(tmp.name, device=self.fd_device, index=self.fd_device.source_index)
+        self.fd_device.create_checksums_files.assert_not_called()
+        self.assertEqual(self.fd_device.source_mdsums, {'a.txt': '4567'})
+        self.assertIsInstance(self.fd_device.source_mdsums.buffer, mmap.mmap)
+        self.assertEqual(self.fd_device.get_copy_source_dir(), '/dev/shm/stage')
+        self.fd_device.cleanup_stage()
+        mock_SourceStage.return_value.cleanup.assert_called()
+        self.assertEqual(self.fd_device.get_copy_source_dir(), tmp.name)
+
+        '''Falls back to the source device if staging fails'''
+        mock_SourceStage.return_value.stage = MagicMock(return_value=1)
+        status = self.fd_device.prepare_to_copy(checksums=True, staging=True)
+        self.assertEqual(status, 0)
+        self.assertEqual(self.fd_device.source_mdsums, {'a.txt': '1234'})
+        self.assertEqual(self.fd_device.get_copy_source_dir(), tmp.name)
 
     def test_emit(self):
         self.fd_device.hub = '/dev/sda'
@@ -530,6 +1252,983 @@ class FdDeviceTests(unittest.TestCase):
         results = self.fd_device.copy(source_device, source_dir)
         self.assertEqual(results, 'results123')
 
+class FanOutCopierTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source_dir = os.path.join(self.tmp.name, 'source')
+        os.makedirs(os.path.join(self.source_dir, 'a', 'b'))
+        self.files = {'top.txt': b'top' * 1000, os.path.join('a', 'b', 'deep.bin'): bytes(range(256)) * 50,
+                os.path.join('a', 'empty.txt'): b''}
+        for rel_path, data in self.files.items():
+            with open(os.path.join(self.source_dir, rel_path), 'wb') as f:
+                f.write(data)
+        self.targets = []
+        for i in range(3):
+            target = MagicMock()
+            target.device = f'/dev/sd{i}'
+            target.device_dir = os.path.join(self.tmp.name, f'dest{i}')
+            target.check_stamp = MagicMock(return_value=False)
+            os.makedirs(target.device_dir)
+            self.targets.append(target)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_scan_source(self):
+        copier = FanOutCopier(self.source_dir, self.targets)
+        dirs, files = copier.scan_source()
+        self.assertEqual(sorted(dirs), ['a', os.path.join('a', 'b')])
+        self.assertEqual(sorted(files), sorted((rel_path, len(data)) for rel_path, data in self.files.items()))
+
+    def test_copy(self):
+        copier = FanOutCopier(self.source_dir, self.targets, chunk_size=100, queue_depth=2)
+        statuses = copier.copy()
+        self.assertEqual(statuses, [0, 0, 0])
+        for target in self.targets:
+            for rel_path, data in self.files.items():
+                with open(os.path.join(target.device_dir, rel_path), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            target.calculate_and_emit.assert_called()
+        self.assertEqual(copier.mdsums, None)
+
+    def test_copy_preserve_times(self):
+        for i, rel_path in enumerate(self.files):
+            os.utime(os.path.join(self.source_dir, rel_path), ns=(1000000000 * i, 1500000000000000000 + 2000000000 * i))
+        statuses = FanOutCopier(self.source_dir, self.targets, chunk_size=100).copy()
+        self.assertEqual(statuses, [0, 0, 0])
+        for target in self.targets:
+            for rel_path in self.files:
+                source = os.stat(os.path.join(self.source_dir, rel_path))
+                dest = os.stat(os.path.join(target.device_dir, rel_path))
+                self.assertEqual(dest.st_mtime_ns, source.st_mtime_ns)
+        copier = FanOutCopier(self.source_dir, self.targets[:1], preserve_times=False)
+        self.assertEqual(copier.copy(), [0])
+        dest = os.stat(os.path.join(self.targets[0].device_dir, 'top.txt'))
+        self.assertGreater(dest.st_mtime_ns, os.stat(os.path.join(self.source_dir, 'top.txt')).st_mtime_ns)
+
+    def test_copy_writer_error(self):
+        '''A writer failing with something other than OSError still drains its queue, so the copy returns'''
+        handle = FanOutWriter.handle
+
+        def failing_handle(writer, item):
+            if writer.target is self.targets[1] and item[0] == 'data':
+                raise TypeError('write to a closed file')
+            handle(writer, item)
+
+        copier = FanOutCopier(self.source_dir, self.targets, chunk_size=10, queue_depth=1)
+        with patch.object(FanOutWriter, 'handle', failing_handle):
+            statuses = copier.copy()
+        self.assertEqual(statuses, [0, 1, 0])
+        with open(os.path.join(self.targets[2].device_dir, 'top.txt'), 'rb') as f:
+            self.assertEqual(f.read(), self.files['top.txt'])
+
+    def test_copy_hash_source(self):
+        copier = FanOutCopier(self.source_dir, self.targets, chunk_size=100, hash_source=True)
+        statuses = copier.copy()
+        self.assertEqual(statuses, [0, 0, 0])
+        self.assertEqual(copier.mdsums, {rel_path: hashlib.md5(data).hexdigest() for rel_path, data in self.files.items()})
+
+        '''The digests of the blocks of the files of more than two blocks are created in the same pass'''
+        blocks = SourceBlocks(block_size=4096)
+        copier = FanOutCopier(self.source_dir, self.targets, chunk_size=1000, hash_source=True, blocks=blocks)
+        self.assertEqual(copier.copy(), [0, 0, 0])
+        data = self.files[os.path.join('a', 'b', 'deep.bin')]
+        self.assertEqual(blocks.files, {os.path.join('a', 'b', 'deep.bin'): 
+                [hashlib.md5(data[i:i + 4096]).hexdigest() for i in range(0, len(data), 4096)]})
+
+    def test_copy_failed_target(self):
+        self.targets[1].device_dir = os.path.join(self.tmp.name, 'missing', 'dest')
+        with open(os.path.join(self.tmp.name, 'missing'), 'w') as f:
+            f.write('not a directory')
+        copier = FanOutCopier(self.source_dir, self.targets, chunk_size=100, queue_depth=1)
+        statuses = copier.copy()
+        self.assertEqual(statuses, [0, 1, 0])
+        with open(os.path.join(self.targets[2].device_dir, 'top.txt'), 'rb') as f:
+            self.assertEqual(f.read(), self.files['top.txt'])
+
+    def test_replicate(self):
+        for target in self.targets:
+            target.checksums = True
+            target.prepare_device = MagicMock(return_value=0)
+            target.finish_device = MagicMock(return_value=0)
+            target.check_mountpoint = MagicMock(return_value=0)
+        self.targets[0].prepare_device = MagicMock(return_value=1)
+        copier = FanOutCopier(self.source_dir, self.targets, threads=2)
+        copier.copy = MagicMock(return_value=[0, 1])
+        copier.mdsums = {'top.txt': '123'}
+        results = copier.replicate()
+        self.assertEqual(self.targets[1].source_mdsums, {'top.txt': '123'})
+        copier.copy.assert_called_with(targets=self.targets[1:], pc=50)
+        self.assertEqual([status for _, status in results], [1, 0, 1])
+        self.targets[0].finish_device.assert_not_called()
+        self.targets[1].finish_device.assert_called()
+        self.targets[2].finish_device.assert_not_called()
+        '''finish_device unmounts the device it verified, the others are released'''
+        self.targets[0].check_mountpoint.assert_called()
+        self.targets[1].check_mountpoint.assert_not_called()
+        self.targets[2].check_mountpoint.assert_called()
+
+        '''A device that fails verification is released too'''
+        self.targets[1].finish_device = MagicMock(return_value=1)
+        self.assertEqual(copier.finish(self.targets[1]), 1)
+        self.targets[1].check_mountpoint.assert_called_once_with()
+
+    def test_replicate_image(self):
+        '''Image targets are never mounted, so they aren't unmounted either'''
+        for target in self.targets:
+            target.checksums = False
+            target.unmount_partitions = MagicMock(return_value=0)
+        copier = ImageCopier(os.path.join(self.source_dir, 'top.txt'), self.targets)
+        copier.copy = MagicMock(return_value=[0, 1, 0])
+        results = copier.replicate()
+        self.assertEqual([status for _, status in results], [0, 1, 0])
+        for target in self.targets:
+            target.check_mountpoint.assert_not_called()
+
+    def test_replicate_stamped(self):
+        for target in self.targets:
+            target.checksums = False
+            target.prepare_device = MagicMock(return_value=0)
+            target.finish_device = MagicMock(return_value=0)
+            target.check_mountpoint = MagicMock(return_value=0)
+        '''The second device already holds the payload, and isn't touched'''
+        self.targets[1].check_stamp = MagicMock(return_value=True)
+        copier = FanOutCopier(self.source_dir, self.targets)
+        copier.copy = MagicMock(return_value=[0, 0])
+        results = copier.replicate()
+        self.assertEqual([status for _, status in results], [0, 0, 0])
+        copier.copy.assert_called_with(targets=[self.targets[0], self.targets[2]], pc=100)
+        self.targets[1].prepare_device.assert_not_called()
+        self.targets[1].finish_device.assert_not_called()
+        self.targets[1].check_mountpoint.assert_not_called()
+        self.targets[1].emit.assert_called_with(100)
+
+    def test_emit_progress(self):
+        target = self.targets[0]
+        writer = FanOutWriter(target, 200, pc=50)
+        writer.bytes_written = 100
+        writer.emit_progress()
+        writer.emit_progress()
+        target.calculate_and_emit.assert_called_once_with(100, 200, pc=50)
+
+def make_fat_boot_sector(total_sectors, fat_sectors, **kwargs):
+    '''Return a minimal FAT boot sector, FAT32 style if root_entries is 0'''
+    root_entries = kwargs.get('root_entries', 0)
+    sector = bytearray(512)
+    sector[0:3] = b'\xeb\x58\x90'
+    sector[11:13] = (512).to_bytes(2, 'little')
+    sector[13] = kwargs.get('sectors_per_cluster', 1)
+    sector[14:16] = kwargs.get('reserved_sectors', 1).to_bytes(2, 'little')
+    sector[16] = 2
+    sector[17:19] = root_entries.to_bytes(2, 'little')
+    sector[32:36] = total_sectors.to_bytes(4, 'little')
+    if root_entries:
+        sector[22:24] = fat_sectors.to_bytes(2, 'little')
+    else:
+        sector[36:40] = fat_sectors.to_bytes(4, 'little')
+    sector[510:512] = b'\x55\xaa'
+    return bytes(sector)
+
+class ImageTests(unittest.TestCase):
+    def setUp(self):
+        '''FAT16: 1 reserved + 2 * 20 FAT + 32 root directory sectors, then 5000 one-sector clusters'''
+        self.boot_sector = make_fat_boot_sector(5073, 20, root_entries=512)
+        self.image = bytearray(5073 * 512)
+        self.image[:512] = self.boot_sector
+        fat = bytearray(20 * 512)
+        fat[100 * 2:100 * 2 + 2] = b'\xff\xff'
+        self.image[512:512 + len(fat)] = fat
+        self.image[(73 + 98) * 512:(73 + 99) * 512] = b'x' * 512
+        self.used = (73 + 99) * 512
+
+    def test_parse_fat_boot_sector(self):
+        fat = image.parse_fat_boot_sector(self.boot_sector)
+        self.assertEqual(fat['fat_type'], 16)
+        self.assertEqual(fat['first_data_sector'], 73)
+        self.assertEqual(fat['clusters'], 5000)
+
+        fat = image.parse_fat_boot_sector(make_fat_boot_sector(67072, 520, reserved_sectors=32))
+        self.assertEqual(fat['fat_type'], 32)
+        self.assertEqual(fat['first_data_sector'], 32 + 2 * 520)
+
+        self.assertEqual(image.parse_fat_boot_sector(bytes(512)), None)
+
+    def test_get_image_extent(self):
+        used, required = image.get_image_extent(io.BytesIO(bytes(self.image)), len(self.image))
+        self.assertEqual(used, self.used)
+        self.assertEqual(required, len(self.image))
+
+        '''The same file system in an MBR partition starting at sector 2048'''
+        mbr = bytearray(512)
+        mbr[446 + 4] = 0x0e
+        mbr[446 + 8:446 + 12] = (2048).to_bytes(4, 'little')
+        mbr[446 + 12:446 + 16] = (5073).to_bytes(4, 'little')
+        mbr[510:512] = b'\x55\xaa'
+        disk = bytes(mbr) + bytes(2047 * 512) + bytes(self.image) + bytes(1000 * 512)
+        used, required = image.get_image_extent(io.BytesIO(disk), len(disk))
+        self.assertEqual(used, 2048 * 512 + self.used)
+        self.assertEqual(required, (2048 + 5073) * 512)
+
+        used, required = image.get_image_extent(io.BytesIO(bytes(4096)), 4096)
+        self.assertEqual((used, required), (4096, 4096))
+
+    def test_read_fat_root_file(self):
+        '''FAT16: the root directory follows the FATs, at sector 41, and the first cluster is at sector 73'''
+        stamp = b'{"manifest_id": "123"}'
+        entry = bytearray(32)
+        entry[:11] = b'FDSTAMP TXT'
+        entry[26:28] = (3).to_bytes(2, 'little')
+        entry[28:32] = len(stamp).to_bytes(4, 'little')
+        deleted = bytearray(entry)
+        deleted[0] = 0xe5
+        self.image[41 * 512:41 * 512 + 64] = deleted + entry
+        self.image[74 * 512:74 * 512 + len(stamp)] = stamp
+        f = io.BytesIO(bytes(self.image))
+        self.assertEqual(image.read_fat_root_file(f, 'FDSTAMP.TXT'), stamp)
+        self.assertEqual(image.read_fat_root_file(f, 'fdstamp.txt'), stamp)
+        self.assertEqual(image.read_fat_root_file(f, 'OTHER.TXT'), None)
+        self.assertEqual(image.read_fat_root_file(io.BytesIO(bytes(4096)), 'FDSTAMP.TXT'), None)
+
+        '''FAT32: the root directory is a cluster chain, here clusters 2 then 5'''
+        fat32 = bytearray(make_fat_boot_sector(67072, 520, reserved_sectors=32))
+        fat32[44:48] = (2).to_bytes(4, 'little')
+        first_data = (32 + 2 * 520) * 512
+        image32 = bytearray(first_data + 10 * 512)
+        image32[:512] = fat32
+        fat = 32 * 512
+        image32[fat + 2 * 4:fat + 3 * 4] = (5).to_bytes(4, 'little')
+        image32[fat + 5 * 4:fat + 6 * 4] = (0x0fffffff).to_bytes(4, 'little')
+        entry[26:28] = (7).to_bytes(2, 'little')
+        image32[first_data:first_data + 512] = b'\xe5' * 512
+        image32[first_data + 3 * 512:first_data + 3 * 512 + 32] = entry
+        image32[first_data + 5 * 512:first_data + 5 * 512 + len(stamp)] = stamp
+        self.assertEqual(image.read_fat_root_file(io.BytesIO(bytes(image32)), 'FDSTAMP.TXT'), stamp)
+
+    def test_get_volume_id(self):
+        self.image[39:43] = (0x1a2b3c4d).to_bytes(4, 'little')
+        self.assertEqual(image.get_volume_id(io.BytesIO(bytes(self.image))), '1A2B-3C4D')
+        self.assertEqual(image.get_volume_id(io.BytesIO(bytes(4096))), None)
+
+    def test_copy(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_device = os.path.join(tmp, 'source')
+            with open(source_device, 'wb') as f:
+                f.write(self.image)
+            targets = []
+            for i, size in enumerate((len(self.image), len(self.image) * 2, len(self.image) - 512)):
+                target = MagicMock()
+                target.device = os.path.join(tmp, f'target{i}')
+                target.checksums = True
+                with open(target.device, 'wb') as f:
+                    f.write(b'\xff' * size)
+                targets.append(target)
+            copier = ImageCopier(source_device, targets, chunk_size=4096)
+            statuses = copier.copy()
+            self.assertEqual(statuses, [0, 0, 1])
+            self.assertEqual(copier.image_size, self.used)
+            for target in targets[:2]:
+                with open(target.device, 'rb') as f:
+                    data = f.read()
+                self.assertEqual(data[:self.used], self.image[:self.used])
+                self.assertEqual(data[self.used:self.used + 512], b'\xff' * 512)
+                target.sample = 1
+                for readback in (False, True):
+                    target.readback = readback
+                    self.assertEqual(copier.finish(target), 0)
+            '''The source is an image file, so its block tree is saved next to it'''
+            self.assertEqual(BlockTree.load(source_device + '.tree', copier.get_tree_file()[1]).leaves, copier.tree.leaves)
+            with open(targets[1].device, 'r+b') as f:
+                f.seek(100 * 512)
+                f.write(b'corrupt')
+            copier.rewrite_leaves = MagicMock(return_value=0)
+            self.assertEqual(copier.finish(targets[1]), 1)
+            self.assertEqual(copier.rewrite_leaves.call_count, REPAIR_RETRIES)
+            '''The first block is always part of the sample'''
+            with open(targets[1].device, 'r+b') as f:
+                f.seek(100 * 512)
+                f.write(self.image[100 * 512:100 * 512 + 7])
+            targets[1].sample = 0.01
+            self.assertEqual(copier.finish(targets[1]), 0)
+            with open(targets[1].device, 'r+b') as f:
+                f.write(b'corrupt')
+            self.assertEqual(copier.finish(targets[1]), 1)
+
+    @patch('actions.block_tree.BLOCK_TREE_LEAF_SIZE', 4096)
+    def test_finish_rewrite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_device = os.path.join(tmp, 'source')
+            with open(source_device, 'wb') as f:
+                f.write(self.image)
+            target = MagicMock()
+            target.device = os.path.join(tmp, 'target')
+            target.checksums = True
+            target.sample = 1
+            target.readback = False
+            with open(target.device, 'wb') as f:
+                f.write(b'\xff' * len(self.image))
+            copier = ImageCopier(source_device, [target], chunk_size=8192)
+            self.assertEqual(copier.copy(), [0])
+            self.assertEqual(len(copier.tree.leaves), -(-self.used // 4096))
+            for offset in (0, 100 * 512, 5 * 4096):
+                with open(target.device, 'r+b') as f:
+                    f.seek(offset)
+                    f.write(b'corrupt')
+            self.assertEqual(copier.verify_leaves(target, range(len(copier.tree.leaves))), [0, 5, 12])
+            '''Only the bad blocks are written again'''
+            copier.rewrite_leaves = MagicMock(wraps=copier.rewrite_leaves)
+            self.assertEqual(copier.finish(target), 0)
+            copier.rewrite_leaves.assert_called_once_with(target, [0, 5, 12])
+            with open(target.device, 'rb') as f:
+                self.assertEqual(f.read(self.used), self.image[:self.used])
+
+            '''The saved tree is used instead of hashing the image again'''
+            with patch('actions.image.BlockTree.update') as mock_update:
+                copier = ImageCopier(source_device, [target], chunk_size=8192)
+                self.assertEqual(copier.copy(), [0])
+                mock_update.assert_not_called()
+                self.assertEqual(copier.finish(target), 0)
+
+    def test_image_writer_dedupe(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            target = MagicMock()
+            target.device = os.path.join(tmp, 'target')
+            '''The target already holds the image, except for one block'''
+            old_image = bytearray(self.image)
+            old_image[5 * 4096 + 10] ^= 0xff
+            with open(target.device, 'wb') as f:
+                f.write(old_image)
+            writer = ImageWriter(target, len(self.image), dedupe=True, block_size=4096)
+            writer.start()
+            writer.put(('open', None))
+            for i in range(0, len(self.image), 8192):
+                writer.put(('data', bytes(self.image[i:i + 8192])))
+            writer.put(('close', None))
+            writer.put(('done', None))
+            writer.join()
+            self.assertEqual(writer.status, 0)
+            self.assertEqual((writer.blocks_written, writer.blocks_same), (1, -(-len(self.image) // 4096) - 1))
+            with open(target.device, 'rb') as f:
+                self.assertEqual(f.read(), self.image)
+
+class BlockTreeTests(unittest.TestCase):
+    def test_update(self):
+        data = os.urandom(10000)
+        tree = BlockTree(leaf_size=4096)
+        for i in range(0, len(data), 3000):
+            tree.update(data[i:i + 3000])
+        tree.finish()
+        self.assertEqual(tree.size, 10000)
+        self.assertEqual(tree.leaves, [hashlib.md5(data[i:i + 4096]).hexdigest() for i in range(0, 10000, 4096)])
+        self.assertEqual(tree.get_leaf_range(2), (8192, 1808))
+        self.assertEqual(tree.get_ranges([2, 0, 1]), [(0, 10000)])
+        self.assertEqual(tree.get_ranges([0, 2]), [(0, 4096), (8192, 1808)])
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'image.tree')
+            self.assertEqual(BlockTree.load(path, '1'), None)
+            tree = BlockTree(leaf_size=4096)
+            tree.update(b'x' * 5000)
+            self.assertEqual(tree.finish().save(path, '1'), 0)
+            loaded = BlockTree.load(path, '1', leaf_size=4096)
+            self.assertEqual((loaded.leaves, loaded.size), (tree.leaves, 5000))
+            self.assertEqual(BlockTree.load(path, '2', leaf_size=4096), None)
+            self.assertEqual(BlockTree.load(path, '1'), None)
+
+class GoldenImageBuilderTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source_dir = os.path.join(self.tmp.name, 'source')
+        os.makedirs(os.path.join(self.source_dir, 'videos'))
+        os.makedirs(os.path.join(self.source_dir, '.Trashes'))
+        for rel_path, data in (('readme.txt', b'hello'), (os.path.join('videos', 'a.mp4'), b'v' * 10000),
+                ('.Trashes/junk', b'junk')):
+            with open(os.path.join(self.source_dir, rel_path), 'wb') as f:
+                f.write(data)
+        self.source_object = MagicMock()
+        self.source_object.device_dir = self.source_dir
+        self.image_dir = os.path.join(self.tmp.name, 'images')
+        self.builder = GoldenImageBuilder(self.source_object, image_dir=self.image_dir, label='LABEL',
+                ignore_files=['.Trashes'])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_scan_source(self):
+        dirs, files = self.builder.scan_source()
+        self.assertEqual(dirs, {'': ['videos', 'readme.txt'], 'videos': ['a.mp4']})
+        self.assertEqual([(rel_path, size) for rel_path, size, _ in files], 
+                [('readme.txt', 5), (os.path.join('videos', 'a.mp4'), 10000)])
+
+    def test_get_key(self):
+        _, files = self.builder.scan_source()
+        key = self.builder.get_key(files)
+        self.assertEqual(key, self.builder.get_key(files))
+        os.utime(os.path.join(self.source_dir, 'readme.txt'), ns=(0, 0))
+        _, files = self.builder.scan_source()
+        self.assertNotEqual(key, self.builder.get_key(files))
+
+    def test_get_image_size(self):
+        dirs, files = self.builder.scan_source()
+        size, cluster_size = self.builder.get_image_size(dirs, files)
+        self.assertEqual(cluster_size, 512)
+        self.assertGreater(size, 65525 * 512)
+        size, cluster_size = self.builder.get_image_size(dirs, files + [('big.bin', 4 * 1024 ** 3, 0)])
+        self.assertGreater(size, 4 * 1024 ** 3)
+        self.assertLess(size, 4.2 * 1024 ** 3)
+        self.assertGreaterEqual(cluster_size, 4096)
+
+    def test_get_image(self):
+        mount_dir = os.path.join(self.tmp.name, 'mnt')
+        os.makedirs(mount_dir)
+        def mkfs(cmd, **kwargs):
+            with open(cmd[-2], 'wb') as f:
+                f.write(b'image')
+            return 0
+        self.source_object.check_call = MagicMock(side_effect=mkfs)
+        self.source_object.mount_device = MagicMock(return_value=(mount_dir, 0))
+        self.source_object.check_mountpoint = MagicMock(return_value=0)
+        image = self.builder.get_image()
+        self.assertTrue(image.startswith(self.image_dir))
+        self.assertIn('LABEL', self.source_object.check_call.call_args[0][0])
+        with open(os.path.join(mount_dir, 'videos', 'a.mp4'), 'rb') as f:
+            self.assertEqual(f.read(), b'v' * 10000)
+        self.assertEqual(os.listdir(self.image_dir), [os.path.basename(image)])
+
+        '''The cached image is reused while the source is unchanged'''
+        self.source_object.check_call.reset_mock()
+        self.assertEqual(self.builder.get_image(), image)
+        self.source_object.check_call.assert_not_called()
+
+        self.source_object.check_call = MagicMock(return_value=1)
+        with open(os.path.join(self.source_dir, 'new.txt'), 'wb') as f:
+            f.write(b'new')
+        self.assertEqual(self.builder.get_image(), None)
+
+class SourceStageTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source_dir = os.path.join(self.tmp.name, 'source')
+        os.makedirs(os.path.join(self.source_dir, 'a'))
+        self.files = {'top.txt': b'top' * 1000, os.path.join('a', 'sub.txt'): b'sub'}
+        for rel_path, data in self.files.items():
+            with open(os.path.join(self.source_dir, rel_path), 'wb') as f:
+                f.write(data)
+        self.stage_dir = os.path.join(self.tmp.name, 'stage')
+        self.device = MagicMock()
+        self.stage = SourceStage(self.source_dir, stage_dir=self.stage_dir, reserve=0, chunk_size=100, 
+                device=self.device)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_stage(self):
+        status = self.stage.stage(checksums=True)
+        self.assertEqual(status, 0)
+        for rel_path, data in self.files.items():
+            with open(os.path.join(self.stage_dir, rel_path), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertEqual(self.stage.mdsums, {rel_path: hashlib.md5(data).hexdigest() for rel_path, data in self.files.items()})
+        self.device.calculate_and_emit.assert_called_with(3003, 3003)
+
+        self.stage.cleanup()
+        self.assertFalse(os.path.exists(self.stage_dir))
+
+    def test_stage_blocks(self):
+        data = os.urandom(3 * 4096 + 1)
+        with open(os.path.join(self.source_dir, 'big.bin'), 'wb') as f:
+            f.write(data)
+        blocks = SourceBlocks(block_size=4096)
+        self.assertEqual(self.stage.stage(checksums=True, blocks=blocks), 0)
+        '''Only files of more than two blocks have their blocks kept'''
+        self.assertEqual(blocks.files, {'big.bin': [hashlib.md5(data[i:i + 4096]).hexdigest() for i in range(0, len(data), 4096)]})
+
+    def test_stage_does_not_fit(self):
+        self.stage.get_free_space = MagicMock(return_value=3000)
+        status = self.stage.stage(checksums=True)
+        self.assertEqual(status, 1)
+        self.assertFalse(os.path.exists(self.stage_dir))
+
+    @patch('actions.staging.get_available_memory', return_value=1000)
+    @patch('actions.staging.get_mount_fs_type', return_value='tmpfs')
+    def test_get_free_space(self, mock_get_mount_fs_type, mock_get_available_memory):
+        self.stage.reserve = 100
+        self.assertEqual(self.stage.get_free_space(), 900)
+
+    def test_get_available_memory(self):
+        with patch('actions.staging.open', mock_open(read_data='MemTotal: 100 kB\nMemAvailable: 50 kB\n')):
+            self.assertEqual(staging.get_available_memory(), 50 * 1024)
+
+    def test_get_mount_fs_type(self):
+        mounts = '/dev/root / ext4 rw 0 0\ntmpfs /dev/shm tmpfs rw 0 0\n'
+        with patch('actions.staging.open', mock_open(read_data=mounts)):
+            self.assertEqual(staging.get_mount_fs_type('/dev/shm/fd_replicator'), 'tmpfs')
+        with patch('actions.staging.open', mock_open(read_data=mounts)):
+            self.assertEqual(staging.get_mount_fs_type('/home'), 'ext4')
+
+class CopyEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src.bin')
+        self.data = os.urandom(3 * 4096 + 123)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        os.chmod(self.src, 0o600)
+        os.utime(self.src, ns=(1500000000 * 10 ** 9, 1600000000 * 10 ** 9))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check_copy(self, engine, name):
+        dest = os.path.join(self.tmp.name, name)
+        engine.copy_file(self.src, dest)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(os.stat(dest).st_mode & 0o777, 0o600)
+        self.assertEqual(os.stat(dest).st_mtime_ns, 1600000000 * 10 ** 9)
+
+    def test_strategies(self):
+        for strategy in ('auto', 'copy_file_range', 'sendfile', 'buffered', 'direct'):
+            engine = CopyEngine(strategy=strategy, block_size=4096)
+            self.check_copy(engine, strategy)
+            self.assertEqual(engine.files_copied, 1)
+            self.assertEqual(engine.bytes_copied, len(self.data))
+            self.assertIn(f'copy strategy {strategy}', engine.report())
+
+    def test_fallocate(self):
+        '''Space is reserved without extending (and zero filling) the file'''
+        engine = CopyEngine()
+        dest = os.path.join(self.tmp.name, 'dest.bin')
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT)
+        try:
+            engine.fallocate(fd, 1024 * 1024)
+            self.assertEqual(os.fstat(fd).st_size, 0)
+        finally:
+            os.close(fd)
+        self.check_copy(CopyEngine(preallocate=True), 'preallocated')
+
+        with patch('actions.copy_engine.get_libc') as mock_get_libc:
+            mock_get_libc.return_value.fallocate.return_value = -1
+            with patch('actions.copy_engine.ctypes.get_errno', return_value=errno.EOPNOTSUPP):
+                engine.fallocate(0, 100)
+                self.assertIn('fallocate', engine.unsupported)
+                engine.fallocate(0, 100)
+                self.assertEqual(mock_get_libc.return_value.fallocate.call_count, 1)
+            with patch('actions.copy_engine.ctypes.get_errno', return_value=errno.ENOSPC):
+                with self.assertRaises(OSError):
+                    CopyEngine().fallocate(0, 100)
+
+    def test_fallback(self):
+        engine = CopyEngine(strategy='auto', block_size=1000)
+        self.assertEqual(engine.block_size, 4096)
+        with patch('actions.copy_engine.os.copy_file_range', side_effect=OSError(errno.EXDEV, 'Cross-device link')):
+            self.check_copy(engine, 'fallback1')
+            self.check_copy(engine, 'fallback2')
+        self.assertEqual(engine.unsupported, {'copy_file_range'})
+        self.assertEqual(engine.used, {'sendfile'})
+
+        engine = CopyEngine(strategy='buffered')
+        with patch('actions.copy_engine.os.readv', side_effect=OSError(errno.EIO, 'I/O error')):
+            self.assertRaises(OSError, engine.copy_file, self.src, os.path.join(self.tmp.name, 'failed'))
+
+    def test_unknown_strategy(self):
+        engine = CopyEngine(strategy='foo')
+        self.assertEqual(engine.strategy, 'auto')
+
+class HashEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'file.bin')
+        self.data = os.urandom(10000)
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_hash_file(self):
+        expected = {'md5': hashlib.md5(self.data).hexdigest(), 'blake2b': hashlib.blake2b(self.data).hexdigest(),
+                'crc32': f'{zlib.crc32(self.data):08x}', 'adler32': f'{zlib.adler32(self.data):08x}'}
+        for algorithm, digest in expected.items():
+            for use_mmap in (False, True):
+                engine = HashEngine(algorithm=algorithm, chunk_size=4096, use_mmap=use_mmap)
+                progress = MagicMock()
+                self.assertEqual(engine.hash_file(self.path, progress=progress), digest)
+                self.assertEqual(progress.call_args_list, [call(4096), call(4096), call(1808)])
+
+    def test_hash_file_direct(self):
+        engine = HashEngine(chunk_size=5000, direct=True)
+        self.assertEqual(engine.chunk_size, 8192)
+        self.assertEqual(engine.hash_file(self.path), hashlib.md5(self.data).hexdigest())
+
+        '''File systems without O_DIRECT: the cached pages are dropped instead'''
+        real_open = os.open
+        def open_no_direct(path, flags, *args):
+            if flags & os.O_DIRECT:
+                raise OSError(errno.EINVAL, 'Invalid argument')
+            return real_open(path, flags, *args)
+        with patch('actions.hashing.os.open', side_effect=open_no_direct), \
+                patch('actions.hashing.os.posix_fadvise') as mock_fadvise:
+            self.assertEqual(engine.hash_file(self.path), hashlib.md5(self.data).hexdigest())
+            mock_fadvise.assert_called_with(unittest.mock.ANY, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def test_hash_empty_file(self):
+        path = os.path.join(self.tmp.name, 'empty')
+        open(path, 'wb').close()
+        for use_mmap in (False, True):
+            engine = HashEngine(use_mmap=use_mmap)
+            self.assertEqual(engine.hash_file(path), hashlib.md5(b'').hexdigest())
+
+    def test_hash_files(self):
+        files = []
+        for size in (100, 50000, 3000, 0, 20000):
+            path = os.path.join(self.tmp.name, f'{size}.bin')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            files.append((path, size))
+        engine = HashEngine(chunk_size=4096)
+        expected = {path: engine.hash_file(path) for path, _ in files}
+        for workers in (1, 3):
+            progress = MagicMock()
+            self.assertEqual(engine.hash_files(files, progress=progress, workers=workers), expected)
+            self.assertEqual(sum(c.args[0] for c in progress.call_args_list), 73100)
+
+        '''Largest files first'''
+        engine.hash_file = MagicMock(return_value='123')
+        engine.hash_files(files, workers=1)
+        self.assertEqual([c.args[0] for c in engine.hash_file.call_args_list], 
+                [files[1][0], files[4][0], files[2][0], files[0][0], files[3][0]])
+
+    def test_new_hash(self):
+        self.assertEqual(new_hash('sha256').name, 'sha256')
+        self.assertRaises(ValueError, new_hash, 'foo')
+        self.assertRaises(ValueError, HashEngine, algorithm='foo')
+
+class SampledVerifierTests(unittest.TestCase):
+    def test_sample_blocks(self):
+        self.assertEqual(sample_blocks(0, 4096, 0.1), [])
+        self.assertEqual(sample_blocks(5000, 4096, 0.1), [0, 1])
+        self.assertEqual(sample_blocks(10 * 4096, 4096, 1), list(range(10)))
+        blocks = sample_blocks(100 * 4096 + 1, 4096, 0.1, random.Random(1))
+        self.assertEqual(len(blocks), 12)
+        self.assertEqual((blocks[0], blocks[-1]), (0, 100))
+        self.assertEqual(blocks, sorted(set(blocks)))
+
+    def test_compare_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            data = os.urandom(10 * 4096 + 10)
+            for name in ('source', 'dest'):
+                with open(os.path.join(tmp, name), 'wb') as f:
+                    f.write(data)
+            leaves = [hashlib.md5(data[i:i + 4096]).hexdigest() for i in range(0, len(data), 4096)]
+            digest = hashlib.md5(data).hexdigest()
+            dest = os.path.join(tmp, 'dest')
+            for direct in (False, True):
+                verifier = SampledVerifier(fraction=1, block_size=4096, direct=direct)
+                self.assertTrue(verifier.compare_file(dest, len(data), digest, leaves=leaves))
+                self.assertEqual((verifier.blocks_checked, verifier.bytes_checked), (11, len(data)))
+            '''Without the block digests, the whole file is compared with its digest'''
+            self.assertTrue(verifier.compare_file(dest, len(data), digest))
+            self.assertEqual((verifier.blocks_checked, verifier.bytes_checked), (22, 2 * len(data)))
+            with open(dest, 'r+b') as f:
+                f.seek(5 * 4096)
+                f.write(b'x')
+            self.assertFalse(verifier.compare_file(dest, len(data), digest, leaves=leaves))
+            self.assertFalse(verifier.compare_file(dest, len(data), digest))
+            self.assertIn('27 blocks, 102420 of 163880 bytes', verifier.report())
+
+class SourceIndexTests(unittest.TestCase):
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'b', 'd'))
+            os.makedirs(os.path.join(tmp, 'a'))
+            for rel_path, data in (('z.txt', b'zz'), (os.path.join('b', 'd', 'x.txt'), b'xxx'), ('a.txt', b'')):
+                with open(os.path.join(tmp, rel_path), 'wb') as f:
+                    f.write(data)
+            os.symlink(os.path.join(tmp, 'b'), os.path.join(tmp, 'link'))
+            index = SourceIndex(tmp)
+            self.assertEqual(index.dirs, ('a', 'b', 'link', os.path.join('b', 'd')))
+            self.assertEqual(list(index.files), ['a.txt', 'z.txt', os.path.join('b', 'd', 'x.txt')])
+            self.assertEqual(index.get_sizes(), {'a.txt': 0, 'z.txt': 2, os.path.join('b', 'd', 'x.txt'): 3})
+            self.assertEqual((len(index), index.total_bytes), (3, 5))
+            with self.assertRaises(TypeError):
+                index.files['new.txt'] = None
+        with self.assertRaises(OSError):
+            SourceIndex(os.path.join(tmp, 'missing'))
+
+    def test_iter_sorted_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'a', 'b'))
+            for rel_path in ('a.txt', 'a-b', os.path.join('a', 'b', 'c'), os.path.join('a', 'x'), 'b'):
+                with open(os.path.join(tmp, rel_path), 'wb') as f:
+                    f.write(rel_path.encode())
+            os.symlink(os.path.join(tmp, 'a'), os.path.join(tmp, 'link'))
+            files = list(iter_sorted_files(tmp))
+            '''The order of a PackedManifest: a-b and a.txt sort before the files below a/'''
+            self.assertEqual([rel_path for rel_path, _ in files], 
+                    ['a-b', 'a.txt', os.path.join('a', 'b', 'c'), os.path.join('a', 'x'), 'b'])
+            self.assertEqual([rel_path for rel_path, _ in files], list(PackedManifest({rel_path: '00' for rel_path, _ in files})))
+            self.assertEqual(files[0][1].st_size, 3)
+
+
+class PackedManifestTests(unittest.TestCase):
+    def setUp(self):
+        self.mdsums = {'b/a.txt': hashlib.md5(b'1').hexdigest(), 'a.txt': hashlib.md5(b'2').hexdigest(), 
+                'caf\xe9.txt': hashlib.md5(b'3').hexdigest(), 'z.txt': hashlib.md5(b'').hexdigest()}
+
+    def test_mapping(self):
+        manifest = PackedManifest(self.mdsums)
+        self.assertEqual(len(manifest), 4)
+        self.assertEqual(list(manifest), sorted(self.mdsums, key=lambda path: path.encode()))
+        self.assertEqual(manifest, self.mdsums)
+        self.assertEqual(manifest['caf\xe9.txt'], self.mdsums['caf\xe9.txt'])
+        self.assertIn('b/a.txt', manifest)
+        self.assertNotIn('b', manifest)
+        self.assertNotIn('zz.txt', manifest)
+        with self.assertRaises(KeyError):
+            manifest['c.txt']
+        self.assertFalse(PackedManifest({}))
+        self.assertEqual(len(PackedManifest({'a.txt': 'abcd1234'}).buffer), 
+                len(PackedManifest.pack({})) + 8 + 4 + 5)
+
+    def test_save_load(self):
+        with tempfile.TemporaryFile() as f:
+            PackedManifest(self.mdsums).save(f)
+            manifest = PackedManifest.load(f)
+        self.assertEqual(dict(manifest.items()), self.mdsums)
+        with tempfile.TemporaryFile() as f:
+            f.write(b'not a manifest' * 10)
+            f.flush()
+            with self.assertRaises(ValueError):
+                PackedManifest.load(f)
+
+
+class MountManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mounts = MountManager(mount_dir=os.path.join(self.tmp.name, 'mnt'))
+        self.check_call = MagicMock(return_value=0)
+        native_patcher = patch('actions.mounts.NATIVE_MOUNT', False)
+        native_patcher.start()
+        self.addCleanup(native_patcher.stop)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_refcount(self):
+        mount_dir = self.mounts.acquire('/dev/sdb', self.check_call, options='ro,noatime')
+        self.assertEqual(mount_dir, os.path.join(self.tmp.name, 'mnt', 'dev_sdb'))
+        self.assertTrue(os.path.isdir(mount_dir))
+        '''The second user shares the mount'''
+        self.assertEqual(self.mounts.acquire('/dev/sdb', self.check_call), mount_dir)
+        self.check_call.assert_called_once_with(['mount', '-o', 'ro,noatime', '/dev/sdb', mount_dir], timeout=30)
+        self.assertEqual(self.mounts.release('/dev/sdb'), 0)
+        self.assertTrue(self.mounts.is_mounted('/dev/sdb'))
+        self.assertEqual(self.mounts.release('/dev/sdb'), 0)
+        self.check_call.assert_called_with(['umount', mount_dir], timeout=30)
+        self.assertFalse(self.mounts.is_mounted('/dev/sdb'))
+        self.assertEqual(self.mounts.release('/dev/sdb'), None)
+        self.assertEqual(self.mounts.release('/dev/sdc'), None)
+
+        '''The mount point is reused'''
+        self.assertEqual(self.mounts.acquire('/dev/sdb', self.check_call), mount_dir)
+        self.assertEqual(self.check_call.call_count, 3)
+
+    def test_failure(self):
+        self.check_call.return_value = 32
+        self.assertEqual(self.mounts.acquire('/dev/sdb', self.check_call), None)
+        self.assertFalse(self.mounts.is_mounted('/dev/sdb'))
+
+    def test_release_all(self):
+        mount_dir = self.mounts.acquire('/dev/sdb', self.check_call)
+        self.mounts.acquire('/dev/sdb', self.check_call)
+        self.mounts.release_all()
+        self.check_call.assert_called_with(['umount', mount_dir], timeout=30)
+        self.assertFalse(os.path.exists(mount_dir))
+        self.assertFalse(self.mounts.is_mounted('/dev/sdb'))
+
+
+class NativeMountTests(unittest.TestCase):
+    def test_split_options(self):
+        self.assertEqual(mounts.split_options('ro,noatime'), (mounts.MS_RDONLY | mounts.MS_NOATIME, ''))
+        self.assertEqual(mounts.split_options('rw,noatime,async,flush,uid=1000'), (mounts.MS_NOATIME, 'flush,uid=1000'))
+        self.assertEqual(mounts.split_options(''), (0, ''))
+
+    @patch('actions.mounts.os.stat')
+    @patch('actions.mounts.sys_mount')
+    def test_mount(self, mock_sys_mount, mock_stat):
+        check_call = MagicMock(return_value=0)
+        mock_stat.return_value.st_mode = 0o60660
+        self.assertEqual(mounts.mount('/dev/sdb', '/mnt/sdb', check_call, options='ro', native=True), 0)
+        mock_sys_mount.assert_called_with('/dev/sdb', '/mnt/sdb', MOUNT_FS_TYPE, 'ro')
+        check_call.assert_not_called()
+
+        '''Falls back to the mount command if the system call fails, or for image files'''
+        mock_sys_mount.side_effect = OSError(errno.EPERM, 'Operation not permitted')
+        self.assertEqual(mounts.mount('/dev/sdb', '/mnt/sdb', check_call, options='ro', native=True), 0)
+        check_call.assert_called_with(['mount', '-o', 'ro', '/dev/sdb', '/mnt/sdb'], timeout=30)
+        mock_sys_mount.reset_mock()
+        mock_stat.return_value.st_mode = 0o100644
+        check_call.return_value = 32
+        self.assertEqual(mounts.mount('/tmp/a.img', '/mnt/img', check_call, options='', native=True), 32)
+        mock_sys_mount.assert_not_called()
+        check_call.assert_called_with(['mount', '/tmp/a.img', '/mnt/img'], timeout=30)
+
+    @patch('actions.mounts.sys_umount')
+    def test_umount(self, mock_sys_umount):
+        check_call = MagicMock(return_value=0)
+        self.assertEqual(mounts.umount('/mnt/sdb', check_call, native=True), 0)
+        mock_sys_umount.assert_called_with('/mnt/sdb')
+        check_call.assert_not_called()
+        mock_sys_umount.side_effect = OSError(errno.EPERM, 'Operation not permitted')
+        self.assertEqual(mounts.umount('/mnt/sdb', check_call, native=True), 0)
+        check_call.assert_called_with(['umount', '/mnt/sdb'], timeout=30)
+
+    def test_mount_table(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'mountinfo')
+            with open(path, 'w') as f:
+                f.write('22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+                        '30 22 8:16 / /media/my\\040stick rw,noatime - vfat /dev/sdb rw,fmask=0022\n'
+                        '31 22 8:16 / /tmp/fd_replicator/dev_sdb rw,noatime - vfat /dev/sdb rw\n')
+            table = MountTable(path=path)
+            self.assertEqual(table.get_mounts()[1], ('/dev/sdb', '/media/my stick', 'vfat'))
+            self.assertTrue(table.is_mountpoint('/media/my stick'))
+            self.assertFalse(table.is_mountpoint('/media'))
+            self.assertEqual(table.get_mount_dirs('/dev/sdb'), ['/tmp/fd_replicator/dev_sdb', '/media/my stick'])
+
+            '''Cached until invalidated (a regular file never reports a change)'''
+            with open(path, 'w') as f:
+                f.write('22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n')
+            self.assertEqual(len(table.get_mounts()), 3)
+            table.invalidate()
+            self.assertEqual(table.get_mounts(), [('/dev/sda1', '/', 'ext4')])
+        self.assertEqual(MountTable(path=os.path.join(tmp, 'missing')).get_mounts(), [])
+
+
+class FakeEventSource:
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def wait(self, timeout):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return False
+
+    def close(self):
+        self.events.put(False)
+
+
+class HotplugTests(unittest.TestCase):
+    def setUp(self):
+        self.devices = MagicMock()
+        self.devices.list_usb_ids = MagicMock(return_value={'/dev/sda': ['00', '1', '1'], '/dev/sdb': ['01', '1', '2']})
+        self.changes = queue.Queue()
+        self.source = FakeEventSource()
+        self.monitor = HotplugMonitor(self.devices, lambda added, removed: self.changes.put((added, removed)),
+                source=self.source, debounce=0.01)
+
+    def test_rescan(self):
+        self.devices.list_usb_ids.return_value = {'/dev/sdb': ['01', '1', '2'], '/dev/sdc': ['02', '1', '3']}
+        self.monitor.rescan()
+        self.assertEqual(self.changes.get_nowait(), ({'/dev/sdc': ['02', '1', '3']}, ['/dev/sda']))
+        self.assertEqual(self.monitor.usb_ids, self.devices.list_usb_ids.return_value)
+        '''The shared listing is left to the threads that call get_usb_ids'''
+        self.devices.get_usb_ids.assert_not_called()
+
+        '''Nothing changed'''
+        self.monitor.rescan()
+        self.assertTrue(self.changes.empty())
+
+    def test_run(self):
+        self.monitor.start()
+        self.devices.list_usb_ids.return_value = {}
+        '''A burst of events is listed once'''
+        for _ in range(5):
+            self.source.events.put(True)
+        self.assertEqual(self.changes.get(timeout=5), ({}, ['/dev/sda', '/dev/sdb']))
+        self.monitor.stop()
+        self.monitor.join(5)
+        self.assertFalse(self.monitor.is_alive())
+        self.assertEqual(self.devices.list_usb_ids.call_count, 2)
+
+    def test_poll_event_source(self):
+        source = PollEventSource(interval=0.05)
+        self.assertFalse(source.wait(0))
+        self.assertTrue(source.wait(1))
+        source.close()
+        self.assertFalse(source.wait(1))
+
+    def test_get_devices(self):
+        replicator_main = ReplicatorMain(devices=Devices())
+        replicator_main.fd_devices.get_usb_ids = MagicMock()
+        replicator_main.fd_devices.get_hubs_with_mappings = MagicMock(return_value={'1': {'2': '/dev/sdb'}})
+        self.assertEqual(replicator_main.get_devices(usb_ids={'/dev/sdb': ['01', '1', '2']}), (['1'], {'1': {'2': '/dev/sdb'}}))
+        replicator_main.fd_devices.get_usb_ids.assert_not_called()
+        replicator_main.fd_devices.get_hubs_with_mappings.assert_called_with({'/dev/sdb': ['01', '1', '2']})
+
+
+class ManifestCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmp.name, 'cache', 'checksums.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_and_save(self):
+        cache = ManifestCache('1234-ABCD', cache_file=self.cache_file)
+        self.assertEqual(cache.get('a.txt', 10, 1000), None)
+        cache.set('a.txt', 10, 1000, 'abc')
+        cache.set('b.txt', 20, 2000, 'def')
+        self.assertEqual(cache.save(), 0)
+
+        cache = ManifestCache('1234-ABCD', cache_file=self.cache_file)
+        self.assertEqual(cache.get('a.txt', 10, 1000), 'abc')
+        self.assertEqual(cache.get('b.txt', 21, 2000), None)
+        self.assertEqual(cache.get('b.txt', 20, 2001), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        '''Files not seen in this run are dropped'''
+        cache.save()
+        cache = ManifestCache('1234-ABCD', cache_file=self.cache_file)
+        self.assertEqual(list(cache.files), ['a.txt'])
+
+        self.assertEqual(ManifestCache('1234-ABCE', cache_file=self.cache_file).get('a.txt', 10, 1000), None)
+        self.assertEqual(ManifestCache('1234-ABCD', cache_file=self.cache_file).get_blocks('a.txt', 10, 1000, 4096), None)
+
+        cache = ManifestCache('1234-ABCD', cache_file=self.cache_file)
+        cache.set('c.txt', 30, 3000, 'ghi', blocks=(4096, ['01', '02']))
+        cache.save()
+        cache = ManifestCache('1234-ABCD', cache_file=self.cache_file)
+        self.assertEqual(cache.get_blocks('c.txt', 30, 3000, 4096), ['01', '02'])
+        self.assertEqual(cache.get_blocks('c.txt', 30, 3000, 8192), None)
+        self.assertEqual(cache.get_blocks('c.txt', 31, 3000, 4096), None)
+        self.assertEqual(ManifestCache('1234-ABCD', cache_file=self.cache_file, algorithm='crc32').get('a.txt', 10, 1000), None)
+
+    def test_compare_manifests(self):
+        source = {'a.txt': '01', 'b/a.txt': '02', 'c.txt': '03'}
+        dest = {'a.txt': '01', 'b/a.txt': '03', 'd.txt': '04'}
+        self.assertEqual(compare_manifests(source, dest), (['c.txt'], ['d.txt'], ['b/a.txt']))
+        self.assertEqual(compare_manifests(source, dict(source)), ([], [], []))
+        '''Packed and plain manifests can be mixed'''
+        self.assertEqual(compare_manifests(PackedManifest(source), PackedManifest(dest)), (['c.txt'], ['d.txt'], ['b/a.txt']))
+        self.assertEqual(compare_manifests(PackedManifest(source), dest), (['c.txt'], ['d.txt'], ['b/a.txt']))
+        self.assertEqual(compare_manifests({}, PackedManifest(dest)), ([], ['a.txt', 'b/a.txt', 'd.txt'], []))
+
+    def test_max_volumes(self):
+        for volume_id in ('1', '2', '3'):
+            cache = ManifestCache(volume_id, cache_file=self.cache_file, max_volumes=2)
+            cache.set('a.txt', 10, 1000, volume_id)
+            cache.save()
+        self.assertEqual(sorted(ManifestCache('3', cache_file=self.cache_file).volumes), ['2', '3'])
+
+    def test_load_corrupt(self):
+        os.makedirs(os.path.dirname(self.cache_file))
+        with open(self.cache_file, 'w') as f:
+            f.write('{not json')
+        self.assertEqual(ManifestCache('1', cache_file=self.cache_file).volumes, {})
+
 class MailTests(unittest.TestCase):
     @patch('actions.mail.smtplib.SMTP', return_value=MagicMock())
     def setUp(self, mock_SMTP):
@@ -2,13 +2,14 @@
 import logging
 import os
 from PyQt5.QtWidgets import *
-from PyQt5.QtCore import QObject, pyqtSignal, Qt, QTimer, QThreadPool, QRunnable, pyqtSlot
+from PyQt5.QtCore import QObject, pyqtSignal, Qt, QThreadPool, QRunnable, pyqtSlot
 from PyQt5.QtGui import QPalette, QTextCursor, QPixmap, QIntValidator
 import re
 import sys 
 import time
 import traceback
 
+from actions.fd_devices import get_registry
 from fd_replicator_main import ReplicatorMain
 from widgets.help_widget import HelpWidget
 from widgets.log_widget import LogWidget
@@ -42,6 +43,11 @@ class WorkerSignals(QObject):
     progress = pyqtSignal(tuple)
 
 
+class HotplugSignals(QObject):
+    '''Carries the (added, removed) devices from the hotplug monitor's thread to the GUI thread'''
+    changed = pyqtSignal(object, object)
+
+
 class Worker(QRunnable):
     '''
     Worker thread
@@ -93,6 +99,7 @@ class DeviceStatus:
         self.progress_bar = None
         self.icon = None
         self.status = None
+        self.probe = None
 
     def new_device(self):
         '''Create the DeviceStatus object for a new device'''
@@ -106,6 +113,7 @@ class DeviceWidget:
     def __init__(self, **kwargs):
         self.replicator_main = ReplicatorMain()
         self.usb_ports = USB_PORTS if isinstance(USB_PORTS, list) or isinstance(USB_PORTS, tuple) else []
+        self.topology = kwargs.get('topology') or get_registry().get_topology()
         self.progress_bars = {}
 
     def add_progress_bar(self, progress_bars, row, col):
@@ -129,22 +137,23 @@ class DeviceWidget:
             self.hub_widget.setLayout(self.hub_grid)
 
             hub_progress_bars = {}
-            for col in (0,1):
+            '''As many columns as the hub's ports need, every other one mirrored'''
+            layout = self.topology.get_hub(hub)
+            for row, col in layout.get_positions():
                 new_col = col * 3
-                for row in range(HUB_ROWS):
-                    text_label = QLabel()
-                    text_label.clear()
-                    text_label.setText(str(row + 1))
-                    all_ports.add((row, col))
-                    hub_progress_bars = self.add_progress_bar(hub_progress_bars, row, col)
-                    if col == 0:
-                        self.hub_grid.addWidget(text_label, row, new_col)
-                        self.hub_grid.addWidget(hub_progress_bars[(row, col)].icon, row, new_col+1)
-                        self.hub_grid.addWidget(hub_progress_bars[(row, col)].progress_bar, row, new_col+2)
-                    else:
-                        self.hub_grid.addWidget(text_label, row, new_col+2)
-                        self.hub_grid.addWidget(hub_progress_bars[(row, col)].icon, row, new_col+1)
-                        self.hub_grid.addWidget(hub_progress_bars[(row, col)].progress_bar, row, new_col)
+                text_label = QLabel()
+                text_label.clear()
+                text_label.setText(str(row + 1))
+                all_ports.add((row, col))
+                hub_progress_bars = self.add_progress_bar(hub_progress_bars, row, col)
+                if col % 2 == 0:
+                    self.hub_grid.addWidget(text_label, row, new_col)
+                    self.hub_grid.addWidget(hub_progress_bars[(row, col)].icon, row, new_col+1)
+                    self.hub_grid.addWidget(hub_progress_bars[(row, col)].progress_bar, row, new_col+2)
+                else:
+                    self.hub_grid.addWidget(text_label, row, new_col+2)
+                    self.hub_grid.addWidget(hub_progress_bars[(row, col)].icon, row, new_col+1)
+                    self.hub_grid.addWidget(hub_progress_bars[(row, col)].progress_bar, row, new_col)
             self.all_ports[hub] = all_ports
 
             self.progress_bars[hub] = hub_progress_bars
@@ -153,7 +162,7 @@ class DeviceWidget:
             num_dev_label.setText('No Devices')
             num_dev_label.setAlignment(Qt.AlignRight)
             self.num_dev_labels[hub] = num_dev_label
-            self.hub_grid.addWidget(num_dev_label, 28, 3)
+            self.hub_grid.addWidget(num_dev_label, layout.rows + 1, 3 * (layout.columns - 1))
 
             self.tab_widget.addTab(self.hub_widget, str(hub))
         return self.tab_widget
@@ -164,8 +173,11 @@ class DeviceWidget:
         for device in self.devices[hub]:
             row, col = device[2]
             new_col = col * 2
+            progress_bar = self.progress_bars[hub].get((row, col))
+            if progress_bar is None:
+                '''The mapping file has changed since the tabs were laid out'''
+                continue
             self.active_devices.add((row, col))
-            progress_bar = self.progress_bars[hub][(row, col)]
             icon = progress_bar.icon
             icon.clear()
             '''If status is 0 (Success) or None (Not finished)'''
@@ -173,11 +185,11 @@ class DeviceWidget:
                     or progress_bar.status == None else icon.setPixmap(QPixmap(ICON_RED_LED).scaled(15,15))
 
 
-    def set_led_on_active(self):
-        '''Checks devices, then updates the progress bars and leds accordingly'''
+    def set_led_on_active(self, **kwargs):
+        '''Checks devices (or the usb_ids given), then updates the progress bars and leds accordingly'''
 
         '''Get the hubs and devices'''
-        self.hubs, self.devices = self.replicator_main.get_devices()
+        self.hubs, self.devices = self.replicator_main.get_devices(usb_ids=kwargs.get('usb_ids'))
 
         '''Update if there are devices available, else clear all'''
         if self.hubs and self.devices:
@@ -201,13 +213,13 @@ class DeviceWidget:
 
     def reset_all(self):
         '''Reset all progress bars, clear the icons and set the status to None for all devices'''
-        for hub in USB_PORTS:
-            for col in (0,1):
-                new_col = col * 2
-                for row in range(HUB_ROWS):
-                    self.progress_bars[hub][(row,col)].progress_bar.reset()
-                    self.progress_bars[hub][(row,col)].icon.clear()
-                    self.progress_bars[hub][(row,col)].status = None
+        for hub_progress_bars in self.progress_bars.values():
+            for device_status in hub_progress_bars.values():
+                device_status.progress_bar.reset()
+                device_status.icon.clear()
+                device_status.status = None
+                device_status.probe = None
+                device_status.progress_bar.setToolTip('')
 
 class MainWidget(QMainWindow):
     '''Main Widget window'''
@@ -217,7 +229,17 @@ class MainWidget(QMainWindow):
         self.debug = False
         QMainWindow.__init__(self)
         self.source_object = None
+        self.list_widget_0 = None
+        self.hotplug = None
+        self.hotplug_paused = False
+        self.hotplug_changes = set()
+        self.preflight_failures = {}
+        self.probe = PROBE
+        self.probe_results = {}
         self.checksums=True
+        self.readback = READBACK_VERIFY
+        self.sample = VERIFY_SAMPLE
+        self.copy_mode = COPY_MODE
         self.init_ui()
 
     def init_ui(self):
@@ -367,6 +389,37 @@ class MainWidget(QMainWindow):
 
         row += 1
 
+        '''Checkbox for verifying the copies as read back from the flash, not from the page cache'''
+        self.readback_check_box = QCheckBox('Verify from flash')
+        self.readback_check_box.setChecked(self.readback)
+        self.readback_check_box.setEnabled(self.checksums)
+        self.grid.addWidget(self.readback_check_box, row, 0)
+        self.readback_check_box.stateChanged.connect(self.toggle_readback)
+
+        '''Percentage of the blocks of each file compared when verifying. Below 100 only a sample is checked'''
+        sample_label = QLabel()
+        sample_label.setAlignment(Qt.AlignRight)
+        sample_label.setText('Verify %:')
+        self.grid.addWidget(sample_label, row, 1)
+
+        self.sample_line_edit = QLineEdit()
+        self.sample_line_edit.setPlaceholderText(str(round(self.sample * 100)))
+        self.sample_line_edit.setValidator(QIntValidator(1, 100))
+        self.sample_line_edit.setMaxLength(3)
+        self.sample_line_edit.setAlignment(Qt.AlignRight)
+        self.sample_line_edit.editingFinished.connect(self.set_sample)
+        self.grid.addWidget(self.sample_line_edit, row, 2)
+
+        row += 1
+
+        '''Checkbox for probing the devices for fake capacity and slow writes before copying'''
+        self.probe_check_box = QCheckBox('Probe devices')
+        self.probe_check_box.setChecked(self.probe)
+        self.grid.addWidget(self.probe_check_box, row, 0)
+        self.probe_check_box.stateChanged.connect(self.toggle_probe)
+
+        row += 1
+
         '''Progress bar for initial checksum creation'''
         self.checksums_progress_bar = QProgressBar() 
         self.checksums_label = QLabel()
@@ -389,7 +442,7 @@ class MainWidget(QMainWindow):
         self.scroll_area.setWidget(self.tab_widget)
         #self.device_widget.set_led_on_active()
         
-        self.start_timer()
+        self.start_hotplug()
 
     def init_config(self):
         '''Check config directory and create if doesn't exist'''
@@ -404,15 +457,40 @@ class MainWidget(QMainWindow):
         self.total_devices = sum([len(self.devices[h]) for h in self.devices])
         self.device_widget.set_led_on_active()
 
-    def start_timer(self):
-        '''Timer for providing checking for newly plugged in devices'''
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.check_devices)
-        self.timer.start(6000)
+    def start_hotplug(self):
+        '''Watch for devices being plugged in or removed. The monitor runs in its own thread, and the
+        changes are handed to the GUI thread through a signal'''
+        self.hotplug_signals = HotplugSignals()
+        self.hotplug_signals.changed.connect(self.devices_changed)
+        self.hotplug = self.replicator_main.start_hotplug(self.hotplug_signals.changed.emit)
+
+    def devices_changed(self, added, removed):
+        '''Update the source list and the devices after devices were plugged in or removed. Not while copying,
+        when the devices show the progress of their copies: the changed devices are kept in hotplug_changes
+        instead, so copy_files leaves out those that changed since they were checked'''
+        if self.hotplug_paused:
+            for device in removed:
+                logging.info(f'{device} removed while copying')
+            self.hotplug_changes.update(added, removed)
+            return
+        self.check_devices(usb_ids=self.hotplug.usb_ids)
 
     def toggle_checksums(self, state):
         '''Set checksums variable to True or False'''
         self.checksums = True if state == Qt.Checked else False
+        self.readback_check_box.setEnabled(self.checksums)
+
+    def toggle_readback(self, state):
+        '''Set readback variable to True or False'''
+        self.readback = True if state == Qt.Checked else False
+
+    def toggle_probe(self, state):
+        '''Set probe variable to True or False'''
+        self.probe = True if state == Qt.Checked else False
+
+    def set_sample(self):
+        '''Update the fraction of the blocks compared when verifying'''
+        self.sample = int(self.sample_line_edit.text()) / 100
     
     def set_workers(self):
         '''Update number of threads'''
@@ -438,18 +516,62 @@ class MainWidget(QMainWindow):
     def prepare_checksums(self, **kwargs):
         '''Prepare the source object for copying - getting checksums, self.checksums is True'''
         progress_callback = kwargs.get('progress_callback')
-        status = self.source_object.prepare_to_copy(checksums=self.checksums, progress_callback=progress_callback)
+        if self.copy_mode == 'image':
+            status = self.source_object.prepare_image(progress_callback=progress_callback)
+        elif self.copy_mode == 'golden_image':
+            status = self.source_object.prepare_golden_image(progress_callback=progress_callback)
+        else:
+            '''In fan-out mode the source checksums are created while copying'''
+            checksums = self.checksums and self.copy_mode != 'fan_out'
+            status = self.source_object.prepare_to_copy(checksums=checksums, sample=self.sample, 
+                    progress_callback=progress_callback)
+        '''Probe the devices that passed the preflight, before any copying starts'''
+        self.probe_results = {}
+        if status == 0 and self.probe:
+            devices = [device[1] for hub in self.hubs for device in self.devices[hub] 
+                    if device[1] not in self.preflight_failures]
+            self.probe_results = self.replicator_main.probe_devices(devices, threads=self.thread_num)
         return status
 
     def copy(self, hub, device, **kwargs):
         '''Copy files to the chip (device)'''
         dest_object = self.replicator_main.new_device(device=device[1], port=device[0], hub=hub, hub_coordinates=device[2], 
-                source_mdsums=self.source_object.source_mdsums)
+                source_mdsums=self.source_object.source_mdsums, source_blocks=self.source_object.source_blocks, 
+                manifest_id=self.source_object.manifest_id, source_index=self.source_object.source_index)
         progress_callback = kwargs.get('progress_callback')
-        results = dest_object.copy(self.source_object.device, self.source_object.device_dir, checksums=self.checksums, 
+        results = dest_object.copy(self.source_object.device, self.source_object.get_copy_source_dir(), checksums=self.checksums, 
+                readback=self.readback, sample=self.sample, sync=self.copy_mode == 'sync', 
                 progress_callback=progress_callback)
         return dest_object, results
 
+    def new_dest_objects(self, devices):
+        '''Create the destination objects for a list of (hub, device)'''
+        return [self.replicator_main.new_device(device=device[1], port=device[0], hub=hub, 
+            hub_coordinates=device[2], source_mdsums=self.source_object.source_mdsums, 
+            source_blocks=self.source_object.source_blocks, manifest_id=self.source_object.manifest_id, source_index=self.source_object.source_index)
+            for hub, device in devices]
+
+    def fan_out_copy(self, devices, **kwargs):
+        '''Copy files to all the chips (devices) at once, reading the source only once'''
+        progress_callback = kwargs.get('progress_callback')
+        return self.replicator_main.fan_out_copy(self.source_object, self.new_dest_objects(devices), 
+                checksums=self.checksums, readback=self.readback, sample=self.sample, 
+                progress_callback=progress_callback, threads=self.thread_num)
+
+    def golden_image_copy(self, devices, **kwargs):
+        '''Write the golden image built from the source to all the chips (devices) at once'''
+        progress_callback = kwargs.get('progress_callback')
+        return self.replicator_main.image_copy(self.source_object, self.new_dest_objects(devices), 
+                image=self.source_object.golden_image, checksums=self.checksums, readback=self.readback, 
+                sample=self.sample, progress_callback=progress_callback, threads=self.thread_num)
+
+    def image_copy(self, devices, **kwargs):
+        '''Clone the source device to all the chips (devices) at once'''
+        progress_callback = kwargs.get('progress_callback')
+        return self.replicator_main.image_copy(self.source_object, self.new_dest_objects(devices), 
+                checksums=self.checksums, readback=self.readback, sample=self.sample, 
+                progress_callback=progress_callback, threads=self.thread_num)
+
 
     def copy_to_devices(self):
         '''Initiate the copying of files to the devices. Threads here are used for preparation (checksums). '''
@@ -465,12 +587,22 @@ class MainWidget(QMainWindow):
                     QMessageBox.warning(self, 'Warning', 'Not copying files!', QMessageBox.Ok)
                     return
             self.refresh()
-            self.timer.stop()
+            '''Check (and later probe) the devices plugged in now, not those there at startup. From here on
+            devices plugged in or removed are only recorded'''
+            self.hotplug_changes = set()
+            self.hotplug_paused = True
+            self.initialize_devices()
+            if not self.check_preflight():
+                self.hotplug_paused = False
+                if self.hotplug_changes:
+                    self.check_devices(usb_ids=self.hotplug.usb_ids)
+                return
             self.finished_devices = 0
             ### MULTITHREADING
             self.threadpool = QThreadPool()
             self.checksums_threadpool = QThreadPool()
             self.threadpool.setMaxThreadCount(self.thread_num)
+            '''One preparation worker, which hashes the source with HASH_WORKERS threads of its own'''
             self.checksums_threadpool.setMaxThreadCount(1)
 
             self.checksums_progress_bar.setValue(0)
@@ -484,10 +616,77 @@ class MainWidget(QMainWindow):
             self.checksums_worker.signals.progress.connect(self.update_checksums_progress_bar)
             self.checksums_threadpool.start(self.checksums_worker)
 
+    def check_preflight(self):
+        '''Check the devices before copying. Those too small for the payload are marked failed and left out of
+        the batch, and any problems are shown. Returns True to go ahead with the copy'''
+        devices = [device[1] for hub in self.hubs for device in self.devices[hub]]
+        self.preflight_failures, warnings = self.replicator_main.preflight(self.source_object, devices, 
+                copy_mode=self.copy_mode)
+        if not self.preflight_failures and not warnings:
+            return True
+        for hub in self.hubs:
+            for device in self.devices[hub]:
+                if device[1] in self.preflight_failures:
+                    progress_info = self.device_widget.progress_bars.get(hub, {}).get(device[2])
+                    if progress_info is None:
+                        '''The mapping file has changed since the tabs were laid out'''
+                        continue
+                    progress_info.status = 1
+                    progress_info.icon.setPixmap(QPixmap(ICON_RED_LED).scaled(15,15))
+        problems = '\n'.join([f'{device} is too small: {reason}' for device, reason in self.preflight_failures.items()]
+                + warnings)
+        if len(self.preflight_failures) == len(devices):
+            QMessageBox.warning(self, 'Warning', f'No device can hold the files!\n{problems}', QMessageBox.Ok)
+            return False
+        confirm = QMessageBox.question(self, 'Preflight', f'{problems}\nContinue?', QMessageBox.Yes | QMessageBox.No)
+        return confirm == QMessageBox.Yes
+
+    def show_probe_results(self):
+        '''Show the probe results on the devices, marking those flagged failed'''
+        for hub in self.hubs:
+            for device in self.devices[hub]:
+                result = self.probe_results.get(device[1])
+                if not result:
+                    continue
+                progress_info = self.device_widget.progress_bars.get(hub, {}).get(device[2])
+                if progress_info is None:
+                    '''The mapping file has changed since the tabs were laid out'''
+                    continue
+                progress_info.probe = result
+                progress_info.progress_bar.setToolTip(result.describe())
+                if result.flagged:
+                    progress_info.status = 1
+                    progress_info.icon.setPixmap(QPixmap(ICON_RED_LED).scaled(15,15))
+
     def copy_files(self):
         '''Copy files to the devices using multithreading'''
-        self.initialize_devices() # Get devices one last time
+        self.show_probe_results()
+        '''Leave out the devices that failed the preflight or the probe, and those plugged in or removed since
+        they were checked'''
+        for device in sorted(self.hotplug_changes):
+            logging.info(f'{device} changed since the devices were checked, not copying to it')
+        excluded = set(self.preflight_failures) | {device for device, result in self.probe_results.items() 
+                if result.flagged} | self.hotplug_changes
+        self.devices = {hub: [device for device in self.devices[hub] if device[1] not in excluded] 
+                for hub in self.devices}
+        self.total_devices = sum([len(self.devices[h]) for h in self.devices])
+        if not self.total_devices:
+            QMessageBox.warning(self, 'Warning', 'No devices left to copy to!', QMessageBox.Ok)
+            self.source_object.check_mountpoint()
+            self.source_object.cleanup_stage()
+            self.hotplug_paused = False
+            return
         self.failed_devices = 0 # Failed devices reset to 0
+        batch_copy = {'fan_out': self.fan_out_copy, 'image': self.image_copy, 
+                'golden_image': self.golden_image_copy}.get(self.copy_mode)
+        if batch_copy:
+            '''A single worker reads the source once and writes to all the devices'''
+            devices = [(hub, device) for hub in self.hubs for device in self.devices[hub]]
+            self.worker = Worker(batch_copy, devices)
+            self.worker.signals.result.connect(self.update_fan_out_results)
+            self.worker.signals.progress.connect(self.update_progress_bar)
+            self.threadpool.start(self.worker)
+            return
         for hub in self.hubs:
             for device in self.devices[hub]:
                 self.worker = Worker(self.copy, hub, device)
@@ -534,6 +733,12 @@ class MainWidget(QMainWindow):
             progress_bar.reset()
             led_icon.setPixmap(QPixmap(ICON_RED_LED).scaled(15,15))
 
+    def update_fan_out_results(self, results):
+        '''Update the result of each device once the fan-out copy is finished'''
+        for result in results:
+            self.update_result(result)
+            self.do_completed_actions()
+
     def do_completed_actions(self):
         '''As each device is completed, add to finished devices. Once all are completed, send notifications'''
         self.finished_devices += 1
@@ -542,7 +747,9 @@ class MainWidget(QMainWindow):
             logging.info('Total devices completed: {}. Failed: {}. Time Elapsed: {}'.format(self.finished_devices, 
                 self.failed_devices, total_time))
             self.source_object.check_mountpoint()
-            self.timer.start()
+            self.source_object.cleanup_stage()
+            self.hotplug_paused = False
+            self.check_devices()
             self.replicator_main.send_notification(self.finished_devices, self.failed_devices, total_time, self.file_list)
             QMessageBox.information(self, 'Finished', 
                     f'Copied {self.finished_devices} devices. Failures: {self.failed_devices}. Time Elapsed {total_time}', 
@@ -608,15 +815,17 @@ class MainWidget(QMainWindow):
             success = False
         return success
 
-    def add_source_list(self):
-        '''Set up the list widget'''
+    def add_source_list(self, **kwargs):
+        '''Set up the list widget, or refill it with the devices (from usb_ids, if given)'''
         success = True
-        self.list_widget_0 = QListWidget()
-        self.list_widget_0.setContextMenuPolicy(Qt.ActionsContextMenu)
-        self.list_widget_0.itemActivated.connect(self.select_source)
-        self.grid.addWidget(self.list_widget_0, 1, 1, 3, 2)
+        if self.list_widget_0 is None:
+            self.list_widget_0 = QListWidget()
+            self.list_widget_0.setContextMenuPolicy(Qt.ActionsContextMenu)
+            self.list_widget_0.itemActivated.connect(self.select_source)
+            self.grid.addWidget(self.list_widget_0, 1, 1, 3, 2)
+        self.list_widget_0.clear()
 
-        devices = self.replicator_main.get_direct_dev()
+        devices = self.replicator_main.get_direct_dev(usb_ids=kwargs.get('usb_ids'))
 
         try:
             self.source_ports = list(devices.values())
@@ -630,10 +839,10 @@ class MainWidget(QMainWindow):
         #self.list_widget_0.show()
         return success
 
-    def check_devices(self):
-        '''Add source list, and check devices'''
-        self.add_source_list()
-        self.device_widget.set_led_on_active()
+    def check_devices(self, **kwargs):
+        '''Add source list, and check devices (listing them, unless usb_ids is given)'''
+        self.add_source_list(usb_ids=kwargs.get('usb_ids'))
+        self.device_widget.set_led_on_active(usb_ids=kwargs.get('usb_ids'))
 
     def reset_devices(self):
         self.checksums_progress_bar.reset()
@@ -641,4 +850,6 @@ class MainWidget(QMainWindow):
         self.device_widget.set_led_on_active()
 
     def exit(self):
+        if self.hotplug:
+            self.hotplug.stop()
         self.close()